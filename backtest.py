@@ -0,0 +1,340 @@
+import os
+import sys
+import logging
+from concurrent.futures import Future
+from ohlcv_aggregator import OhlcvAggregator
+from liquid_message import Ticker
+from position_ledger import PositionLedger,apply_fill
+
+class SimulatedClock():
+    """
+    バックテスト中の時刻。約定データの再生に合わせて進める。
+    """
+    def __init__(self,now=0):
+        self.now = now
+
+class SimulatedExecutor():
+    """
+    submitされた関数をその場で実行する。バックテストの結果を再現可能にするため、スレッドプールの代わりに使う。
+    """
+    def submit(self,fn,*args,**kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args,**kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self,wait=True):
+        pass
+
+class SimulatedRealtimeApi():
+    """
+    約定データからTickerとローソク足を作り、LiquidRealtimeApiと同じメソッドで返す。
+    板情報は持たないため、ask,bidは最終約定価格とする。
+    """
+    def __init__(self,clock,ohlcv_resolutions=(1,60),ohlcv_length=600):
+        self.clock = clock
+        self.ticker = None
+        self.last_massage_timestamp = 0
+        self.ohlcv = OhlcvAggregator(resolutions=ohlcv_resolutions,length=ohlcv_length)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def on_execution(self,timestamp,price,quantity,taker_side):
+        self.ticker = Ticker(timestamp,price,price,price,price,price,0.0,0.0)
+        self.last_massage_timestamp = timestamp
+        self.ohlcv.update(timestamp,price,quantity,taker_side)
+
+    def get_seconds_from_last_message(self):
+        return self.clock.now - self.last_massage_timestamp
+
+    def get_ticker(self):
+        return self.ticker
+
+    def get_ohlcv(self,n,resolution=60):
+        return self.ohlcv.get(n,resolution)
+
+    def get_book(self):
+        return None
+
+class SimulatedRestApi():
+    """
+    LiquidRestApiの発注系メソッドをシミュレートする。
+    指値注文は発注からorder_latency秒後に板に載り、約定価格が注文価格を超えた(fill_on_touchの場合は達した)時点で全量約定する。
+    キャンセルはcancel_latency秒後に反映され、それまでは約定しうる。
+    注文の変更はorder_latency秒後に反映され、それまでは変更前の価格・数量で約定しうる。
+    ポジションはnetoutで管理し、実現損益・未実現損益を計算する。
+    注文の状態が変わるたびにposition_ledgerに渡し、LiquidRestApiと同じく台帳でもポジションを追えるようにする。
+    """
+    def __init__(self,clock,order_latency=0.1,cancel_latency=0.1,fill_on_touch=False):
+        """
+        :param clock:SimulatedClock
+        :param order_latency:発注が板に載るまでの秒数
+        :param cancel_latency:キャンセルが反映されるまでの秒数
+        :param fill_on_touch:Trueの場合、約定価格が注文価格と同じでも約定とみなす
+        """
+        self.clock = clock
+        self.order_latency = order_latency
+        self.cancel_latency = cancel_latency
+        self.fill_on_touch = fill_on_touch
+        self.symbol = 'BTC/JPY'
+        self.orders = {}
+        self.live_order_ids = []
+        self._next_order_id = 1
+        self.ltp = None
+        self.position = 0
+        self.average_price = 0
+        self.realized_pnl = 0
+        self._reported_pnl = 0
+        self.position_ledger = PositionLedger(since=clock.now)
+
+    def start_order_sync(self):
+        pass
+
+    def stop_order_sync(self):
+        pass
+
+    def _format(self,order):
+        return {
+            "id":order["id"],
+            "timestamp":order["timestamp"],
+            "symbol":self.symbol,
+            "status":order["status"],
+            "side":"buy" if order["quantity"] > 0 else "sell",
+            "price":order["price"],
+            "quantity":order["quantity"],
+            "order_type":order["order_type"],
+            "remaining":abs(order["quantity"]) if order["status"] == "filled" else 0.0,
+            }
+
+    def _create_order(self,order_type,quantity,price):
+        order = {
+            "id":self._next_order_id,
+            "timestamp":self.clock.now,
+            "status":"live",
+            "order_type":order_type,
+            "price":price,
+            "quantity":quantity,
+            "active_at":self.clock.now + self.order_latency,
+            "cancel_at":None,
+            "edit":None,
+            }
+        self._next_order_id += 1
+        self.orders[order["id"]] = order
+        self.live_order_ids.append(order["id"])
+        self.position_ledger.on_order(self._format(order))
+        return self._format(order)
+
+    def limit_order(self,quantity,price):
+        return self._create_order("limit",quantity,price)
+
+    def market_order(self,quantity):
+        return self._create_order("market",quantity,None)
+
+    def cancel_order(self,order_id):
+        order = self.orders.get(order_id)
+        if order is None or order["status"] != "live":return None
+        if order["cancel_at"] is None:
+            order["cancel_at"] = self.clock.now + self.cancel_latency
+        return self._format(order)
+
+    def edit_order(self,order_id,quantity,price):
+        order = self.orders.get(order_id)
+        if order is None or order["status"] != "live" or order["cancel_at"] is not None:return None
+        quantity = abs(quantity) if order["quantity"] > 0 else -abs(quantity)
+        order["edit"] = (self.clock.now + self.order_latency,quantity,price)
+        return dict(self._format(order),quantity=quantity,price=price)
+
+    def cancel_orders(self,order_ids):
+        results = {}
+        for order_id in order_ids:
+            order = self.cancel_order(order_id)
+            results[order_id] = {"result":"cancelled" if order is not None else "failed","order":order}
+        return results
+
+    def cancel_all_orders(self,side=None,min_price=None,max_price=None):
+        order_ids = []
+        for order in self.get_orders(status="live"):
+            if side is not None and order["side"] != side:continue
+            if min_price is not None and order["price"] < min_price:continue
+            if max_price is not None and order["price"] > max_price:continue
+            order_ids.append(order["id"])
+        return self.cancel_orders(order_ids)
+
+    def get_orders(self,status=None):
+        if status == "live":
+            return [self._format(self.orders[order_id]) for order_id in self.live_order_ids]
+        return [self._format(order) for order in self.orders.values() if status is None or order["status"] == status]
+
+    def get_order(self,order_id):
+        if order_id not in self.orders:
+            raise Exception("no such order.")
+        return self._format(self.orders[order_id])
+
+    def get_local_orders(self,status=None,side=None):
+        return [order for order in self.get_orders(status) if side is None or order["side"] == side]
+
+    def _fill(self,quantity,price):
+        """
+        約定をポジションに反映する。計算はPositionLedgerと共通。
+        """
+        self.position,self.average_price,pnl = apply_fill(self.position,self.average_price,quantity,price)
+        self.realized_pnl += pnl
+
+    def on_execution(self,timestamp,price,quantity,taker_side):
+        """
+        約定1件ごとに、キャンセルの反映と注文の約定判定を行う。
+        """
+        self.ltp = price
+        still_live = []
+        for order_id in self.live_order_ids:
+            order = self.orders[order_id]
+            if order["cancel_at"] is not None and order["cancel_at"] <= timestamp:
+                order["status"] = "cancelled"
+                self.position_ledger.on_order(self._format(order))
+                continue
+            if order["edit"] is not None and order["edit"][0] <= timestamp:
+                _,order["quantity"],order["price"] = order["edit"]
+                order["edit"] = None
+                self.position_ledger.on_order(self._format(order))
+            if order["active_at"] > timestamp:
+                still_live.append(order_id)
+                continue
+            if order["order_type"] == "market":
+                filled = True
+            elif order["quantity"] > 0:
+                filled = price < order["price"] or (self.fill_on_touch and price == order["price"])
+            else:
+                filled = price > order["price"] or (self.fill_on_touch and price == order["price"])
+            if filled:
+                order["status"] = "filled"
+                if order["order_type"] == "market":
+                    order["price"] = price
+                self._fill(order["quantity"],order["price"])
+                self.position_ledger.on_order(self._format(order))
+            else:
+                still_live.append(order_id)
+        self.live_order_ids = still_live
+
+    def position_close_all(self):
+        if self.position != 0 and self.ltp is not None:
+            # 即座に約定した成行注文として台帳にも反映する
+            order = {
+                "id":self._next_order_id,
+                "timestamp":self.clock.now,
+                "status":"filled",
+                "order_type":"market",
+                "price":self.ltp,
+                "quantity":-self.position,
+                "active_at":self.clock.now,
+                "cancel_at":None,
+                "edit":None,
+                }
+            self._next_order_id += 1
+            self.orders[order["id"]] = order
+            self._fill(order["quantity"],order["price"])
+            self.position_ledger.on_order(self._format(order))
+
+    def get_position_and_open_closed_pnl(self):
+        """
+        :return: ポジション、未実現損益、前回呼び出し時からの実現損益
+        """
+        open_pnl = (self.ltp - self.average_price) * self.position if self.position != 0 else 0
+        closed_pnl = self.realized_pnl - self._reported_pnl
+        self._reported_pnl = self.realized_pnl
+        return self.position,open_pnl,closed_pnl
+
+class BacktestMixin():
+    """
+    botの時刻、sleep、発注スレッドプールをシミュレーション用に差し替える。
+    _sleepで時刻を進めると、その間の約定データを再生する。
+    """
+    def _sleep(self,n):
+        self.backtester.advance(n)
+        if self.backtester.finished():
+            self.stop_flg = True
+
+    def _wait_tick(self,n):
+        # シミュレーションでは受信イベントを待たずに時刻を進める
+        self._sleep(n)
+
+    def _get_now_timestamp(self):
+        return self.backtester.clock.now
+
+    def _create_executor(self,max_workers):
+        return SimulatedExecutor()
+
+class Backtester():
+    """
+    約定データを再生し、botの_logicを変更せずにシミュレーション時刻で動かす。
+    """
+    def __init__(self,bot_class,executions,logger,config=None,order_latency=0.1,cancel_latency=0.1,fill_on_touch=False):
+        """
+        :param bot_class:BotBaseの子クラス
+        :param executions:timestamp,price,quantity,taker_sideを持つ約定の構造化配列(TickReaderのexecutionsなど)。時系列順。
+            taker_sideは"buy"/"sell"か1/-1。
+        :param logger:ロガーインスタンス
+        :param config:botに渡すコンフィグ
+        :param order_latency:発注が板に載るまでの秒数
+        :param cancel_latency:キャンセルが反映されるまでの秒数
+        :param fill_on_touch:Trueの場合、約定価格が注文価格と同じでも約定とみなす
+        """
+        self.timestamps = executions["timestamp"].tolist()
+        self.prices = executions["price"].tolist()
+        self.quantities = executions["quantity"].tolist()
+        self.taker_sides = ["buy" if side in (1,"buy") else "sell" for side in executions["taker_side"].tolist()]
+        self.index = 0
+        self.clock = SimulatedClock(self.timestamps[0] if len(self.timestamps) else 0)
+        self.rest = SimulatedRestApi(self.clock,order_latency=order_latency,cancel_latency=cancel_latency,fill_on_touch=fill_on_touch)
+        self.realtime = SimulatedRealtimeApi(self.clock)
+        bot_class = type(f"Backtest{bot_class.__name__}",(BacktestMixin,bot_class),{})
+        config = config if config is not None else {"liquid_api_keys":[]}
+        self.bot = bot_class(config,logger,rest=self.rest,realtime=self.realtime)
+        self.bot.backtester = self
+
+    def finished(self):
+        return self.index >= len(self.timestamps)
+
+    def advance(self,n):
+        """
+        時刻をn秒進め、その間の約定を再生する。
+        """
+        target = self.clock.now + n
+        while self.index < len(self.timestamps) and self.timestamps[self.index] <= target:
+            args = (self.timestamps[self.index],self.prices[self.index],self.quantities[self.index],self.taker_sides[self.index])
+            self.clock.now = args[0]
+            self.rest.on_execution(*args)
+            self.realtime.on_execution(*args)
+            self.index += 1
+        self.clock.now = target
+
+    def run(self):
+        """
+        データの最後まで_logicを実行し、成績を返す。
+        :return: pnl,pf,wr,tc,hsの辞書(HigeCatchBot._get_resultと同じ)
+        """
+        self.advance(0)
+        self.bot.stop_flg = False
+        self.bot._logic()
+        return self.bot._get_result()
+
+
+if __name__=='__main__':
+    from tick_recorder import TickReader
+    from hige_catch_bot import HigeCatchBot
+    from setup_logger import setup_logger
+    if len(sys.argv) < 2:
+        print("usage: python backtest.py tick_dir [start_timestamp] [end_timestamp]")
+        sys.exit(1)
+    start = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    end = float(sys.argv[3]) if len(sys.argv) > 3 else None
+    executions = TickReader(sys.argv[1]).read("executions",start,end)
+    logger = setup_logger(os.path.basename(__file__))
+    logger.setLevel(logging.WARNING)
+    backtester = Backtester(HigeCatchBot,executions,logger)
+    print(backtester.run())
@@ -0,0 +1,48 @@
+"""
+realtime apiのメッセージ1件あたりのデコード時間をデコーダーごとに計測する。
+python benchmarks/bench_decoder.py
+"""
+import os
+import sys
+import json
+import time
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from liquid_message import available_decoders,get_decoder
+
+TICKER_MESSAGE = json.dumps({
+    "id":"5","product_type":"CurrencyPair","code":"CASH","name":" CASH Trading","market_ask":"4012345.0",
+    "market_bid":"4012000.0","indicator":None,"currency":"JPY","currency_pair_code":"BTCJPY","symbol":"¥",
+    "btc_minimum_withdraw":None,"fiat_minimum_withdraw":None,"pusher_channel":"product_cash_btcjpy_5",
+    "taker_fee":"0.0","maker_fee":"0.0","low_market_bid":"3950000.0","high_market_ask":"4100000.0",
+    "volume_24h":"1234.56789","last_price_24h":"4000000.0","last_traded_price":"4012100.0",
+    "last_traded_quantity":"0.01","average_price":None,"quoted_currency":"JPY","base_currency":"BTC",
+    "tick_size":"1.0","disabled":False,"margin_enabled":True,"cfd_enabled":False,"perpetual_enabled":False,
+    "last_event_timestamp":"1600000000.123456789","timestamp":"1600000000.123456789",
+    })
+EXECUTION_MESSAGE = json.dumps({
+    "created_at":1600000000,"id":123456789,"price":4012100.0,"quantity":0.01,
+    "taker_side":"buy","timestamp":"1600000000.123456"
+    })
+BOOK_MESSAGE = json.dumps({
+    "asks":[[str(4012345.0 + i),str(0.01 * (i % 7 + 1))] for i in range(40)],
+    "bids":[[str(4012000.0 - i),str(0.01 * (i % 5 + 1))] for i in range(40)],
+    "timestamp":"1600000000.123456789",
+    })
+
+def bench(func,message,n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func(message)
+    return (time.perf_counter() - start) / n * 1e6
+
+def main(n=20000):
+    print(f"{'decoder':10}{'ticker[us]':>12}{'execution[us]':>15}{'book[us]':>10}")
+    for name in available_decoders():
+        decoder = get_decoder(name)
+        ticker = bench(lambda message:decoder.decode_ticker(message,0),TICKER_MESSAGE,n)
+        execution = bench(decoder.decode_execution,EXECUTION_MESSAGE,n)
+        book = bench(decoder.decode_book,BOOK_MESSAGE,n)
+        print(f"{name:10}{ticker:12.2f}{execution:15.2f}{book:10.2f}")
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+realtime apiのメッセージ処理とrest apiの注文の変換を計測する。
+合成したTicker・約定・板のメッセージを受信スレッドと同じ関数に連続で渡し、
+1件あたりの処理時間のパーセンタイル、1秒あたりの処理件数、1件あたりのメモリ確保量を求める。
+結果はjsonで保存し、比較対象のjsonを指定した場合は処理時間の比を表示する。
+python benchmarks/bench_realtime.py [出力json] [比較対象json]
+"""
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime
+import numpy as np
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_decoder import TICKER_MESSAGE,EXECUTION_MESSAGE
+from liquid_realtime_api import LiquidRealtimeApi
+from liquid_rest_api import LiquidRestApi
+from setup_logger import setup_logger
+
+START_TIMESTAMP = 1600000000.0
+START_PRICE = 4012100.0
+BOOK_LEVELS = 40
+
+def ticker_messages(n,rate=5,seed=0):
+    """
+    Tickerのメッセージを作る。
+    :param n:件数
+    :param rate:1秒あたりの件数(取引所時刻)
+    """
+    rng = np.random.default_rng(seed)
+    template = json.loads(TICKER_MESSAGE)
+    prices = START_PRICE + np.cumsum(rng.normal(0,300,n)).round()
+    messages = []
+    for i,price in enumerate(prices.tolist()):
+        timestamp = f"{START_TIMESTAMP + i / rate:.9f}"
+        template.update({
+            "last_traded_price":f"{price:.1f}",
+            "market_ask":f"{price + 100:.1f}",
+            "market_bid":f"{price - 100:.1f}",
+            "timestamp":timestamp,
+            "last_event_timestamp":timestamp,
+            })
+        messages.append(json.dumps(template))
+    return messages
+
+def execution_messages(n,rate=20,burst=10,seed=0):
+    """
+    約定のメッセージを作る。成行注文で板を複数段食う約定を再現するため、burst件ずつ同じ時刻で価格を1円ずつずらす。
+    :param rate:1秒あたりの約定の塊の数(取引所時刻)
+    :param burst:1つの塊の最大件数。塊ごとに1からburstの一様分布。
+    """
+    rng = np.random.default_rng(seed)
+    template = json.loads(EXECUTION_MESSAGE)
+    messages = []
+    price = START_PRICE
+    timestamp = START_TIMESTAMP
+    execution_id = 1
+    while len(messages) < n:
+        timestamp += rng.exponential(1 / rate)
+        price = round(price + rng.normal(0,300))
+        side = "buy" if rng.random() < 0.5 else "sell"
+        step = 1 if side == "buy" else -1
+        for i in range(min(int(rng.integers(1,burst + 1)),n - len(messages))):
+            template.update({
+                "id":execution_id,
+                "created_at":int(timestamp),
+                "price":price + i * step,
+                "quantity":round(float(rng.exponential(0.02)) + 0.001,8),
+                "taker_side":side,
+                "timestamp":f"{timestamp:.6f}",
+                })
+            messages.append(json.dumps(template))
+            execution_id += 1
+    return messages
+
+def book_messages(n,rate=10,levels=BOOK_LEVELS,seed=0):
+    """
+    片側levels段の板のメッセージを作る。Liquidの板は1メッセージで片側の全段を送る。
+    """
+    rng = np.random.default_rng(seed)
+    prices = START_PRICE + np.cumsum(rng.normal(0,300,n)).round()
+    messages = []
+    for i,price in enumerate(prices.tolist()):
+        ask_sizes = rng.exponential(0.05,levels).round(8) + 0.001
+        bid_sizes = rng.exponential(0.05,levels).round(8) + 0.001
+        ask_steps = np.cumsum(rng.integers(1,50,levels))
+        bid_steps = np.cumsum(rng.integers(1,50,levels))
+        messages.append(json.dumps({
+            "asks":[[f"{price + step:.5f}",f"{size:.8f}"] for step,size in zip(ask_steps.tolist(),ask_sizes.tolist())],
+            "bids":[[f"{price - step:.5f}",f"{size:.8f}"] for step,size in zip(bid_steps.tolist(),bid_sizes.tolist())],
+            "timestamp":f"{START_TIMESTAMP + i / rate:.9f}",
+            }))
+    return messages
+
+def order_responses(n,seed=0):
+    """
+    /orders/のレスポンスの注文を作る。
+    """
+    rng = np.random.default_rng(seed)
+    orders = []
+    for i in range(n):
+        side = "buy" if rng.random() < 0.5 else "sell"
+        orders.append({
+            "id":1000000 + i,"order_type":"limit","quantity":"0.01000000","disc_quantity":"0.0",
+            "iceberg_total_quantity":"0.0","side":side,"filled_quantity":"0.0","price":f"{START_PRICE + rng.integers(-5000,5000):.5f}",
+            "created_at":int(START_TIMESTAMP) + i,"updated_at":int(START_TIMESTAMP) + i,"status":"live",
+            "leverage_level":2,"source_exchange":"QUOINE","product_id":5,"margin_type":None,"take_profit":None,
+            "stop_loss":None,"trading_type":"margin","product_code":"CASH","funding_currency":"JPY",
+            "crypto_account_id":None,"currency_pair_code":"BTCJPY","average_price":"0.0","target":"margin",
+            "order_fee":"0.0","source_action":"manual","unwound_trade_id":None,"trade_id":None,"client_order_id":None,
+            })
+    return orders
+
+def measure(func,args_list,memory_samples=1000):
+    """
+    args_listの各要素でfuncを呼び、処理時間とメモリ確保量を計測する。
+    処理時間の計測とメモリの計測は別に行う。tracemallocは処理を大きく遅くするため。
+    :param args_list:funcに渡す引数のタプルのリスト
+    :param memory_samples:メモリを計測する呼び出しの数。args_listの最後からこの件数を使う。
+    """
+    latencies = np.empty(len(args_list),dtype=np.float64)
+    perf_counter_ns = time.perf_counter_ns
+    timed = args_list[:len(args_list) - memory_samples]
+    start = perf_counter_ns()
+    for i,args in enumerate(timed):
+        t = perf_counter_ns()
+        func(*args)
+        latencies[i] = perf_counter_ns() - t
+    elapsed = (perf_counter_ns() - start) / 1e9
+    latencies = latencies[:len(timed)] / 1e3
+
+    peaks = []
+    retained = []
+    blocks = []
+    tracemalloc.start()
+    for args in args_list[len(timed):]:
+        tracemalloc.reset_peak()
+        block_num = sys.getallocatedblocks()
+        before,_ = tracemalloc.get_traced_memory()
+        func(*args)
+        current,peak = tracemalloc.get_traced_memory()
+        blocks.append(sys.getallocatedblocks() - block_num)
+        peaks.append(peak - before)
+        retained.append(current - before)
+    tracemalloc.stop()
+    return {
+        "count":len(timed),
+        "throughput_per_sec":len(timed) / elapsed if elapsed > 0 else None,
+        "mean_us":float(latencies.mean()),
+        "p50_us":float(np.percentile(latencies,50)),
+        "p90_us":float(np.percentile(latencies,90)),
+        "p99_us":float(np.percentile(latencies,99)),
+        "p999_us":float(np.percentile(latencies,99.9)),
+        "max_us":float(latencies.max()),
+        "peak_bytes_per_call":float(np.mean(peaks)),
+        "retained_bytes_per_call":float(np.mean(retained)),
+        "retained_blocks_per_call":float(np.mean(blocks)),
+        }
+
+def _create_realtime(logger,decoder):
+    # websocketには接続せず、受信時の関数だけを使う
+    return LiquidRealtimeApi(logger,decoder=decoder,backfill=False)
+
+def run(n=20000,decoder="json",memory_samples=1000):
+    """
+    全ての対象を計測する。
+    :param n:対象ごとの呼び出し回数(メモリの計測分を含む)
+    :param decoder:realtime apiのデコーダー
+    :return: 対象名をキーとした計測結果の辞書
+    """
+    logger = setup_logger("bench_realtime")
+    results = {}
+
+    realtime = _create_realtime(logger,decoder)
+    results["_recieve_market"] = measure(realtime._recieve_market,[(message,) for message in ticker_messages(n)],memory_samples)
+
+    # 本番と同じく約定ごとにTickerの最終価格を更新させるため、Tickerを1件受信しておく
+    realtime = _create_realtime(logger,decoder)
+    realtime._recieve_market(ticker_messages(1)[0])
+    messages = execution_messages(n)
+    results["_recieve_executions"] = measure(realtime._recieve_executions,[(message,) for message in messages],memory_samples)
+
+    realtime = _create_realtime(logger,decoder)
+    results["_recieve_book"] = measure(realtime._recieve_book,[(message,) for message in book_messages(n)],memory_samples)
+
+    # デコード済みの約定で、ローソク足の更新のみを計測する
+    realtime = _create_realtime(logger,decoder)
+    executions = [realtime.decoder.decode_execution(message) for message in messages]
+    results["_update_ohlcv"] = measure(realtime._update_ohlcv,[(execution,) for execution in executions],memory_samples)
+
+    # 足が埋まった状態で取得する
+    for count in (1,60,600):
+        for resolution in (1,60):
+            results[f"get_ohlcv[n={count},resolution={resolution}]"] = measure(realtime.get_ohlcv,[(count,resolution)] * n,memory_samples)
+
+    # _to_my_order_formatはインスタンスの状態を使わないため、apiキーやセッションを用意せずに呼ぶ
+    rest = LiquidRestApi.__new__(LiquidRestApi)
+    results["_to_my_order_format"] = measure(rest._to_my_order_format,[(order,) for order in order_responses(n)],memory_samples)
+    return results
+
+def _revision():
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run(["git","rev-parse","--short","HEAD"],cwd=root,capture_output=True,text=True,check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def compare(results,baseline):
+    """
+    比較対象の結果に対する処理時間(p50,p99)と処理件数の比を表示する。1より大きいほど遅くなっている。
+    """
+    print(f"{'target':40}{'p50':>8}{'p99':>8}{'throughput':>12}")
+    for name,result in results.items():
+        base = baseline.get(name)
+        if base is None:continue
+        p50 = result["p50_us"] / base["p50_us"] if base["p50_us"] else float("nan")
+        p99 = result["p99_us"] / base["p99_us"] if base["p99_us"] else float("nan")
+        throughput = base["throughput_per_sec"] / result["throughput_per_sec"] if result["throughput_per_sec"] else float("nan")
+        print(f"{name:40}{p50:8.2f}{p99:8.2f}{throughput:12.2f}")
+
+def main(n=20000,decoder="json"):
+    revision = _revision()
+    output = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)),"results",f"bench_realtime_{revision}.json")
+    results = run(n,decoder)
+    print(f"{'target':40}{'msg/s':>12}{'p50[us]':>10}{'p99[us]':>10}{'p99.9[us]':>11}{'peak[B]':>10}{'retained[B]':>13}")
+    for name,result in results.items():
+        print(f"{name:40}{result['throughput_per_sec']:12.0f}{result['p50_us']:10.2f}{result['p99_us']:10.2f}{result['p999_us']:11.2f}"
+            f"{result['peak_bytes_per_call']:10.0f}{result['retained_bytes_per_call']:13.1f}")
+    report = {
+        "revision":revision,
+        "created_at":datetime.now().isoformat(),
+        "python":platform.python_version(),
+        "numpy":np.__version__,
+        "platform":platform.platform(),
+        "decoder":decoder,
+        "n":n,
+        "results":results,
+        }
+    os.makedirs(os.path.dirname(os.path.abspath(output)),exist_ok=True)
+    with open(output,"w") as f:
+        json.dump(report,f,indent=2)
+    print(f"saved {output}")
+    if len(sys.argv) > 2:
+        with open(sys.argv[2],"r") as f:
+            compare(results,json.load(f)["results"])
+
+if __name__=='__main__':
+    main()
@@ -1,53 +1,187 @@
 from liquid_realtime_api import LiquidRealtimeApi
 from liquid_rest_api import LiquidRestApi
 from setup_logger import setup_logger
+from latency_metrics import latency_metrics
+from clock_sync import ClockSync
+from market_data_bus import MarketDataPublisher,MarketDataReader,DEFAULT_NAME
+from tick_recorder import TickRecorder,BOOK_LEVELS
 import json
 import os
+import asyncio
+import inspect
 from datetime import datetime,timezone,timedelta
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 import time
 
 class BotBase():
-    def __init__(self,config,logger):
+    def __init__(self,config,logger,rest=None,realtime=None):
         """
+        :param config:コンフィグインスタンス
         :param logger:ロガーインスタンス
+        :param rest:RestApiインスタンス。Noneの場合はLiquidRestApiを作る。バックテストではシミュレーターを渡す。
+        :param realtime:RealtimeApiインスタンス。Noneの場合はLiquidRealtimeApiを作る。バックテストではシミュレーターを渡す。
         """
-        self.rest = LiquidRestApi(config,logger)
-        self.realtime = LiquidRealtimeApi(logger)
+        self.config = config
+        # 取引所との時刻のずれの推定はrealtime,restで共有する
+        self.clock_sync = ClockSync(**config.get("clock_sync",{}))
+        self.rest = rest if rest is not None else LiquidRestApi(config,logger,clock_sync=self.clock_sync)
+        # 非同期版は_logicがコルーチン関数の場合のみ作る。aiohttpはその場合のみ必要。
+        self.async_rest = None
+        if inspect.iscoroutinefunction(self._logic):
+            from liquid_async_rest_api import LiquidAsyncRestApi
+            self.async_rest = LiquidAsyncRestApi(config,logger)
+        # 共有メモリのマーケットデータ。{"mode":"publisher"|"reader","name":共有メモリの名前,"publisher":MarketDataPublisherの引数}
+        # readerの場合はwebsocketに接続せず、publisherのプロセスが書き込んだデータを読む。
+        self.market_data_bus_config = config.get("market_data_bus",{})
+        self.market_data_publisher = None
+        if realtime is None and self.market_data_bus_config.get("mode") == "reader":
+            realtime = MarketDataReader(name=self.market_data_bus_config.get("name",DEFAULT_NAME))
+        self.realtime = realtime if realtime is not None else self._create_realtime(config,logger)
         self.logger = logger
         self.stop_flg = True
         self.logic_thread = None
+        # イベント駆動モード。_wait_tickの間、データを受信するたびに_on_realtime_updateを呼ぶ。
+        self.event_driven = config.get("event_driven",False)
+        self.event_coalesce = config.get("event_coalesce",0)
+        # レイテンシ計測。{"enabled":bool,"export_interval":秒,"http_port":ポート番号}
+        self.latency_config = config.get("latency_metrics",{})
+        self.decision_perf = None
         self.tz = timezone(timedelta(hours=+9), 'Asia/Tokyo')
 
-    def _log(self,message):
+    def _create_realtime(self,config,logger):
+        """
+        LiquidRealtimeApiを作る。
+        liquid_realtimeにrecord_dirがある場合は、受信したメッセージをTickRecorderでそのディレクトリに記録する。
+        記録したディレクトリはbacktest.py、mispricing_analyzer.pyのtick_dirに渡せる。板の段数はrecord_book_levelsで指定する。
+        TickRecorderはrealtimeのstart・stopで開始・終了する。
+        """
+        realtime_config = dict(config.get("liquid_realtime",{}))
+        record_dir = realtime_config.pop("record_dir",None)
+        record_book_levels = realtime_config.pop("record_book_levels",BOOK_LEVELS)
+        recorder = TickRecorder(record_dir,logger,book_levels=record_book_levels) if record_dir is not None else None
+        return LiquidRealtimeApi(logger,clock_sync=self.clock_sync,recorder=recorder,**realtime_config)
+
+    def _log(self,message,*args):
+        """
+        :param args:messageに%で埋め込む値。出力する時に組み立てる。
+        """
+        message = "[BotBase]" + str(message)
+        self.logger.info(message,*args)
+
+    def _log_error(self,message,*args,exc_info=False):
+        """
+        :param exc_info:Trueの場合、処理中の例外のトレースバックを付ける。トレースバックも出力する時に組み立てる。
+        """
         message = "[BotBase]" + str(message)
-        self.logger.info(message)
+        self.logger.error(message,*args,exc_info=exc_info)
 
     def start(self):
         self._log("start bot.")
+        if self.latency_config.get("enabled",False):
+            latency_metrics.enable()
+            latency_metrics.start_exporter(
+                self.logger,
+                interval=self.latency_config.get("export_interval",60),
+                http_port=self.latency_config.get("http_port"),
+                )
         self.realtime.start()
+        # 公開の約定からポジション台帳の約定を推定する
+        position_ledger = getattr(self.rest,"position_ledger",None)
+        if position_ledger is not None and hasattr(self.realtime,"subscribe"):
+            self.realtime.subscribe(position_ledger.on_execution)
+        if self.market_data_bus_config.get("mode") == "publisher":
+            self.market_data_publisher = MarketDataPublisher(
+                self.realtime,
+                name=self.market_data_bus_config.get("name",DEFAULT_NAME),
+                **self.market_data_bus_config.get("publisher",{}),
+                )
+        self.rest.start_order_sync()
         self.stop_flg = False
-        self.logic_thread = Thread(target=self._logic)
+        self.logic_thread = Thread(target=self._run_logic)
         self.logic_thread.setDaemon(True)
         self.logic_thread.start()
 
     def stop(self):
         self._log("stopping bot.")
+        if self.market_data_publisher is not None:
+            self.market_data_publisher.close()
+            self.market_data_publisher = None
         self.realtime.stop()
         self.rest.cancel_all_orders()
+        self.rest.stop_order_sync()
         self.stop_flg = True
         if self.logic_thread is not None:self.logic_thread.join()
+        if self.latency_config.get("enabled",False):
+            latency_metrics.stop_exporter()
         self._log("stop bot.")
 
+    def _run_logic(self):
+        """
+        ロジックスレッドで実行する。
+        _logicがコルーチン関数(async def)の場合はイベントループを作って実行する。
+        """
+        if inspect.iscoroutinefunction(self._logic):
+            asyncio.run(self._run_async_logic())
+        else:
+            self._logic()
+
+    async def _run_async_logic(self):
+        try:
+            await self._logic()
+        finally:
+            await self.async_rest.close()
+
     def _logic(self):
         """
         子クラスでオーバーライドする。
+        async defでオーバーライドした場合、self.async_restで非同期に発注できる。
         """
         while self.stop_flg == False:
             print(self.realtime.get_ticker())
 
     def _sleep(self,n):
         time.sleep(n)
+
+    def _mark_decision(self):
+        """
+        発注判断の時点を記録する。最後のメッセージ受信からのレイテンシを計測し、発注の応答までの計測の起点にする。
+        """
+        self.decision_perf = time.perf_counter()
+        latency_metrics.record_since("bot_decision",getattr(self.realtime,"last_receive_perf",None))
+
+    def _wait_tick(self,n):
+        """
+        ロジックの1周期分(n秒)待つ。
+        イベント駆動モードでは、待っている間にTicker・約定を受信するたびに_on_realtime_updateを呼ぶ。
+        """
+        if not self.event_driven:
+            self._sleep(n)
+            return
+        deadline = time.monotonic() + n
+        seq = self.realtime.update_seq
+        while self.stop_flg == False:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:return
+            new_seq = self.realtime.wait_for_update(seq,remaining,self.event_coalesce)
+            if new_seq != seq:
+                seq = new_seq
+                self._on_realtime_update()
+
+    def _on_realtime_update(self):
+        """
+        イベント駆動モードで新しいデータを受信した時に呼ばれる。子クラスでオーバーライドする。
+        """
+        pass
+
+    def _create_executor(self,max_workers):
+        """
+        発注用のスレッドプールを作る。バックテストでは同期実行のものに差し替える。
+        """
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+    async def _async_sleep(self,n):
+        await asyncio.sleep(n)
     
     def _get_now_timestamp(self):
         return datetime.now(self.tz).timestamp()
@@ -56,7 +190,7 @@ if __name__=='__main__':
     current_dir = os.path.dirname(__file__)
     config_file = os.path.join(current_dir,"config.json")
     config = json.load(open(config_file, "r"))
-    logger = setup_logger(setup_logger(os.path.basename(__file__)))
+    logger = setup_logger(os.path.basename(__file__))
     bot = BotBase(config,logger)
     bot.start()
     time.sleep(10)
@@ -0,0 +1,168 @@
+import math
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from threading import Lock
+import numpy as np
+
+class ClockSync():
+    """
+    取引所の時刻と自分の時刻のずれ(offset = 取引所時刻 - 自分の時刻)と、その変化率(drift)を推定する。
+    realtime apiのメッセージのタイムスタンプは取引所の送信時刻なので、offset >= タイムスタンプ - 受信時刻 (下限)が得られる。
+    rest apiのDateヘッダ(秒精度)からは、Date - 受信時刻 < offset < Date + 1 - 送信時刻 が得られる。
+    下限は一定時間ごとの区間で上位quantileを取って外れ値を除き、区間ごとの値に直線を当てはめてdriftを求める。
+    区間の集計は区間が切り替わった時に1度だけ行い、Dateヘッダの上下限は単調なキューで持つ。
+    推定の計算し直しは区間の数だけの計算で済み、受信スレッドで呼んでも期間内のメッセージ数に比例した時間はかからない。
+    推定値は下限にassumed_min_latency(取引所から自分までの最小の片道遅延の想定)を足し、上限を超えないようにしたもの。
+    """
+    def __init__(self,window=600,bucket=10,quantile=0.95,assumed_min_latency=0.0,update_interval=1.0):
+        """
+        :param window:推定に使う期間(秒)
+        :param bucket:下限をまとめる区間の長さ(秒)
+        :param quantile:区間内の下限から取る分位点。1に近いほど最小遅延のメッセージに近づく。
+        :param assumed_min_latency:最小の片道遅延の想定(秒)
+        :param update_interval:推定を計算し直す間隔(秒)
+        """
+        self.window = window
+        self.bucket = bucket
+        self.quantile = quantile
+        self.assumed_min_latency = assumed_min_latency
+        self.update_interval = update_interval
+        # 集計済みの区間 (区間の番号,受信時刻の平均,下限の分位点)
+        self.lower_buckets = deque()
+        # 集計中の区間の番号と(受信時刻,下限)のリスト
+        self._bucket_key = None
+        self._bucket_samples = []
+        # 期間内のDateヘッダの下限の最大値・上限の最小値 (受信時刻,値)。先頭が最大・最小。
+        self.http_lowers = deque()
+        self.http_uppers = deque()
+        self.lock = Lock()
+        self._offset = 0.0
+        self._drift = 0.0
+        self._reference_time = time.time()
+        self._last_update = 0.0
+
+    def add_message(self,exchange_timestamp,received_at):
+        """
+        realtime apiのメッセージを1件追加する。
+        :param exchange_timestamp:メッセージのタイムスタンプ(取引所時刻)
+        :param received_at:受信時刻(自分の時刻、time.time())
+        """
+        key = math.floor(received_at / self.bucket)
+        with self.lock:
+            if self._bucket_key is None or key > self._bucket_key:
+                if len(self._bucket_samples) > 0:
+                    self.lower_buckets.append((self._bucket_key,) + self._summarize(self._bucket_samples))
+                self._bucket_key = key
+                self._bucket_samples = []
+            self._bucket_samples.append((received_at,exchange_timestamp - received_at))
+            while len(self.lower_buckets) > 0 and self.lower_buckets[0][1] < received_at - self.window:
+                self.lower_buckets.popleft()
+
+    def add_http_date(self,date_header,sent_at,received_at):
+        """
+        rest apiのレスポンスのDateヘッダを1件追加する。
+        :param date_header:Dateヘッダの値
+        :param sent_at:リクエスト送信時刻(time.time())
+        :param received_at:レスポンス受信時刻(time.time())
+        """
+        if date_header is None:return
+        try:
+            server_time = parsedate_to_datetime(date_header).timestamp()
+        except Exception:
+            return
+        lower = server_time - received_at
+        upper = server_time + 1 - sent_at
+        with self.lock:
+            while len(self.http_lowers) > 0 and self.http_lowers[-1][1] <= lower:
+                self.http_lowers.pop()
+            self.http_lowers.append((received_at,lower))
+            while len(self.http_uppers) > 0 and self.http_uppers[-1][1] >= upper:
+                self.http_uppers.pop()
+            self.http_uppers.append((received_at,upper))
+            self._trim(self.http_lowers,received_at)
+            self._trim(self.http_uppers,received_at)
+
+    def _trim(self,samples,now):
+        while len(samples) > 0 and samples[0][0] < now - self.window:
+            samples.popleft()
+
+    def _summarize(self,samples):
+        """
+        区間の受信時刻の平均と下限の分位点を返す。
+        """
+        received_at = sum(sample[0] for sample in samples) / len(samples)
+        return received_at,float(np.quantile([sample[1] for sample in samples],self.quantile))
+
+    def _update(self,now):
+        with self.lock:
+            self._trim(self.http_lowers,now)
+            self._trim(self.http_uppers,now)
+            lower = self.http_lowers[0][1] if len(self.http_lowers) > 0 else None
+            upper = self.http_uppers[0][1] if len(self.http_uppers) > 0 else None
+            points = [(received_at,value) for _,received_at,value in self.lower_buckets]
+            current = list(self._bucket_samples)
+        if len(current) > 0:
+            points.append(self._summarize(current))
+        points = [point for point in points if point[0] >= now - self.window]
+        offset = None
+        drift = 0.0
+        if len(points) > 0:
+            if len(points) >= 3:
+                # 区間ごとの値に最小二乗で直線を当てはめ、nowでの値をoffsetとする
+                xs = [received_at - now for received_at,_ in points]
+                ys = [value for _,value in points]
+                x_mean = sum(xs) / len(xs)
+                y_mean = sum(ys) / len(ys)
+                sxx = sum((x - x_mean) ** 2 for x in xs)
+                sxy = sum((x - x_mean) * (y - y_mean) for x,y in zip(xs,ys))
+                drift = sxy / sxx if sxx > 0 else 0.0
+                offset = y_mean - drift * x_mean
+            else:
+                offset = max(value for _,value in points)
+            if lower is not None:
+                offset = max(offset,lower)
+            offset += self.assumed_min_latency
+        elif lower is not None:
+            offset = (lower + upper) / 2 if upper is not None else lower
+        if offset is None:return
+        if upper is not None and lower is not None and lower <= upper:
+            offset = min(offset,upper)
+        self._offset = float(offset)
+        self._drift = float(drift)
+        self._reference_time = now
+        self._last_update = now
+
+    def offset(self,now=None):
+        """
+        推定したoffset(取引所時刻 - 自分の時刻)を返す。
+        """
+        now = time.time() if now is None else now
+        if now - self._last_update >= self.update_interval:
+            self._update(now)
+        return float(self._offset + self._drift * (now - self._reference_time))
+
+    def drift(self):
+        """
+        offsetの変化率(秒/秒)を返す。
+        """
+        return self._drift
+
+    def exchange_now(self):
+        """
+        推定した現在の取引所時刻を返す。
+        """
+        now = time.time()
+        return now + self.offset(now)
+
+    def one_way_latency(self,exchange_timestamp,received_at):
+        """
+        時刻のずれを補正した片道遅延を返す。
+        """
+        return received_at + self.offset(received_at) - exchange_timestamp
+
+    def message_age(self,exchange_timestamp):
+        """
+        時刻のずれを補正した、取引所のタイムスタンプからの経過時間を返す。
+        """
+        return self.exchange_now() - exchange_timestamp
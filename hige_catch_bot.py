@@ -1,13 +1,19 @@
 from bot_base import BotBase
-from setup_logger import setup_logger
+from setup_logger import setup_logger,Lazy
+from latency_metrics import latency_metrics
+from price_log_writer import PriceLogWriter
+from indicators import ema_step,span_to_alpha
 import json
 import os
-import traceback
 from datetime import datetime
 import time
-from concurrent.futures import ThreadPoolExecutor
 
 class HigeCatchBot(BotBase):
+    def __init__(self,config,logger,rest=None,realtime=None):
+        super().__init__(config,logger,rest=rest,realtime=realtime)
+        # configのrequote_by_amendがTrueの場合、インターバルごとの注文入れ替えを注文の変更(edit_order)で行い、インターバル終盤のキャンセルは行わない。
+        self.requote_by_amend = config.get("requote_by_amend",False)
+
     def _logic(self):
         # ロジックパラメータ
         self.interval = 5
@@ -34,9 +40,16 @@ class HigeCatchBot(BotBase):
 
         # 各種カウンター
         self.counter = {"ask_entry":0,"bid_entry":0,"ask_cancel":0,"bid_cancel":0,"trade":0,"win":0,"lose":0}
+        self.requote_counter = {"keep":0,"amend":0,"cancel":0,"new":0}
 
         # 発注用スレッドプール
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        self.executor = self._create_executor(10)
+
+        # 価格ログ。configにprice_logがある場合のみ出力する。
+        price_log_config = self.config.get("price_log")
+        self.price_log_writer = PriceLogWriter(logger=self.logger,**price_log_config) if price_log_config else None
+        if self.price_log_writer is not None:
+            self.price_log_writer.start()
 
         # emaパラメータ
         self.ema_span = 5
@@ -63,39 +76,36 @@ class HigeCatchBot(BotBase):
         self.interval_counter = 0
         self._log("order logic start.")
         while self.stop_flg == False:
-            self._output_price_log()
-            self._sleep(1)
             try:
+                self._output_price_log()
+                # イベント駆動モードではここで_on_realtime_updateが呼ばれるため、例外をロジックと同じく扱う
+                self._wait_tick(1)
                 self.interval_counter += 1
                 if self._get_now_timestamp() - timelog_5m > 60 * 5:
-                    timelog_5m = 0
+                    timelog_5m = self._get_now_timestamp()
                     self._5m_processing()
 
                 if self._get_now_timestamp() - timelog_1h > 60 * 60:
-                    timelog_1h = 0
+                    timelog_1h = self._get_now_timestamp()
                     self._1h_processing()
             
                 if self._get_now_timestamp() - timelog_1d > 60 * 60 * 24:
-                    timelog_1d = 0
+                    timelog_1d = self._get_now_timestamp()
                     self._1d_processing()
                 
-                if self.interval_counter < self.interval:
+                # 約定でポジションが変わった場合は、インターバルを待たずに注文を入れ替える
+                position_changed = abs(self.rest.position_ledger.get_position() - self.position) >= self.zero_position
+                if self.interval_counter < self.interval and not position_changed:
                     ltp = self.realtime.get_ticker()["ltp"]
                     self.ema = self._calc_ema(self.ema,ltp,self.ema_span)
-                    self._monitor_price_cancel_order()
+                    self._monitor_price_cancel_order(check_timeout=not self.requote_by_amend)
                     continue
 
                 # インターバル明け。発注ロジック開始
                 self.interval_counter = 0
 
-                # 前回注文が残っていればキャンセル
-                for order in self.orders:
-                    if order is None:continue
-                    self.rest.cancel_order(order["id"])
-                self.orders = []
-
-                # ポジションと損益を取得
-                self.position,_,closed_pnl=self.rest.get_position_and_open_closed_pnl()
+                # ポジションと損益を取得。約定ごとに更新しているポジション台帳から読む。
+                self.position,_,closed_pnl=self.rest.position_ledger.get_position_and_open_closed_pnl()
                 self.total_pnl += closed_pnl
                 if closed_pnl!=0:
                     if closed_pnl < 0:
@@ -137,7 +147,9 @@ class HigeCatchBot(BotBase):
                     "bid_cancel":int(round(self.ema * (1 - self.beta))),
                     "close":int(round(self.ema)),
                     }
+                self._mark_decision()
 
+                orders = []
                 if abs(self.position) < self.zero_position and self.no_order==False:
                     ask_order = {"id":None,
                                 "price":max(ltp,self.prices["ask"]),
@@ -151,8 +163,8 @@ class HigeCatchBot(BotBase):
                                 "quantity":self.lot,
                                 "side":"bid",
                                 }
-                    self.orders.append(ask_order)
-                    self.orders.append(bid_order)
+                    orders.append(ask_order)
+                    orders.append(bid_order)
                 elif abs(self.position) >= self.zero_position:
                     close_order = {"id":None,
                                 "price":self.prices["close"],
@@ -160,24 +172,32 @@ class HigeCatchBot(BotBase):
                                 "quantity":-self.position,
                                 "side":None,
                                 }
-                    self.orders.append(close_order)
+                    orders.append(close_order)
 
-                for i in range(len(self.orders)):
-                    self.executor.submit(self._create_limit_order_multithread,args=(i,))
+                # 前回注文を今回の注文に入れ替える
+                self._requote(orders)
 
-                # ログ出力
-                log_str = f"pos={round(self.position,4)}:total_pnl={round(self.total_pnl,6)}"
-                log_str += f":ltp={ltp}"
-                log_str += f":order_price={sorted([x['price'] for x in self.orders])}"
-                log_str += f":counter={self.counter}"
-                log_str += f":latency={round(latency,3)}"
-                log_str += f":no_order={self.no_order}"
-                self._log(log_str)
+                # ログ出力。文字列の組み立てはロガー側で行う。
+                self._log(
+                    "pos=%.4f:total_pnl=%.6f:reconcile_pnl=%.6f:ltp=%s:order_price=%s:counter=%s:requote=%s:latency=%.3f:no_order=%s",
+                    self.position,
+                    self.total_pnl,
+                    self.rest.position_ledger.get_reconcile_pnl(),
+                    ltp,
+                    Lazy(sorted,[x['price'] for x in self.orders]),
+                    dict(self.counter),
+                    dict(self.requote_counter),
+                    latency,
+                    self.no_order,
+                    )
 
             except Exception as e:
-                self._log(f"error occered in _logic. message={e}.traceback={traceback.format_exc()}")
+                self._log_error("error occered in _logic. message=%s",e,exc_info=True)
                 self.stop_flg = False
 
+        if self.price_log_writer is not None:
+            self.price_log_writer.stop()
+
     def _5m_processing(self):
         """
         5分ごとに行う処理
@@ -200,51 +220,70 @@ class HigeCatchBot(BotBase):
         pass
 
     def _calc_ema(self,ema,ltp,ema_span):
-        return (ema * (ema_span - 1) + ltp * 2) / (ema_span + 1)
+        """
+        indicators.Emaと同じ式でemaを1件更新する。alpha=2/(ema_span+1)。
+        """
+        return ema_step(ema,ltp,span_to_alpha(ema_span))
 
-    def _monitor_price_cancel_order(self):
+    def _on_realtime_update(self):
+        """
+        イベント駆動モードで、1秒の区切りを待たずに最新の約定価格でキャンセル判定を行う。
+        emaは確定させず、最新の約定価格を反映した暫定値で判定する。
+        """
+        if len(self.orders) == 0:return
+        ltp = self.realtime.get_ticker()["ltp"]
+        self._monitor_price_cancel_order(ema=self._calc_ema(self.ema,ltp,self.ema_span),check_timeout=False)
+
+    def _monitor_price_cancel_order(self,ema=None,check_timeout=True):
+        """
+        emaがキャンセル価格を超えた注文をキャンセルする。
+        発注中(idがNone)の注文はキャンセルの印を付け、発注が完了した時にキャンセルする。
+        :param ema:判定に使うema。Noneの場合はself.ema。
+        :param check_timeout:Trueの場合、インターバル終盤に残っている注文もキャンセルする。
+        """
+        ema = self.ema if ema is None else ema
         for i in range(len(self.orders)):
-            if self.orders[i] is None:continue
-            if self.orders[i]["side"] is None:continue
-            if self.orders[i]["side"] == "ask":
-                if self.orders[i]["cancel_price"] < self.ema:
-                    self.rest.cancel_order(self.orders[i]["id"])
-                    self.orders[i] = None
-                    self.counter["ask_cancel"] += 1
-            elif self.orders[i]["side"] == "bid":
-                if self.orders[i]["cancel_price"] > self.ema:
-                    self.rest.cancel_order(self.orders[i]["id"])
-                    self.orders[i] = None
-                    self.counter["bid_cancel"] += 1
-        if self.interval_counter > 3:
+            order = self.orders[i]
+            if order is None:continue
+            if order["side"] is None:continue
+            if order["side"] == "ask":
+                if not order["cancel_price"] < ema:continue
+            elif order["side"] == "bid":
+                if not order["cancel_price"] > ema:continue
+            if order["id"] is None:
+                order["cancel_requested"] = True
+                continue
+            self.rest.cancel_order(order["id"])
+            self.orders[i] = None
+            self.counter[f"{order['side']}_cancel"] += 1
+        if check_timeout and self.interval_counter > 3:
             for i in range(len(self.orders)):
                 if self.orders[i] is None:continue
                 if self.orders[i]["side"] is None:continue
+                if self.orders[i]["id"] is None:continue
                 self.rest.cancel_order(self.orders[i]["id"])
     
     def _output_price_log(self):
         """
         現在価格、ema、注文価格、キャンセル価格をファイル出力する。
+        バッファに1行追加するだけで、書き出しはPriceLogWriterのスレッドで行う。
         """
+        if self.price_log_writer is None:return
         if self.prices["ask"] == 0:return
 
         ltp = self.realtime.get_ticker()["ltp"]
-        data = {
-            "timestamp":self._get_now_timestamp(),
-            "position":self.position,
-            "pnl":self.total_pnl,
-            "trade_count":self.counter["trade"],
-            "ltp":ltp,
-            "ema":self.ema,
-            "ask":self.prices["ask"],
-            "bid":self.prices["bid"],
-            "ask_cancel":self.prices["ask_cancel"],
-            "bid_cancel":self.prices["bid_cancel"],
-        }
-        """
-        with open("","") as f:
-            f.wirte()
-        """
+        self.price_log_writer.append((
+            self._get_now_timestamp(),
+            self.position,
+            self.total_pnl,
+            self.counter["trade"],
+            ltp,
+            self.ema,
+            self.prices["ask"],
+            self.prices["bid"],
+            self.prices["ask_cancel"],
+            self.prices["bid_cancel"],
+            ))
 
     def _get_result(self):
         """
@@ -257,21 +296,87 @@ class HigeCatchBot(BotBase):
         pf,wr,hs=None,None,None
         pf = round(self.total_profit / abs(self.total_loss),3) if self.total_loss != 0 else None
         wr = round(self.counter["win"] / self.counter["trade"] ,3) if self.counter["trade"] else None
-        hs = round(sum(self.hold_seconds)/self.counter["trade"],3) if self.counter["trade"] else None
+        hs = round(self.hold_seconds/self.counter["trade"],3) if self.counter["trade"] else None
         return {"pnl":round(self.total_pnl,2),"pf":pf,"wr":wr,"tc":self.counter["trade"],"hs":hs}
 
+    def _requote(self,orders):
+        """
+        前回の注文(self.orders)を今回の注文(orders)に入れ替える。
+        売買方向が同じ注文同士を対応させ、価格・数量が同じなら何もせず、違えば注文を変更する。
+        対応する注文が無いものは新規発注し、残った前回の注文はキャンセルする。
+        requote_by_amendがFalseの場合は前回の注文を全てキャンセルして新規発注する。
+        :param orders:今回の注文のリスト。idはNone。
+        """
+        live_orders = [order for order in self.orders if order is not None and order["id"] is not None]
+        if not self.requote_by_amend:
+            for order in live_orders:
+                self.rest.cancel_order(order["id"])
+                self.requote_counter["cancel"] += 1
+            live_orders = []
+        actions = []
+        for i,order in enumerate(orders):
+            match = None
+            for live_order in live_orders:
+                if (live_order["quantity"] > 0) == (order["quantity"] > 0):
+                    match = live_order
+                    break
+            if match is None:
+                actions.append((self._create_limit_order_multithread,i))
+                self.requote_counter["new"] += 1
+                continue
+            live_orders.remove(match)
+            order["id"] = match["id"]
+            if match["price"] == order["price"] and abs(match["quantity"] - order["quantity"]) < 1e-12:
+                self.requote_counter["keep"] += 1
+                continue
+            # 変更に失敗した場合に戻す、板に載っている価格・数量
+            order["amend_from"] = (match["price"],match["quantity"])
+            actions.append((self._edit_limit_order_multithread,i))
+            self.requote_counter["amend"] += 1
+        for order in live_orders:
+            self.rest.cancel_order(order["id"])
+            self.requote_counter["cancel"] += 1
+        self.orders = orders
+        for fn,i in actions:
+            self.executor.submit(fn,args=(i,))
+
+    def _edit_limit_order_multithread(self,args):
+        """
+        注文を変更する。約定済み・キャンセル済みで変更できなかった場合は新規発注する。
+        注文が板に残ったまま失敗した場合は、二重に発注しないよう元の価格・数量に戻し、次のインターバルで再度変更する。
+        """
+        i = args[0]
+        try:
+            order = self.rest.edit_order(self.orders[i]["id"],self.orders[i]["quantity"],self.orders[i]["price"])
+        except Exception as e:
+            self._log_error("edit_order failed. keep the order. id=%s message=%s",self.orders[i]["id"],e)
+            self.orders[i]["price"],self.orders[i]["quantity"] = self.orders[i]["amend_from"]
+            return
+        if order is None:
+            self._create_limit_order_multithread(args)
+            return
+        latency_metrics.record_since("bot_order_ack",self.decision_perf)
+
     def _create_limit_order_multithread(self,args):
+        """
+        新規発注する。発注中にキャンセル価格を超えていた場合は、発注の完了後にキャンセルする。
+        """
         i = args[0]
-        price = self.orders[i]["price"]
-        quantity = self.orders[i]["quantity"]
-        order = self.rest.limit_order(quantity,price)
-        self.orders[i]["id"] = order["id"]
+        my_order = self.orders[i]
+        order = self.rest.limit_order(my_order["quantity"],my_order["price"])
+        latency_metrics.record_since("bot_order_ack",self.decision_perf)
+        my_order["id"] = order["id"]
+        if my_order.get("cancel_requested"):
+            self.rest.cancel_order(order["id"])
+            if i < len(self.orders) and self.orders[i] is my_order:
+                self.orders[i] = None
+            self.counter[f"{my_order['side']}_cancel"] += 1
     
 if __name__=='__main__':
     current_dir = os.path.dirname(__file__)
     config_file = os.path.join(current_dir,"config.json")
     config = json.load(open(config_file, "r"))
-    logger = setup_logger(setup_logger(os.path.basename(__file__)))
+    logger = setup_logger(os.path.basename(__file__),queue_mode=True,error_interval=60)
     bot = HigeCatchBot(config,logger)
     bot.start()
     while bot.stop_flg==False:
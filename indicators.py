@@ -0,0 +1,322 @@
+"""
+約定・価格から計算する指標。
+各指標は1件ごとにO(1)で更新するクラスと、過去データの配列から一括で計算する関数の組で持つ。
+両者は同じ順序・同じ式で浮動小数点演算を行い、同じ入力に対してビット単位で同じ値を返す。
+ライブで計算した値と、検証で過去データから計算した値が常に一致する。
+・窓の合計は累積和の差で求める。np.cumsumは先頭から順に足すため、1件ずつ足した累積和と一致する。
+・emaのような再帰式はベクトル化すると演算順が変わるため、一括計算でも同じ式を先頭から順に適用する。
+窓の長さは全て件数で指定する。一定間隔の系列にしたい場合はmispricing_analyzer.to_price_seriesなどで先に変換する。
+"""
+import math
+from collections import deque
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+def span_to_alpha(span):
+    """
+    期間spanのemaの平滑化係数。2/(span+1)。
+    """
+    return 2 / (span + 1)
+
+def halflife_to_alpha(halflife):
+    """
+    半減期halflife(件数)のemaの平滑化係数。
+    """
+    return 1 - 0.5 ** (1 / halflife)
+
+def ema_step(ema,value,alpha):
+    """
+    emaを1件更新する。ライブと一括計算で共通の式。
+    """
+    return ema + alpha * (value - ema)
+
+def _alpha(span,halflife):
+    if (span is None) == (halflife is None):
+        raise ValueError("specify either span or halflife.")
+    return span_to_alpha(span) if span is not None else halflife_to_alpha(halflife)
+
+def _is_buy(taker_side):
+    return taker_side == "buy" or taker_side == 1
+
+def _buy_mask(taker_sides):
+    taker_sides = np.asarray(taker_sides)
+    if taker_sides.dtype.kind in "USO":
+        return (taker_sides == "buy") | (taker_sides == 1)
+    return taker_sides == 1
+
+class _WindowSum():
+    """
+    直近n件の合計。全件の累積和を持ち、窓の外に出た時点の累積和を引く。
+    """
+    def __init__(self,n):
+        self.total = 0.0
+        self.prefix = deque([0.0],maxlen=n + 1)
+
+    def update(self,value):
+        self.total += value
+        self.prefix.append(self.total)
+        return self.total - self.prefix[0]
+
+def _window_sums(values,n):
+    """
+    _WindowSumを先頭から順に適用した結果と同じ値を返す。
+    """
+    prefix = np.concatenate(([0.0],np.cumsum(values,dtype=np.float64)))
+    index = np.arange(1,len(prefix))
+    return prefix[1:] - prefix[np.maximum(0,index - n)]
+
+def _window_counts(length,n):
+    return np.minimum(np.arange(1,length + 1),n).astype(np.float64)
+
+class Ema():
+    """
+    指数移動平均。最初の値で初期化する。
+    """
+    def __init__(self,span=None,halflife=None):
+        """
+        :param span:期間。alpha=2/(span+1)
+        :param halflife:半減期(件数)。spanとどちらか一方を指定する。
+        """
+        self.alpha = _alpha(span,halflife)
+        self.value = None
+
+    def update(self,value):
+        self.value = value if self.value is None else ema_step(self.value,value,self.alpha)
+        return self.value
+
+def ema(values,span=None,halflife=None):
+    """
+    Emaを先頭から順に適用した値の配列を返す。
+    """
+    alpha = _alpha(span,halflife)
+    values = np.asarray(values,dtype=np.float64).tolist()
+    out = np.empty(len(values),dtype=np.float64)
+    if len(values) == 0:return out
+    value = values[0]
+    out[0] = value
+    for i in range(1,len(values)):
+        value = ema_step(value,values[i],alpha)
+        out[i] = value
+    return out
+
+class RollingVariance():
+    """
+    直近n件の分散。最初の値を基準にした差で合計を持ち、桁落ちを抑える。
+    価格のように基準から大きく離れていく系列を長時間入れる場合は、リターンを入れること。
+    """
+    def __init__(self,n,ddof=0):
+        """
+        :param n:窓の件数
+        :param ddof:自由度の補正。標本分散なら1。
+        """
+        self.n = n
+        self.ddof = ddof
+        self.base = None
+        self.sum = _WindowSum(n)
+        self.square_sum = _WindowSum(n)
+        self.count = 0
+        self.value = 0.0
+
+    def update(self,value):
+        if self.base is None:
+            self.base = value
+        deviation = value - self.base
+        s1 = self.sum.update(deviation)
+        s2 = self.square_sum.update(deviation * deviation)
+        self.count = min(self.count + 1,self.n)
+        m = float(self.count)
+        if m - self.ddof <= 0:
+            self.value = 0.0
+        else:
+            self.value = max(0.0,(s2 - s1 * s1 / m) / (m - self.ddof))
+        return self.value
+
+def rolling_variance(values,n,ddof=0):
+    """
+    RollingVarianceを先頭から順に適用した値の配列を返す。
+    """
+    values = np.asarray(values,dtype=np.float64)
+    if len(values) == 0:return np.empty(0,dtype=np.float64)
+    deviation = values - values[0]
+    s1 = _window_sums(deviation,n)
+    s2 = _window_sums(deviation * deviation,n)
+    m = _window_counts(len(values),n)
+    denominator = m - ddof
+    out = np.zeros(len(values),dtype=np.float64)
+    valid = denominator > 0
+    out[valid] = np.maximum(0.0,(s2[valid] - s1[valid] * s1[valid] / m[valid]) / denominator[valid])
+    return out
+
+class RealizedVolatility():
+    """
+    直近n件のリターン(price/前回price-1)の二乗和の平方根。最初の1件は0。
+    """
+    def __init__(self,n):
+        self.square_sum = _WindowSum(n)
+        self.last_price = None
+        self.value = 0.0
+
+    def update(self,price):
+        if self.last_price is not None:
+            r = price / self.last_price - 1
+            self.value = math.sqrt(max(0.0,self.square_sum.update(r * r)))
+        self.last_price = price
+        return self.value
+
+def realized_volatility(prices,n):
+    """
+    RealizedVolatilityを先頭から順に適用した値の配列を返す。
+    """
+    prices = np.asarray(prices,dtype=np.float64)
+    out = np.zeros(len(prices),dtype=np.float64)
+    if len(prices) < 2:return out
+    r = prices[1:] / prices[:-1] - 1
+    out[1:] = np.sqrt(np.maximum(0.0,_window_sums(r * r,n)))
+    return out
+
+class Vwap():
+    """
+    直近n件の約定の出来高加重平均価格。nがNoneの場合は最初からの累計。
+    """
+    def __init__(self,n=None):
+        self.n = n
+        self.amount = _WindowSum(n) if n is not None else None
+        self.volume = _WindowSum(n) if n is not None else None
+        self.total_amount = 0.0
+        self.total_volume = 0.0
+        self.value = None
+
+    def update(self,price,quantity):
+        if self.n is None:
+            self.total_amount += price * quantity
+            self.total_volume += quantity
+            amount,volume = self.total_amount,self.total_volume
+        else:
+            amount = self.amount.update(price * quantity)
+            volume = self.volume.update(quantity)
+        if volume > 0:
+            self.value = amount / volume
+        return self.value
+
+def vwap(prices,quantities,n=None):
+    """
+    Vwapを先頭から順に適用した値の配列を返す。
+    窓の出来高が0の箇所はnan。Vwap.updateはこの場合直前の値のままになる。
+    """
+    prices = np.asarray(prices,dtype=np.float64)
+    quantities = np.asarray(quantities,dtype=np.float64)
+    if n is None:
+        amount = np.cumsum(prices * quantities)
+        volume = np.cumsum(quantities)
+    else:
+        amount = _window_sums(prices * quantities,n)
+        volume = _window_sums(quantities,n)
+    out = np.full(len(prices),np.nan)
+    np.divide(amount,volume,out=out,where=volume > 0)
+    return out
+
+class OrderFlowImbalance():
+    """
+    直近n件の約定のテイカー買い・売りの出来高の偏り。(買い-売り)/(買い+売り)で-1から1。
+    """
+    def __init__(self,n):
+        self.buy = _WindowSum(n)
+        self.sell = _WindowSum(n)
+        self.value = 0.0
+
+    def update(self,quantity,taker_side):
+        """
+        :param taker_side:buy/sellか1/-1
+        """
+        buy_quantity = quantity if _is_buy(taker_side) else 0.0
+        buy = self.buy.update(buy_quantity)
+        sell = self.sell.update(quantity - buy_quantity)
+        total = buy + sell
+        self.value = (buy - sell) / total if total > 0 else 0.0
+        return self.value
+
+def order_flow_imbalance(quantities,taker_sides,n):
+    """
+    OrderFlowImbalanceを先頭から順に適用した値の配列を返す。
+    """
+    quantities = np.asarray(quantities,dtype=np.float64)
+    buy_quantities = np.where(_buy_mask(taker_sides),quantities,0.0)
+    buy = _window_sums(buy_quantities,n)
+    sell = _window_sums(quantities - buy_quantities,n)
+    total = buy + sell
+    out = np.zeros(len(quantities),dtype=np.float64)
+    np.divide(buy - sell,total,out=out,where=total > 0)
+    return out
+
+class RollingHighLow():
+    """
+    直近n件の最大値・最小値。単調なキューで持ち、更新は償却O(1)。
+    """
+    def __init__(self,n):
+        self.n = n
+        self.count = 0
+        self.highs = deque()
+        self.lows = deque()
+        self.high = None
+        self.low = None
+
+    def update(self,value):
+        """
+        :return: 最大値、最小値
+        """
+        index = self.count
+        self.count += 1
+        while self.highs and self.highs[-1][1] <= value:
+            self.highs.pop()
+        self.highs.append((index,value))
+        while self.lows and self.lows[-1][1] >= value:
+            self.lows.pop()
+        self.lows.append((index,value))
+        if self.highs[0][0] <= index - self.n:
+            self.highs.popleft()
+        if self.lows[0][0] <= index - self.n:
+            self.lows.popleft()
+        self.high = self.highs[0][1]
+        self.low = self.lows[0][1]
+        return self.high,self.low
+
+def rolling_high_low(values,n):
+    """
+    RollingHighLowを先頭から順に適用した値の配列を返す。
+    :return: 最大値の配列、最小値の配列
+    """
+    values = np.asarray(values,dtype=np.float64)
+    high = np.empty(len(values),dtype=np.float64)
+    low = np.empty(len(values),dtype=np.float64)
+    head = min(n - 1,len(values))
+    high[:head] = np.maximum.accumulate(values[:head])
+    low[:head] = np.minimum.accumulate(values[:head])
+    if len(values) >= n:
+        windows = sliding_window_view(values,n)
+        high[n - 1:] = windows.max(axis=1)
+        low[n - 1:] = windows.min(axis=1)
+    return high,low
+
+
+if __name__=='__main__':
+    # ライブ用のクラスと一括計算の関数の結果がビット単位で一致することを確認する
+    rng = np.random.default_rng(0)
+    size = 100000
+    prices = 5e6 + np.cumsum(rng.normal(0,300,size))
+    quantities = rng.exponential(0.01,size)
+    taker_sides = rng.choice(["buy","sell"],size)
+    cases = [
+        ("ema",lambda:Ema(span=20),lambda p,q,s,o:o.update(p),lambda:ema(prices,span=20)),
+        ("ema_halflife",lambda:Ema(halflife=10),lambda p,q,s,o:o.update(p),lambda:ema(prices,halflife=10)),
+        ("rolling_variance",lambda:RollingVariance(60,1),lambda p,q,s,o:o.update(p),lambda:rolling_variance(prices,60,1)),
+        ("realized_volatility",lambda:RealizedVolatility(60),lambda p,q,s,o:o.update(p),lambda:realized_volatility(prices,60)),
+        ("vwap",lambda:Vwap(100),lambda p,q,s,o:o.update(p,q),lambda:vwap(prices,quantities,100)),
+        ("vwap_cumulative",lambda:Vwap(),lambda p,q,s,o:o.update(p,q),lambda:vwap(prices,quantities)),
+        ("order_flow_imbalance",lambda:OrderFlowImbalance(100),lambda p,q,s,o:o.update(q,s),lambda:order_flow_imbalance(quantities,taker_sides,100)),
+        ("rolling_high",lambda:RollingHighLow(60),lambda p,q,s,o:o.update(p)[0],lambda:rolling_high_low(prices,60)[0]),
+        ("rolling_low",lambda:RollingHighLow(60),lambda p,q,s,o:o.update(p)[1],lambda:rolling_high_low(prices,60)[1]),
+        ]
+    for name,create,update,batch in cases:
+        indicator = create()
+        live = np.array([update(p,q,s,indicator) for p,q,s in zip(prices.tolist(),quantities.tolist(),taker_sides.tolist())])
+        print(name,"identical" if np.array_equal(live,batch()) else "MISMATCH")
@@ -0,0 +1,194 @@
+import json
+import math
+import time
+from threading import Thread,Event,Lock
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+
+class StreamingHistogram():
+    """
+    レイテンシ(秒)の分布を対数目盛りのバケットで数える。記録はO(1)で、メモリは一定。
+    値をfrexpで仮数と指数に分け、指数ごとに仮数をsub_buckets個に分割する。相対誤差は1/sub_buckets程度。
+    """
+    def __init__(self,sub_buckets=64,min_exponent=-30,max_exponent=10):
+        """
+        :param sub_buckets:指数1つあたりのバケット数
+        :param min_exponent:記録する最小の指数(2**min_exponent秒)。これより小さい値は最小バケットに入る。
+        :param max_exponent:記録する最大の指数(2**max_exponent秒)。これより大きい値は最大バケットに入る。
+        """
+        self.sub_buckets = sub_buckets
+        self.min_exponent = min_exponent
+        self.max_exponent = max_exponent
+        self.counts = [0] * ((max_exponent - min_exponent) * sub_buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # 複数のスレッドから記録するため、カウントの更新と集計はロック内で行う
+        self.lock = Lock()
+
+    def _index(self,value):
+        if value <= 0:return 0
+        mantissa,exponent = math.frexp(value)
+        if exponent <= self.min_exponent:return 0
+        if exponent > self.max_exponent:return len(self.counts) - 1
+        return (exponent - self.min_exponent - 1) * self.sub_buckets + int((mantissa - 0.5) * 2 * self.sub_buckets)
+
+    def _value(self,index):
+        # バケットの上端の値を返す
+        exponent = index // self.sub_buckets + self.min_exponent + 1
+        mantissa = 0.5 + (index % self.sub_buckets + 1) / (2 * self.sub_buckets)
+        return math.ldexp(mantissa,exponent)
+
+    def record(self,value):
+        index = self._index(value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self,q):
+        """
+        :param q:0から100
+        """
+        if self.count == 0:return None
+        target = self.count * q / 100
+        cumulative = 0
+        for index,count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count > 0:
+                return min(self._value(index),self.max)
+        return self.max
+
+    def summary(self):
+        with self.lock:
+            if self.count == 0:
+                return {"count":0}
+            return {
+                "count":self.count,
+                "mean":self.total / self.count,
+                "p50":self.percentile(50),
+                "p99":self.percentile(99),
+                "p99.9":self.percentile(99.9),
+                "max":self.max,
+                }
+
+class LatencyMetrics():
+    """
+    ホットパスの各段階のレイテンシをステージ名ごとのStreamingHistogramに記録する。
+    無効の場合、recordは即座に戻る。定期的にログへ出力し、オプションでローカルのhttpでjsonを返す。
+    ステージ名の例:
+    rt_decode:メッセージ受信からデコード完了まで
+    rt_message_age:取引所のタイムスタンプから受信まで
+    bot_decision:メッセージ受信から発注判断まで
+    rest_sign:JWT署名
+    rest_http:リクエスト送信からレスポンス受信まで
+    bot_order_ack:発注判断から取引所の応答まで
+    """
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {}
+        self.lock = Lock()
+        self.exporter_thread = None
+        self.http_server = None
+        self._stop_event = Event()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def record(self,stage,seconds):
+        """
+        :param stage:ステージ名
+        :param seconds:経過時間(秒)
+        """
+        if not self.enabled:return
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage,StreamingHistogram())
+        histogram.record(seconds)
+
+    def record_since(self,stage,start):
+        """
+        time.perf_counter()で取ったstartからの経過時間を記録する。
+        """
+        if not self.enabled or start is None:return
+        self.record(stage,time.perf_counter() - start)
+
+    def snapshot(self,reset=False):
+        """
+        ステージごとのcount,mean,p50,p99,p99.9,maxを返す。
+        :param reset:Trueの場合、取得後にヒストグラムを空にする。
+        """
+        with self.lock:
+            histograms = self.histograms
+            if reset:
+                self.histograms = {}
+        return {stage:histogram.summary() for stage,histogram in histograms.items()}
+
+    def measure_overhead(self,n=100000):
+        """
+        record 1回あたりのコスト(秒)を有効時・無効時それぞれ計測する。
+        """
+        enabled = self.enabled
+        histograms = self.histograms
+        self.histograms = {}
+        result = {}
+        for state in [True,False]:
+            self.enabled = state
+            start = time.perf_counter()
+            for _ in range(n):
+                self.record_since("overhead",start)
+            result["enabled" if state else "disabled"] = (time.perf_counter() - start) / n
+        self.enabled = enabled
+        self.histograms = histograms
+        return result
+
+    def start_exporter(self,logger,interval=60,http_port=None):
+        """
+        interval秒ごとにログへ出力する。http_portを指定した場合は127.0.0.1で最新の集計をjsonで返す。
+        """
+        self._stop_event.clear()
+        self.exporter_thread = Thread(target=self._export_loop,args=(logger,interval))
+        self.exporter_thread.daemon = True
+        self.exporter_thread.start()
+        if http_port is not None:
+            metrics = self
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = json.dumps(metrics.snapshot()).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type","application/json")
+                    self.send_header("Content-Length",str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self,format,*args):
+                    pass
+            self.http_server = ThreadingHTTPServer(("127.0.0.1",http_port),Handler)
+            http_thread = Thread(target=self.http_server.serve_forever)
+            http_thread.daemon = True
+            http_thread.start()
+
+    def stop_exporter(self):
+        self._stop_event.set()
+        if self.exporter_thread is not None:
+            self.exporter_thread.join()
+            self.exporter_thread = None
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server = None
+
+    def _export_loop(self,logger,interval):
+        while not self._stop_event.wait(interval):
+            for stage,summary in sorted(self.snapshot().items()):
+                if summary["count"] == 0:continue
+                logger.info(f"[LatencyMetrics]{stage}:count={summary['count']}"
+                    f":p50={summary['p50']*1e3:.3f}ms:p99={summary['p99']*1e3:.3f}ms"
+                    f":p99.9={summary['p99.9']*1e3:.3f}ms:max={summary['max']*1e3:.3f}ms")
+
+# プロセス内で共有する計測インスタンス
+latency_metrics = LatencyMetrics()
@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import asyncio
+import traceback
+from datetime import datetime,timedelta,timezone
+import aiohttp
+import jwt
+
+class LiquidAsyncRestApi():
+    """
+    LiquidのRestApiをasyncioで扱う。LiquidRestApiの発注系メソッドの非同期版。
+    1つのイベントループから複数の発注・キャンセルを同時に送ることができる。
+    apiキーごとにaiohttpのセッションとロックを持つ。セッションとロックは最初の呼び出し時にイベントループ上で作る。
+    同一キーのリクエストはロックで1つずつ送り、nonceはキーごとに単調増加させる。同時に送れるのはキーの数まで。
+    同期版(LiquidRestApi)とnonceが衝突しないよう、configのliquid_async_api_keysに同期版とは別のキーを設定すること。
+    """
+    base_url = 'https://api.liquid.com'
+
+    def __init__(self,config,logger):
+        """
+        :param config:コンフィグインスタンス。apiキーを保持。
+        :param logger:ロガーインスタンス。
+        """
+        self.config = config
+        self.logger = logger
+        self.symbol = self.config.get("symbol",'BTC/JPY')
+        self.product_id = self.config.get("product_id",5)
+        self.try_num = 3
+        self.tz = timezone(timedelta(hours=+9), 'Asia/Tokyo')
+
+        if not self.config.get("liquid_async_api_keys"):
+            raise ValueError("liquid_async_api_keys is required. use keys different from liquid_api_keys.")
+        self.liquid_api_key = []
+        for key01,key02 in self.config["liquid_async_api_keys"]:
+            self.liquid_api_key.append([key01,key02])
+        self._api_key_index = 0
+        # キーごとに最後に使ったnonce
+        self._last_nonce = [0] * len(self.liquid_api_key)
+        self.key_locks = None
+
+        pool_config = self.config.get("liquid_session_pool",{})
+        self.pool_size = pool_config.get("pool_size",4)
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=pool_config.get("connect_timeout",3.05),
+            sock_read=pool_config.get("read_timeout",10),
+            )
+        self.sessions = None
+        self.public_session = None
+
+    def _log_error(self,message):
+        self.logger.error(f"[LiquidAsyncRestApi]{message}")
+
+    def _log_info(self,message):
+        self.logger.info(f"[LiquidAsyncRestApi]{message}")
+
+    def _create_session(self):
+        connector = aiohttp.TCPConnector(limit_per_host=self.pool_size)
+        return aiohttp.ClientSession(connector=connector,timeout=self.timeout)
+
+    def _get_session(self,key_index=None):
+        """
+        apiキーに対応するセッションを返す。初回呼び出し時に実行中のイベントループ上でセッションを作る。
+        """
+        if self.sessions is None:
+            self.sessions = [self._create_session() for _ in self.liquid_api_key]
+            self.public_session = self._create_session()
+            self.key_locks = [asyncio.Lock() for _ in self.liquid_api_key]
+        if key_index is None:
+            return self.public_session
+        return self.sessions[key_index]
+
+    async def close(self):
+        """
+        全セッションを閉じる。イベントループ終了前に呼ぶ。
+        """
+        if self.sessions is None:return
+        for session in self.sessions + [self.public_session]:
+            await session.close()
+        self.sessions = None
+        self.public_session = None
+        self.key_locks = None
+
+    def _next_api_key_index(self):
+        """
+        次に使用するapiキーのインデックスを返す。使用中でないキーを優先し、全て使用中の場合は順番に割り当てる。
+        """
+        key_num = len(self.liquid_api_key)
+        for i in range(1,key_num + 1):
+            key_index = (self._api_key_index + i) % key_num
+            if not self.key_locks[key_index].locked():
+                self._api_key_index = key_index
+                return key_index
+        self._api_key_index = (self._api_key_index + 1) % key_num
+        return self._api_key_index
+
+    def _create_request_param(self,path,query,key_index):
+        url = self.base_url + path + query
+        token,secret = self.liquid_api_key[key_index]
+        timestamp = max(datetime.now(self.tz).timestamp(),self._last_nonce[key_index] + 1e-6)
+        self._last_nonce[key_index] = timestamp
+        payload = {
+            "path": path,
+            "nonce": timestamp,
+            "token_id": token
+        }
+        signature = jwt.encode(payload, secret, algorithm='HS256')
+        headers = {
+            'X-Quoine-API-Version': '2',
+            'X-Quoine-Auth': signature,
+            'Content-Type' : 'application/json'
+        }
+        return headers,url
+
+    async def _private_request(self,method,path,query='',data=None):
+        """
+        private apiを呼び出す。apiキーに対応するセッションを使う。
+        署名から応答までキーのロックを持ち、同じキーのリクエストがnonceの順に届くようにする。
+        :return: レスポンスのjson
+        """
+        # 初回はここでセッションとロックを作る
+        self._get_session()
+        key_index = self._next_api_key_index()
+        async with self.key_locks[key_index]:
+            headers,url = self._create_request_param(path,query,key_index)
+            async with self.sessions[key_index].request(method,url,headers=headers,data=data) as res:
+                return await res.json(content_type=None)
+
+    def _to_my_order_format(self,order):
+        return {
+                "id": order["id"],
+                "timestamp": order["created_at"],
+                "symbol": order["currency_pair_code"],
+                "status": order["status"],
+                "side": order["side"],
+                "price": float(order["price"]),
+                "quantity": abs(float(order["quantity"])) if order["side"]=="buy" else -abs(float(order["quantity"])),
+                "order_type": order["order_type"],
+                "remaining": float(order["filled_quantity"]),
+            }
+
+    def _create_order_data(self,order_type,quantity,price=None):
+        side = "buy" if quantity > 0 else "sell"
+        data = {
+            "order":{
+            "order_type":order_type,
+            "margin_type":"cross",
+            "product_id":self.product_id,
+            "side":side,
+            "quantity":abs(quantity),
+            "leverage_level":2,
+            "funding_currency":'JPY',
+            "order_direction":'netout',
+            }
+        }
+        if price is not None:
+            data["order"]["price"] = price
+        return json.dumps(data)
+
+    async def _post_order(self,json_data):
+        for _ in range(self.try_num):
+            try:
+                res = await self._private_request("POST",'/orders/',data=json_data)
+                return self._to_my_order_format(res)
+            except Exception as e:
+                self._log_error(f"error in {sys._getframe().f_code.co_name}.{e}")
+                self._log_error(traceback.format_exc())
+                await asyncio.sleep(1)
+        raise Exception("over try_num.")
+
+    async def market_order(self,quantity):
+        return await self._post_order(self._create_order_data("market",quantity))
+
+    # 指値注文する関数
+    async def limit_order(self,quantity,price):
+        return await self._post_order(self._create_order_data("limit",quantity,price))
+
+    async def get_orders(self,status=None):
+        """
+        statusはliveかfilled
+        """
+        for _ in range(self.try_num):
+            try:
+                res = await self._private_request("GET",'/orders/',f"?product_id={self.product_id}")
+                orders = [order for order in map(self._to_my_order_format,res["models"])]
+                if status is None:
+                    return orders
+                return [order for order in orders if order["status"]==status]
+            except Exception as e:
+                self._log_error(f"error in {sys._getframe().f_code.co_name}.{e}")
+                self._log_error(traceback.format_exc())
+                await asyncio.sleep(1)
+        raise Exception("over try_num.")
+
+    # 注文をキャンセルする。
+    async def cancel_order(self,order_id):
+        try:
+            res = await self._private_request("PUT",f'/orders/{order_id}/cancel')
+            return self._to_my_order_format(res)
+        except Exception as e:
+            # 約定済みのケース
+            return None
+
+    async def cancel_orders(self,order_ids):
+        """
+        複数の注文を同時にキャンセルする。同時に送るのはキーの数までで、残りは空いたキーから順に送る。
+        :return: order_idの順に、キャンセル後の注文またはNone(約定済みなど)のリスト
+        """
+        return await asyncio.gather(*[self.cancel_order(order_id) for order_id in order_ids])
+
+    async def cancel_all_orders(self):
+        """
+        対象プロダクトのliveな注文を全て同時にキャンセルする。
+        """
+        orders = await self.get_orders(status="live")
+        await self.cancel_orders([order["id"] for order in orders])
+
+    async def get_trades(self):
+        for _ in range(self.try_num):
+            try:
+                res = await self._private_request("GET",'/trades/')
+                return [trade for trade in res["models"] if trade["product_id"] == self.product_id]
+            except Exception as e:
+                self._log_error(f"error in {sys._getframe().f_code.co_name}.{e}")
+                self._log_error(traceback.format_exc())
+                await asyncio.sleep(1)
+        raise Exception("over try_num.")
+
+
+if __name__=='__main__':
+    import logging
+    current_dir=os.path.dirname(__file__)
+    config = os.path.join(current_dir,"config.json")
+    config = json.loads(open(config,"r").read())
+
+    logger = logging.getLogger(__name__)
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.DEBUG)
+
+    async def main():
+        rest_api = LiquidAsyncRestApi(config,logger)
+        try:
+            ask,bid = await asyncio.gather(
+                rest_api.limit_order(-0.0001,400 * 10 ** 4),
+                rest_api.limit_order(0.0001,300 * 10 ** 4),
+                )
+            print("limit_order:",ask,bid)
+            print("cancel_orders:",await rest_api.cancel_orders([ask["id"],bid["id"]]))
+        finally:
+            await rest_api.close()
+    asyncio.run(main())
@@ -0,0 +1,154 @@
+import json
+from collections import namedtuple
+from threading import local
+
+class _Record(tuple):
+    """
+    不変のレコード型の基底クラス。属性でも、従来のdictと同じく["ltp"]のようにキーでも参照できる。
+    """
+    __slots__ = ()
+
+    def __getitem__(self,key):
+        if isinstance(key,str):
+            return getattr(self,key)
+        return tuple.__getitem__(self,key)
+
+    def to_dict(self):
+        return dict(zip(self._fields,self))
+
+class Ticker(_Record,namedtuple("Ticker",["timestamp","ltp","ask","bid","high","low","volume","latency"])):
+    __slots__ = ()
+
+class Execution(_Record,namedtuple("Execution",["id","price","quantity","taker_side","timestamp"])):
+    __slots__ = ()
+
+class BookSnapshot(_Record,namedtuple("BookSnapshot",["timestamp","asks","bids"])):
+    __slots__ = ()
+
+
+class JsonDecoder():
+    """
+    realtime apiのメッセージをレコード型に変換する。標準ライブラリのjsonを使う。
+    """
+    name = "json"
+
+    def loads(self,message):
+        return json.loads(message)
+
+    def decode_ticker(self,message,received_at):
+        """
+        :param message:product_cash_xxx_nのメッセージ
+        :param received_at:受信時刻。latencyの計算に使う。
+        """
+        ticker = self.loads(message)
+        timestamp = float(ticker["timestamp"])
+        return Ticker(
+            timestamp,
+            float(ticker["last_traded_price"]),
+            float(ticker["market_ask"]),
+            float(ticker["market_bid"]),
+            float(ticker["high_market_ask"]),
+            float(ticker["low_market_bid"]),
+            float(ticker["volume_24h"]),
+            received_at - timestamp,
+            )
+
+    def decode_execution(self,message):
+        execution = self.loads(message)
+        return Execution(
+            execution["id"],
+            float(execution["price"]),
+            float(execution["quantity"]),
+            execution["taker_side"],
+            float(execution["timestamp"]),
+            )
+
+    def decode_book(self,message):
+        """
+        :return: タイムスタンプ、asks、bids。asks,bidsは[[価格,数量],...]
+        """
+        book = self.loads(message)
+        return float(book["timestamp"]),book["asks"],book["bids"]
+
+class OrjsonDecoder(JsonDecoder):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.loads = orjson.loads
+
+class UjsonDecoder(JsonDecoder):
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self.loads = ujson.loads
+
+class SimdjsonDecoder(JsonDecoder):
+    """
+    pysimdjsonを使う。必要なフィールドだけをPythonオブジェクトに変換する。
+    パーサーは次のparseで前の結果を破棄するため、スレッドごとにパーサーを持つ。
+    """
+    name = "simdjson"
+
+    def __init__(self):
+        import simdjson
+        self._simdjson = simdjson
+        self._local = local()
+
+    def loads(self,message):
+        parser = getattr(self._local,"parser",None)
+        if parser is None:
+            parser = self._local.parser = self._simdjson.Parser()
+        return parser.parse(message)
+
+    def decode_book(self,message):
+        book = self.loads(message)
+        return float(book["timestamp"]),book["asks"].as_list(),book["bids"].as_list()
+
+def execution_from_rest(execution):
+    """
+    public apiの/executionsのレスポンスの1件をExecutionにする。
+    """
+    return Execution(
+        execution["id"],
+        float(execution["price"]),
+        float(execution["quantity"]),
+        execution["taker_side"],
+        float(execution.get("timestamp") or execution["created_at"]),
+        )
+
+
+DECODERS = {
+    "json":JsonDecoder,
+    "orjson":OrjsonDecoder,
+    "ujson":UjsonDecoder,
+    "simdjson":SimdjsonDecoder,
+    }
+
+def available_decoders():
+    """
+    インストールされているライブラリで使えるデコーダー名のリストを返す。
+    """
+    names = []
+    for name,decoder_class in DECODERS.items():
+        try:
+            decoder_class()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def get_decoder(name="json"):
+    """
+    デコーダーを返す。
+    :param name:json,orjson,ujson,simdjsonのいずれか。autoの場合はインストールされている中で速いものを使う。
+    """
+    if name == "auto":
+        for candidate in ["simdjson","orjson","ujson"]:
+            try:
+                return DECODERS[candidate]()
+            except ImportError:
+                continue
+        return JsonDecoder()
+    return DECODERS[name]()
@@ -0,0 +1,130 @@
+import numpy as np
+from liquid_message import BookSnapshot
+
+class LiquidOrderBook():
+    """
+    板情報を片側ごとに価格・数量のNumPy配列で保持する。
+    asksは価格の昇順、bidsは価格の降順(いずれも最良気配が先頭)。
+    累積数量を更新時に計算しておき、指定数量時点の価格などをベクトル演算で求める。
+    更新1回あたりのコストはmax_levelsで抑えられ、板の深さに依存しない。
+    """
+    def __init__(self,max_levels=100,depth_sizes=None):
+        """
+        :param max_levels:保持する片側の板の段数の上限。
+        :param depth_sizes:get_bookで価格を返す累積数量のリスト。Noneの場合は0.01から0.2まで0.01刻み。
+        """
+        self.max_levels = max_levels
+        if depth_sizes is None:
+            depth_sizes = np.arange(1,21) * 0.01
+        self.depth_sizes = np.asarray(depth_sizes,dtype=np.float64)
+        self.timestamp = 0
+        # (価格,数量,累積数量)を1つのタプルで差し替え、参照側が更新途中の状態を見ないようにする
+        empty = np.empty(0,dtype=np.float64)
+        self._asks = (empty,empty,empty)
+        self._bids = (empty,empty,empty)
+
+    def _to_arrays(self,ladder):
+        levels = np.array(ladder[:self.max_levels],dtype=np.float64).reshape(-1,2)
+        prices = levels[:,0].copy()
+        sizes = levels[:,1].copy()
+        return prices,sizes,np.cumsum(sizes)
+
+    def update(self,asks=None,bids=None,timestamp=None):
+        """
+        板情報のメッセージを反映する。Liquidは上位の板をまとめて送るため、渡された側を丸ごと置き換える。
+        :param asks:[[価格,数量],...]。文字列でも良い。Noneの場合はその側を更新しない。
+        :param bids:[[価格,数量],...]。文字列でも良い。Noneの場合はその側を更新しない。
+        :param timestamp:メッセージのタイムスタンプ
+        """
+        if asks is not None:
+            self._asks = self._to_arrays(asks)
+        if bids is not None:
+            self._bids = self._to_arrays(bids)
+        if timestamp is not None:
+            self.timestamp = timestamp
+
+    def _side(self,side):
+        return self._asks if side == "asks" else self._bids
+
+    def is_empty(self):
+        return len(self._asks[0]) == 0 or len(self._bids[0]) == 0
+
+    def best(self,side):
+        """
+        最良気配の価格を返す。
+        :param side:asksかbids
+        """
+        prices = self._side(side)[0]
+        return float(prices[0]) if len(prices) else np.nan
+
+    def price_at_depth(self,side,sizes):
+        """
+        最良気配から累積した数量が指定数量に達する価格を返す。
+        板が薄く指定数量に届かない場合は保持している最も深い価格を返す。
+        :param side:asksかbids
+        :param sizes:累積数量。スカラーか配列。
+        """
+        prices,_,cumsum = self._side(side)
+        if len(prices) == 0:
+            return np.full(np.shape(sizes),np.nan)
+        idx = np.searchsorted(cumsum,sizes,side="left")
+        return prices[np.minimum(idx,len(prices) - 1)]
+
+    def get_levels(self,side,n):
+        """
+        上位n段の価格と数量を返す。n段に満たない場合はnanで埋める。
+        :param side:asksかbids
+        """
+        prices,sizes,_ = self._side(side)
+        ret_prices = np.full(n,np.nan)
+        ret_sizes = np.full(n,np.nan)
+        num = min(n,len(prices))
+        ret_prices[:num] = prices[:num]
+        ret_sizes[:num] = sizes[:num]
+        return ret_prices,ret_sizes
+
+    def size_within_ticks(self,side,n,tick=1.0):
+        """
+        最良気配からnティック以内にある数量の合計を返す。
+        :param side:asksかbids
+        :param n:ティック数
+        :param tick:1ティックの価格幅
+        """
+        prices,_,cumsum = self._side(side)
+        if len(prices) == 0:return 0.0
+        if side == "asks":
+            idx = np.searchsorted(prices,prices[0] + n * tick,side="right")
+        else:
+            idx = np.searchsorted(-prices,-(prices[0] - n * tick),side="right")
+        return float(cumsum[idx - 1]) if idx > 0 else 0.0
+
+    def microprice(self):
+        """
+        最良気配の数量で加重した仲値を返す。
+        """
+        if self.is_empty():return np.nan
+        ask,ask_size = self._asks[0][0],self._asks[1][0]
+        bid,bid_size = self._bids[0][0],self._bids[1][0]
+        return float((ask * bid_size + bid * ask_size) / (ask_size + bid_size))
+
+    def imbalance(self,levels=1):
+        """
+        上位levels段の数量の偏りを返す。-1(売り優勢)から1(買い優勢)。
+        """
+        if self.is_empty():return np.nan
+        ask_cumsum = self._asks[2]
+        bid_cumsum = self._bids[2]
+        ask_size = ask_cumsum[min(levels,len(ask_cumsum)) - 1]
+        bid_size = bid_cumsum[min(levels,len(bid_cumsum)) - 1]
+        return float((bid_size - ask_size) / (bid_size + ask_size))
+
+    def get_book(self):
+        """
+        最良気配と、depth_sizesの各累積数量に達する価格を返す。
+        """
+        if self.is_empty():return None
+        return BookSnapshot(
+            self.timestamp,
+            [self.best("asks")] + self.price_at_depth("asks",self.depth_sizes).tolist(),
+            [self.best("bids")] + self.price_at_depth("bids",self.depth_sizes).tolist(),
+            )
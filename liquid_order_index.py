@@ -0,0 +1,103 @@
+import time
+from threading import Lock
+
+class LiquidOrderIndex():
+    """
+    自分の注文を注文idをキーとしてメモリ上に保持する。
+    発注・キャンセルのレスポンスで随時更新し、/orders/の取得結果と定期的に突き合わせる。
+    id、status、sideでの検索はメモリ上で行い、apiを呼ばない。
+    """
+    def __init__(self,max_orders=1000):
+        """
+        :param max_orders:保持する注文数の上限。超えた場合はlive以外の古い注文から削除する。
+        """
+        self.max_orders = max_orders
+        self.orders = {}
+        self._updated_at = {}
+        self._by_status = {}
+        self._by_side = {}
+        self.lock = Lock()
+        self.listeners = []
+
+    def subscribe(self,callback):
+        """
+        注文を更新するたびに呼ばれるコールバックを登録する。callback(order)。
+        reconcileで上書きしなかった注文では呼ばれない。
+        """
+        self.listeners.append(callback)
+
+    def _notify(self,orders):
+        for order in orders:
+            for listener in self.listeners:
+                listener(order)
+
+    def _remove(self,order_id):
+        order = self.orders.pop(order_id)
+        self._updated_at.pop(order_id)
+        self._by_status[order["status"]].discard(order_id)
+        self._by_side[order["side"]].discard(order_id)
+
+    def _put(self,order,updated_at):
+        if order["id"] in self.orders:
+            self._remove(order["id"])
+        self.orders[order["id"]] = order
+        self._updated_at[order["id"]] = updated_at
+        self._by_status.setdefault(order["status"],set()).add(order["id"])
+        self._by_side.setdefault(order["side"],set()).add(order["id"])
+
+    def _prune(self):
+        if len(self.orders) <= self.max_orders:return
+        for order_id in list(self.orders.keys()):
+            if len(self.orders) <= self.max_orders:break
+            if self.orders[order_id]["status"] == "live":continue
+            self._remove(order_id)
+
+    def update(self,order):
+        """
+        発注・キャンセルのレスポンスで注文を更新する。
+        :param order:_to_my_order_format済みの注文。Noneの場合は何もしない。
+        """
+        if order is None:return
+        with self.lock:
+            self._put(order,time.monotonic())
+            self._prune()
+        self._notify([order])
+
+    def reconcile(self,orders,fetch_started_at):
+        """
+        /orders/の取得結果で注文を更新する。
+        取得開始後にレスポンスで更新された注文は、取得結果の方が古い可能性があるため上書きしない。
+        :param orders:_to_my_order_format済みの注文のリスト
+        :param fetch_started_at:取得開始時のtime.monotonic()
+        """
+        updated = []
+        with self.lock:
+            for order in orders:
+                if self._updated_at.get(order["id"],0) > fetch_started_at:continue
+                self._put(order,fetch_started_at)
+                updated.append(order)
+            self._prune()
+        self._notify(updated)
+
+    def get(self,order_id):
+        """
+        注文を返す。保持していない場合はNoneを返す。
+        """
+        return self.orders.get(order_id)
+
+    def get_orders(self,status=None,side=None):
+        """
+        条件に合う注文のリストを返す。
+        :param status:liveなど。Noneの場合は条件にしない。
+        :param side:buyかsell。Noneの場合は条件にしない。
+        """
+        with self.lock:
+            if status is None and side is None:
+                return list(self.orders.values())
+            ids = None
+            if status is not None:
+                ids = self._by_status.get(status,set())
+            if side is not None:
+                side_ids = self._by_side.get(side,set())
+                ids = side_ids if ids is None else ids & side_ids
+            return [self.orders[order_id] for order_id in ids]
@@ -1,28 +1,173 @@
 import os
 import liquidtap
-import json
 from datetime import datetime,timezone,timedelta
-from threading import Thread
-import json
+from threading import Thread,Condition,Lock
+from collections import OrderedDict
+from functools import partial
 import time
+import numpy as np
 from setup_logger import setup_logger
+from liquid_order_book import LiquidOrderBook
+from liquid_message import get_decoder,execution_from_rest
+from liquid_session_pool import LiquidSessionPool
+from ohlcv_aggregator import OhlcvAggregator
+from latency_metrics import latency_metrics
+from clock_sync import ClockSync
+
+class _FeedConnection():
+    """
+    liquidtapの接続1本。受信したメッセージをLiquidRealtimeApiの共通の処理に渡し、接続ごとの最終受信時刻と遅れを記録する。
+    """
+    def __init__(self,api,index):
+        self.api = api
+        self.index = index
+        self.tap = None
+        self.connected_monotonic = None
+        self.last_receive_monotonic = None
+        # 他の接続が先に届けたメッセージに対する遅れ(秒)の指数移動平均
+        self.lag = 0.0
+
+    def connect(self):
+        self.tap = liquidtap.Client()
+        self.tap.pusher.connection.bind("pusher:connection_established", self._subscribe)
+        self.connected_monotonic = time.monotonic()
+        self.tap.pusher.connect()
+
+    def disconnect(self):
+        if self.tap is not None:
+            self.tap.pusher.disconnect()
+
+    def _subscribe(self, *args, **kwarg):
+        # 1つの接続で全ての商品のチャンネルを購読し、商品ごとの状態に振り分ける
+        for product in self.api.products.values():
+            self.tap.pusher.subscribe(product.ticker_channel).bind("updated", partial(self._recieve_market,product=product))
+            self.tap.pusher.subscribe(product.executions_channel).bind("created", partial(self._recieve_executions,product=product))
+            self.tap.pusher.subscribe(product.book_channel).bind("updated", partial(self._recieve_book,product=product))
+
+    def _recieve_market(self,message,product):
+        self.last_receive_monotonic = time.monotonic()
+        self.api._recieve_market(message,self,product)
+
+    def _recieve_executions(self,message,product):
+        self.last_receive_monotonic = time.monotonic()
+        self.api._recieve_executions(message,self,product)
+
+    def _recieve_book(self,message,product):
+        self.last_receive_monotonic = time.monotonic()
+        self.api._recieve_book(message,self,product)
+
+    def update_lag(self,lag,alpha=0.1):
+        self.lag += (lag - self.lag) * alpha
+
+    def is_stale(self,now,stale_seconds,connect_timeout):
+        """
+        メッセージが途絶えているかを返す。最初のメッセージまではconnect_timeout秒待つ。
+        """
+        if self.last_receive_monotonic is None:
+            return now - self.connected_monotonic > connect_timeout
+        return now - self.last_receive_monotonic > stale_seconds
+
+class _ProductState():
+    """
+    1商品分の受信状態。購読するチャンネル名、Ticker、板、ローソク足と、重複除去・補完に使う情報を持つ。
+    """
+    def __init__(self,product,book_max_levels,book_depth_sizes,ohlcv_resolutions,ohlcv_length):
+        """
+        :param product:{"product_id":5,"currency_pair_code":"btcjpy"}の形式の辞書。
+            ticker_channel,executions_channel,book_channelでチャンネル名を指定できる。
+        """
+        self.product_id = product["product_id"]
+        code = product.get("currency_pair_code","btcjpy").lower()
+        self.ticker_channel = product.get("ticker_channel",f"product_cash_{code}_{self.product_id}")
+        self.executions_channel = product.get("executions_channel",f"executions_cash_{code}")
+        self.book_channel = product.get("book_channel",f"price_ladders_cash_{code}")
+        self.ticker = None
+        self.order_book = LiquidOrderBook(max_levels=book_max_levels,depth_sizes=book_depth_sizes)
+        self.ohlcv = OhlcvAggregator(resolutions=ohlcv_resolutions,length=ohlcv_length)
+        self.last_massage_timestamp = 0
+        # 約定id -> 最初に受信したtime.monotonic()
+        self.seen_execution_ids = OrderedDict()
+        self.last_ticker_source = (0,None)
+        self.last_book_source = (0,None)
+        # 最後に反映した約定の(id,タイムスタンプ)と、補完が必要な場合の補完開始タイムスタンプ
+        self.last_execution = (None,0)
+        self.backfill_since = None
+        # 補完は商品ごとに1つだけ別スレッドで行う。補完中に再び途絶えた場合の補完開始タイムスタンプと、失敗時の再試行時刻
+        self.backfill_thread = None
+        self.backfill_next_since = None
+        self.backfill_failures = 0
+        self.backfill_retry_at = 0
 
 class LiquidRealtimeApi():
     """
     LiquidのRealtimeApiに接続する。最新のTicker情報を保持する。
     開始する時はstartメソッド、終了するときはstopメソッドを呼ぶ。
     情報取得時は各getメソッドを呼ぶ。
-    取得可能データ:Ticker、1分ローソク足、最終メッセージ受信時からの経過時間
+    取得可能データ:Ticker、板情報、ローソク足(複数の時間足)、最終メッセージ受信時からの経過時間
+    productsで複数の商品を指定すると、1つの接続で全ての商品を購読し、商品ごとに状態を持つ。
+    各getメソッドはproduct_idで商品を指定し、省略した場合はproductsの最初の商品を返す。
+    connection_numを2以上にすると同じチャンネルを複数の接続で購読し、先に届いたメッセージを使う。
+    約定はid、Tickerと板はタイムスタンプで重複を除く。途絶えた接続・遅れている接続は裏で張り替え、張り替えの間も他の接続で受信を続ける。
+    全ての接続が途絶えた場合は、受信が再開した後に途絶えていた間の約定をpublic apiから取得し、受信した約定と同じ処理で反映する。
     """
-    def __init__(self,logger):
+    def __init__(self,logger,book_depth_sizes=None,book_max_levels=100,decoder="json",ohlcv_resolutions=(1,5,60,300,3600),ohlcv_length=600,recorder=None,clock_sync=None,
+        connection_num=1,stale_seconds=5,connect_timeout=30,max_lag=1.0,dedupe_size=10000,backfill=True,backfill_limit=1000,backfill_max_pages=10,
+        backfill_retry_interval=5,backfill_retry_max=300,products=None):
         """
         :param logger:ロガーインスタンス
+        :param decoder:メッセージのデコーダー。json,orjson,ujson,simdjson,autoのいずれか。
+        :param ohlcv_resolutions:作るローソク足の長さ(秒)のリスト
+        :param ohlcv_length:保持するローソク足の本数。時間足ごとに変える場合は{足の長さ:本数}の辞書。
+        :param recorder:受信したメッセージを記録するTickRecorder。Noneの場合は記録しない。
+        :param clock_sync:取引所との時刻のずれを推定するClockSync。Noneの場合は新しく作る。
+        :param book_depth_sizes:get_bookで価格を返す累積数量のリスト。Noneの場合は0.01から0.2まで0.01刻み。
+        :param book_max_levels:保持する片側の板の段数の上限。
+        :param connection_num:同時に張る接続の数
+        :param stale_seconds:この秒数メッセージが無い接続を張り替える
+        :param connect_timeout:接続してから最初のメッセージまで待つ秒数
+        :param max_lag:他の接続に対する遅れの平均がこの秒数を超えた接続を張り替える。接続が1つの場合は使わない。
+        :param dedupe_size:重複判定のために覚えておく約定idの数
+        :param backfill:Trueの場合、受信が途絶えていた間の約定をpublic apiから取得して反映する
+        :param backfill_limit:1回のapi呼び出しで取得する約定の数
+        :param backfill_max_pages:1回の補完でapiを呼び出す回数の上限
+        :param backfill_retry_interval:補完に失敗した場合に再試行するまでの秒数。失敗が続くたびに倍にする。
+        :param backfill_retry_max:補完の再試行までの秒数の上限
+        :param products:購読する商品のリスト。[{"product_id":5,"currency_pair_code":"btcjpy"},...]の形式。Noneの場合はBTC/JPYのみ。
+            recorderで記録するのは最初の商品のみ。
         """
-        self.ticker = None
-        self.book = None
+        self.decoder = get_decoder(decoder)
+        if products is None:
+            products = [{"product_id":5,"currency_pair_code":"btcjpy"}]
+        self.products = OrderedDict()
+        for product in products:
+            self.products[product["product_id"]] = _ProductState(product,book_max_levels,book_depth_sizes,ohlcv_resolutions,ohlcv_length)
+        self.default_product = next(iter(self.products.values()))
         self.stop_flg = True
         self.channel_thread = None
-        self.ohlcv_1m = [{"timestamp":0} for _ in range(60)]
+        self.recorder = recorder
+        # 更新通知。Ticker・約定を受信するたびにupdate_seqを進め、待っているスレッドを起こす。
+        self.update_condition = Condition()
+        self.update_seq = 0
+        self.listeners = []
+        # 最後にメッセージを受信した時のtime.perf_counter()。判断までのレイテンシ計測に使う。
+        self.last_receive_perf = None
+        # 時刻のずれの推定と、ローカルの単調時計で測る最終受信時刻
+        self.clock_sync = clock_sync if clock_sync is not None else ClockSync()
+        self.last_receive_monotonic = time.monotonic()
+        # 複数接続と重複除去
+        self.connection_num = connection_num
+        self.stale_seconds = stale_seconds
+        self.connect_timeout = connect_timeout
+        self.max_lag = max_lag
+        self.dedupe_size = dedupe_size
+        self.connections = []
+        self.receive_lock = Lock()
+        self.backfill = backfill
+        self.backfill_limit = backfill_limit
+        self.backfill_max_pages = backfill_max_pages
+        self.backfill_retry_interval = backfill_retry_interval
+        self.backfill_retry_max = backfill_retry_max
+        self.session_pool = LiquidSessionPool(0,logger,warm_up=False)
         self.logger = logger
         self.tz = timezone(timedelta(hours=+9), 'Asia/Tokyo')
 
@@ -30,51 +175,129 @@ class LiquidRealtimeApi():
         message = "[LiquidRealtimeApi]" + message
         self.logger.info(message)
 
+    def _log_error(self,message):
+        message = "[LiquidRealtimeApi]" + message
+        self.logger.error(message)
+
     def start(self):
         """
         外部から呼び出される。処理を開始する。
         """
         self._log_info("start liquid realtime api.")
+        if self.recorder is not None:
+            self.recorder.start()
         self.stop_flg = False
+        self.last_receive_monotonic = time.monotonic()
         self.channel_thread = Thread(target=self._connect)
         self.channel_thread.setDaemon(True)
         self.channel_thread.start()
-        self.last_massage_timestamp = 0
-        while self.ticker is None:
+        while any(product.ticker is None for product in self.products.values()):
             time.sleep(3)
             self._log_info("... waiting first message.")
         self._log_info("recieved first message.")
 
-    def _subscribe(self, *args, **kwarg):
+    def _open_connection(self,index):
         """
-        websocketの購読を設定するメソッド。_connectメソッド内でpusherオブジェクトのバインドする。
+        接続を1本張る。失敗した場合はログを出してNoneを返し、監視ループの次の周期で張り直す。
         """
-        self.tap.pusher.subscribe("product_cash_btcjpy_5").bind("updated", self._recieve_market)
-        self.tap.pusher.subscribe("executions_cash_btcjpy").bind("created", self._recieve_executions)
-        self.tap.pusher.subscribe("price_ladders_cash_btcjpy").bind("updated", self._recieve_book)
+        connection = _FeedConnection(self,index)
+        try:
+            connection.connect()
+            return connection
+        except Exception as e:
+            self._log_error(f"connection {index} failed to connect.{e}")
+            try:
+                connection.disconnect()
+            except Exception:
+                pass
+            return None
 
     def _connect(self):
         """
-        websocketの購読を開始し、接続状況を監視する。
-        最終メッセージ受信時から5秒経過した場合、接続に不備があるとみなし、websocketを再接続する。
+        websocketの購読を開始し、1秒ごとに接続ごとの状況を監視する。
+        stale_seconds秒メッセージが無い接続と、他の接続よりmax_lag秒以上遅れている接続は、新しい接続を張ってから古い接続を切る。
+        全体でstale_seconds秒メッセージが無かった場合は、受信が再開した後に途絶えていた間の約定を補完する。
+        補完は別スレッドで行い、その間も接続の監視を続ける。
+        接続に失敗した場合は古い接続を残し、次の周期で張り直す。
         """
+        self.connections = [self._open_connection(i) for i in range(self.connection_num)]
         while self.stop_flg == False:
-            self.tap = liquidtap.Client()
-            self.tap.pusher.connection.bind("pusher:connection_established", self._subscribe)
-            self.tap.pusher.connect()
-            time.sleep(30)
-            while self.stop_flg == False:
-                time.sleep(1)
-                if  self.get_seconds_from_last_message() > 5:
-                    self.tap.pusher.disconnect()
-                    self._log_info("too latency, reconnect liquid realtime api.")
-                    break
+            time.sleep(1)
+            feed_stale = self.get_seconds_from_last_message() > self.stale_seconds
+            for product in self.products.values():
+                if self.backfill and feed_stale and product.last_execution[0] is not None:
+                    if product.backfill_since is None:
+                        product.backfill_since = product.last_execution[1]
+                    elif self._is_backfilling(product) and product.backfill_next_since is None:
+                        product.backfill_next_since = product.last_execution[1]
+                if product.backfill_since is not None and not feed_stale:
+                    self._start_backfill(product)
+            now = time.monotonic()
+            for i,connection in enumerate(self.connections):
+                if connection is None:
+                    self._log_info(f"connection {i} is not connected, reconnect liquid realtime api.")
+                elif connection.is_stale(now,self.stale_seconds,self.connect_timeout):
+                    self._log_info(f"connection {i} is stale, reconnect liquid realtime api.")
+                elif len(self.connections) >= 2 and connection.lag > self.max_lag:
+                    self._log_info(f"connection {i} lags {round(connection.lag,3)}s, reconnect liquid realtime api.")
+                else:
+                    continue
+                if self.stop_flg:break
+                new_connection = self._open_connection(i)
+                if new_connection is None:continue
+                self.connections[i] = new_connection
+                if connection is not None:
+                    connection.disconnect()
+
+    def subscribe(self,callback):
+        """
+        外部から呼び出される。Ticker・約定を受信するたびに呼ばれるコールバックを登録する。
+        コールバックは受信スレッドで呼ばれるため、重い処理をしないこと。
+        :param callback:callback(channel,record,product_id)。channelはtickerかexecutions、recordはTickerかExecution。
+        """
+        self.listeners.append(callback)
+
+    def wait_for_update(self,last_seq,timeout,coalesce=0):
+        """
+        外部から呼び出される。update_seqがlast_seqから進むまで最大timeout秒待つ。
+        :param last_seq:前回受け取ったupdate_seq
+        :param timeout:最大待ち時間(秒)
+        :param coalesce:更新があった後さらにこの秒数待ち、その間の更新を1回にまとめる。timeoutは超えない。
+        :return: 最新のupdate_seq。タイムアウトした場合はlast_seqと同じ値。
+        """
+        deadline = time.monotonic() + timeout
+        with self.update_condition:
+            while self.update_seq == last_seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self.update_seq
+                self.update_condition.wait(remaining)
+        if coalesce > 0:
+            time.sleep(max(0,min(coalesce,deadline - time.monotonic())))
+        return self.update_seq
+
+    def _notify(self,channel,record,product_id):
+        for listener in self.listeners:
+            listener(channel,record,product_id)
+        with self.update_condition:
+            self.update_seq += 1
+            self.update_condition.notify_all()
+
+    def _product(self,product_id):
+        return self.default_product if product_id is None else self.products[product_id]
 
     def get_seconds_from_last_message(self):
         """
         最終メッセージ受信時から経過時間を返す。
+        ローカルの単調時計で測るため、取引所との時刻のずれの影響を受けない。
+        """
+        return time.monotonic() - self.last_receive_monotonic
+
+    def get_message_age(self,product_id=None):
+        """
+        最終メッセージのタイムスタンプ(取引所時刻)からの経過時間を、時刻のずれを補正して返す。
         """
-        return datetime.now(self.tz).timestamp() - self.last_massage_timestamp
+        return self.clock_sync.message_age(self._product(product_id).last_massage_timestamp)
 
     def stop(self):
         """
@@ -82,126 +305,245 @@ class LiquidRealtimeApi():
         """
         self._log_info("stop liquid realtime api.")
         self.stop_flg = True
-        self.tap.pusher.disconnect()
+        for connection in self.connections:
+            if connection is None:continue
+            connection.disconnect()
+        if self.recorder is not None:
+            self.recorder.stop()
 
-    def get_ticker(self):
+    def get_ticker(self,product_id=None):
         """
         外部から呼び出される。Ticker情報を返す。
-        """        
-        return self.ticker
+        Tickerは不変のレコード型で、ticker["ltp"]とticker.ltpのどちらでも参照できる。
+        """
+        return self._product(product_id).ticker
 
-    def get_ohlcv(self,n):
+    def get_ohlcv(self,n,resolution=60,product_id=None):
         """
-        外部から呼び出される。直近n期間の1分ローソク足配列を返す。配列は時系列順。最新のデータが最後尾に入っている。
-        :param n:期間を指定。上限は60。
+        外部から呼び出される。直近n本のローソク足を返す。時系列順で、最新(未確定)の足が最後尾に入っている。
+        返り値は構造化NumPy配列のビュー(コピーなし)。ohlcv[-1]["close"]やohlcv["close"]で参照できる。
+        :param n:本数。上限はohlcv_length。
+        :param resolution:足の長さ(秒)。ohlcv_resolutionsで指定したもの。
         """
-        minute = datetime.now(self.tz).minute
-        if minute-n < 0:
-            return self.ohlcv_1m[minute-n:] + self.ohlcv_1m[:minute+1]
-        else:
-            return self.ohlcv_1m[minute-n:minute+1]
+        return self._product(product_id).ohlcv.get(n,resolution)
 
-    def get_book(self):
+    def get_ohlcv_revision(self,resolution=60,product_id=None):
+        """
+        外部から呼び出される。遅れて届いた約定や補完で、最新足より前の足を直した回数を返す。
+        値が変わった場合は、直近2本より前の足も変わっている。
+        """
+        return self._product(product_id).ohlcv.get_revision(resolution)
+
+    def get_book(self,product_id=None):
         """
         外部から呼び出される。板情報を返す。
-        """        
-        return self.book
+        asks,bidsの先頭は最良気配、以降はbook_depth_sizesの各累積数量に達する価格。
+        """
+        return self._product(product_id).order_book.get_book()
+
+    def get_order_book(self,product_id=None):
+        """
+        外部から呼び出される。板情報エンジン(LiquidOrderBook)を返す。
+        指定数量時点の価格、nティック以内の数量、マイクロプライス、板の偏りなどを取得できる。
+        """
+        return self._product(product_id).order_book
 
-    def _recieve_market(self,message):
+    def _is_new(self,last_source,timestamp,connection):
+        """
+        Ticker・板のメッセージが新しいかを返す。古いものと、別の接続から届いた同じタイムスタンプのものは重複とみなす。
+        """
+        last_timestamp,last_connection = last_source
+        if timestamp < last_timestamp:return False
+        return timestamp > last_timestamp or connection is last_connection
+
+    def _is_new_execution(self,product,execution_id,connection):
+        """
+        約定idが初めて届いたものかを返す。2回目以降の場合は、最初に届いてからの遅れをその接続に記録する。
+        """
+        now = time.monotonic()
+        seen_execution_ids = product.seen_execution_ids
+        first_received = seen_execution_ids.get(execution_id)
+        if first_received is not None:
+            if connection is not None:
+                connection.update_lag(now - first_received)
+            return False
+        seen_execution_ids[execution_id] = now
+        if len(seen_execution_ids) > self.dedupe_size:
+            seen_execution_ids.popitem(last=False)
+        if connection is not None:
+            connection.update_lag(0.0)
+        return True
+
+    def _recieve_market(self,message,connection=None,product=None):
         """
         Ticker情報を受信した時の処理。必要な情報のみ抽出し保持する。
         """
-        ticker = json.loads(message)
-        ticker = {
-            "timestamp":float(ticker["timestamp"]),
-            "ltp":float(ticker["last_traded_price"]),
-            "ask":float(ticker["market_ask"]),
-            "bid":float(ticker["market_bid"]),
-            "high":float(ticker["high_market_ask"]),
-            "low":float(ticker["low_market_bid"]),
-            "volume":float(ticker["volume_24h"]),
-            "latency":datetime.now(self.tz).timestamp()-float(ticker["timestamp"])
-            }
-        self.ticker = ticker
-        self.last_massage_timestamp = ticker["timestamp"]
-
-    def _recieve_executions(self,message):
+        received_perf = time.perf_counter()
+        received_at = time.time()
+        product = self.default_product if product is None else product
+        # latencyは時刻のずれを補正した片道遅延
+        ticker = self.decoder.decode_ticker(message,received_at + self.clock_sync.offset(received_at))
+        self.clock_sync.add_message(ticker.timestamp,received_at)
+        with self.receive_lock:
+            if not self._is_new(product.last_ticker_source,ticker.timestamp,connection):return
+            product.last_ticker_source = (ticker.timestamp,connection)
+            self.last_receive_monotonic = time.monotonic()
+            if latency_metrics.enabled:
+                latency_metrics.record_since("rt_decode",received_perf)
+                latency_metrics.record("rt_message_age",ticker.latency)
+            self.last_receive_perf = received_perf
+            product.ticker = ticker
+            product.last_massage_timestamp = ticker.timestamp
+            # 約定がなくても足を進める
+            product.ohlcv.advance(ticker.timestamp)
+            if self.recorder is not None and product is self.default_product:
+                self.recorder.record_ticker(ticker)
+        self._notify("ticker",ticker,product.product_id)
+
+    def _recieve_executions(self,message,connection=None,product=None):
         """
         約定情報を受信した時の処理
         """
-        execution = json.loads(message)
-        execution = {
-            "id":execution["id"],
-            "price":execution["price"],
-            "quantity":execution["quantity"],
-            "taker_side":execution["taker_side"],
-            "timestamp":float(execution["timestamp"])
-        }
-        self.ticker["ltp"] = execution["price"]
-        self.last_massage_timestamp = execution["timestamp"]
-        self._update_ohlcv_1m(execution)
+        received_perf = time.perf_counter()
+        received_at = time.time()
+        product = self.default_product if product is None else product
+        execution = self.decoder.decode_execution(message)
+        self.clock_sync.add_message(execution.timestamp,received_at)
+        with self.receive_lock:
+            if not self._apply_execution(product,execution,connection):return
+            self.last_receive_monotonic = time.monotonic()
+            if latency_metrics.enabled:
+                latency_metrics.record_since("rt_decode",received_perf)
+                latency_metrics.record("rt_message_age",self.clock_sync.one_way_latency(execution.timestamp,received_at))
+            self.last_receive_perf = received_perf
+            if self.recorder is not None and product is self.default_product:
+                self.recorder.record_execution(execution)
+        self._notify("executions",execution,product.product_id)
 
-    def _recieve_book(self,message):
+    def _apply_execution(self,product,execution,connection=None):
+        """
+        約定を反映する。受信と補完で共通の処理。receive_lockを取得して呼ぶ。
+        ltpは反映済みの約定より新しい場合のみ更新し、ローソク足は過去の足にも反映する。
+        :return: 新しい約定の場合True、重複の場合False
+        """
+        if not self._is_new_execution(product,execution.id,connection):return False
+        if execution.timestamp >= product.last_execution[1]:
+            product.last_execution = (execution.id,execution.timestamp)
+            if product.ticker is not None:
+                product.ticker = product.ticker._replace(ltp=execution.price)
+            product.last_massage_timestamp = execution.timestamp
+        self._update_ohlcv(execution,product)
+        return True
+
+    def _is_backfilling(self,product):
+        return product.backfill_thread is not None and product.backfill_thread.is_alive()
+
+    def _start_backfill(self,product):
+        """
+        補完のスレッドを開始する。補完中の場合と、失敗後の再試行時刻になっていない場合は何もしない。
+        """
+        if self._is_backfilling(product):return
+        if time.monotonic() < product.backfill_retry_at:return
+        product.backfill_thread = Thread(target=self._run_backfill,args=(product,product.backfill_since))
+        product.backfill_thread.daemon = True
+        product.backfill_thread.start()
+
+    def _run_backfill(self,product,since):
+        """
+        補完のスレッドで実行する。成功した場合は、補完中に再び途絶えていればその分の補完を次に行う。
+        失敗した場合はbackfill_retry_interval秒から倍々に待って再試行する。
+        """
+        try:
+            self._backfill_executions(product,since)
+            product.backfill_since = product.backfill_next_since
+            product.backfill_next_since = None
+            product.backfill_failures = 0
+        except Exception as e:
+            product.backfill_failures += 1
+            delay = min(self.backfill_retry_max,self.backfill_retry_interval * 2 ** (product.backfill_failures - 1))
+            product.backfill_retry_at = time.monotonic() + delay
+            self._log_error(f"backfill failed.product_id={product.product_id}.retry in {delay}s.{e}")
+
+    def _backfill_executions(self,product,since):
+        """
+        sinceのタイムスタンプ以降の約定をpublic apiから取得し、時系列順に反映する。
+        受信中の約定と重なった分はidで除く。TickRecorderのファイルは時系列順を保つため、補完した約定は記録しない。
+        反映後、補完した範囲の足が取得した約定から作った足と一致するか確認する。
+        :return: 反映した約定の数
+        """
+        timestamp = int(since)
+        count = 0
+        fetched = {}
+        for _ in range(self.backfill_max_pages):
+            url = f"{self.session_pool.base_url}/executions?product_id={product.product_id}&timestamp={timestamp}&limit={self.backfill_limit}"
+            res = self.session_pool.request("GET",url).json()
+            models = res["models"] if isinstance(res,dict) else res
+            executions = sorted(map(execution_from_rest,models),key=lambda execution:(execution.timestamp,execution.id))
+            for execution in executions:
+                if execution.timestamp < since:continue
+                fetched[execution.id] = execution
+                with self.receive_lock:
+                    applied = self._apply_execution(product,execution)
+                if applied:
+                    count += 1
+                    self._notify("executions",execution,product.product_id)
+            if len(models) < self.backfill_limit:break
+            # 同じ秒の約定がlimitを超える場合は次の秒へ進める
+            timestamp = max(timestamp + 1,int(executions[-1].timestamp))
+        self._log_info(f"backfilled {count} executions since {since}.product_id={product.product_id}.")
+        self._verify_backfilled_ohlcv(product,since,list(fetched.values()))
+        return count
+
+    def _verify_backfilled_ohlcv(self,product,since,executions):
+        """
+        補完した範囲の足が、取得した約定を時系列順に反映して作った足と一致するか確認し、一致しない足をログに出す。
+        sinceを含む足と最後に取得した約定を含む足は、取得範囲外の約定を含みうるため比較しない。
+        :return: 一致しなかった足の数
+        """
+        if len(executions) == 0:return 0
+        executions = sorted(executions,key=lambda execution:(execution.timestamp,execution.id))
+        last = executions[-1].timestamp
+        buffers = product.ohlcv.buffers
+        expected = OhlcvAggregator(resolutions=list(buffers.keys()),length={resolution:buffer.length for resolution,buffer in buffers.items()})
+        for execution in executions:
+            expected.update(execution.timestamp,execution.price,execution.quantity,execution.taker_side)
+        fields = ["open","high","low","close","volume","buy_volume","sell_volume"]
+        mismatch = 0
+        for resolution,buffer in expected.buffers.items():
+            with self.receive_lock:
+                actual = {bar["timestamp"]:bar for bar in product.ohlcv.get(buffer.length,resolution).copy()}
+            for bar in buffer.get(buffer.length):
+                bar_timestamp = bar["timestamp"]
+                if bar_timestamp <= since - since % resolution or bar_timestamp >= last - last % resolution:continue
+                actual_bar = actual.get(bar_timestamp)
+                if actual_bar is None:continue
+                if all(np.isclose(actual_bar[field],bar[field]) for field in fields):continue
+                mismatch += 1
+                self._log_error(f"backfilled bar mismatch.resolution={resolution} timestamp={bar_timestamp} actual={actual_bar.tolist()} expected={bar.tolist()}")
+        return mismatch
+
+    def _recieve_book(self,message,connection=None,product=None):
         """
         板情報を受信した時の処理
         """
-        book = json.loads(message)
-        size_lap = 0.01
-        end_size = 0.2
-        ret = {
-            "timestamp":float(book["timestamp"]),
-            "asks":[float(book["asks"][0][0])],
-            "bids":[float(book["bids"][0][0])],
-            }
-        tmp=0
-        idx=0
-        next_size = size_lap
-        while tmp < end_size:
-            tmp += float(book["asks"][idx][1])
-            while next_size<=tmp:
-                ret["asks"].append(float(book["asks"][idx][0]))
-                next_size += size_lap
-                if next_size > end_size:break
-            idx += 1
-        tmp=0
-        idx=0
-        next_size = size_lap
-        while tmp < end_size:
-            tmp += float(book["bids"][idx][1])
-            while next_size<=tmp:
-                ret["bids"].append(float(book["bids"][idx][0]))
-                next_size += size_lap
-                if next_size > end_size:break
-            idx += 1
-        self.book = ret
-
-    def _update_ohlcv_1m(self,execution):
-        """
-        約定情報から1分ローソク足を作る。
-        1分間約定がないと不正確なデータになる。未対応。
-        """
-        minute = datetime.fromtimestamp(execution["timestamp"]).minute
-        if execution["timestamp"] - self.ohlcv_1m[minute]["timestamp"] > 60:
-            self.ohlcv_1m[minute]["timestamp"] = execution["timestamp"]
-            self.ohlcv_1m[minute]["open"] = execution["price"]
-            self.ohlcv_1m[minute]["high"] = execution["price"]
-            self.ohlcv_1m[minute]["low"] = execution["price"]
-            self.ohlcv_1m[minute]["close"] = execution["price"]
-            self.ohlcv_1m[minute]["volume"] = execution["quantity"]
-            self.ohlcv_1m[minute]["buy_volume"] = execution["quantity"] if execution["taker_side"] == "buy" else 0
-            self.ohlcv_1m[minute]["sell_volume"] = execution["quantity"] if execution["taker_side"] == "sell" else 0
-        else:
-            self.ohlcv_1m[minute]["timestamp"] = execution["timestamp"] - execution["timestamp"] % 60
-            self.ohlcv_1m[minute]["high"] = max(self.ohlcv_1m[minute]["high"],execution["price"])
-            self.ohlcv_1m[minute]["low"] = min(self.ohlcv_1m[minute]["low"],execution["price"])
-            self.ohlcv_1m[minute]["close"] = execution["price"]
-            self.ohlcv_1m[minute]["volume"] += execution["quantity"]
-            self.ohlcv_1m[minute]["buy_volume"] += execution["quantity"] if execution["taker_side"] == "buy" else 0
-            self.ohlcv_1m[minute]["sell_volume"] += execution["quantity"] if execution["taker_side"] == "sell" else 0
+        product = self.default_product if product is None else product
+        timestamp,asks,bids = self.decoder.decode_book(message)
+        with self.receive_lock:
+            if not self._is_new(product.last_book_source,timestamp,connection):return
+            product.last_book_source = (timestamp,connection)
+            product.order_book.update(asks,bids,timestamp)
+            if self.recorder is not None and product is self.default_product:
+                self.recorder.record_book(product.order_book)
 
+    def _update_ohlcv(self,execution,product=None):
+        """
+        約定情報から各時間足のローソク足を作る。
+        """
+        product = self.default_product if product is None else product
+        product.ohlcv.update(execution.timestamp,execution.price,execution.quantity,execution.taker_side)
 
 if __name__=='__main__':
-    logger = setup_logger(setup_logger(os.path.basename(__file__)))
+    logger = setup_logger(os.path.basename(__file__))
     liquid_realtime_api = LiquidRealtimeApi(logger)
     liquid_realtime_api.start()
     time.sleep(3)
@@ -1,31 +1,51 @@
 import os
 import sys
 import time
+import copy
 from datetime import datetime,timedelta,timezone
 import ccxt
 import json
 import traceback
 import jwt
-import requests
+from threading import Thread,Event
+from collections import OrderedDict
+from liquid_session_pool import LiquidSessionPool
+from request_scheduler import RequestScheduler,RateLimitError,NonceError,PRIORITY_CANCEL,PRIORITY_ORDER,PRIORITY_QUERY
+from liquid_order_index import LiquidOrderIndex
+from position_ledger import PositionLedger
+from latency_metrics import latency_metrics
 
 class LiquidRestApi():
     """
     LiquidのRestApiを扱う。
     private apiを使用するにはapiキーが必要。configに設定する。
     同一キーで連続してapi呼び出しを行うとnonceエラーが起きる。複数のキーを使い回すことでエラーを回避する。
+    全てのprivate api呼び出しはRequestSchedulerを通し、キャンセル>発注>照会の優先度順に、キーごとのレート制限内で送る。
+    扱う商品はconfigのproduct_id,symbolで指定する。他の商品はfor_productで、セッションとスケジューラを共有するインスタンスを作る。
     """
-    def __init__(self,config,logger):
+    def __init__(self,config,logger,clock_sync=None):
         """
         :param config:コンフィグインスタンス。apiキーを保持。
         :param logger:ロガーインスタンス。
+        :param clock_sync:ClockSync。指定した場合、レスポンスのDateヘッダで取引所との時刻のずれの推定に使う。
         """
         self.config = config
+        self.clock_sync = clock_sync
         self.logger = logger
-        self.symbol = 'BTC/JPY'
-        self.product_id = 5
         self.try_num = 3
         self.tz = timezone(timedelta(hours=+9), 'Asia/Tokyo')
-        self.last_closed_pnl_timestamp = datetime.now(self.tz).timestamp()
+        self.order_sync_interval = self.config.get("order_sync_interval",10)
+        # ポジション台帳と/trades/の突き合わせ間隔(秒)。0の場合は突き合わせない。
+        self.position_sync_interval = self.config.get("position_sync_interval",60)
+        self._init_product(self.config.get("product_id",5),self.config.get("symbol",'BTC/JPY'))
+        self.trade_page_limit = self.config.get("trade_page_limit",100)
+        self.trade_sync_max_pages = self.config.get("trade_sync_max_pages",20)
+        # 決済済みトレードの同期で前回同期時刻から遡る秒数。反映の遅れたトレードを拾い、重複はトレードidで除く。
+        self.trade_sync_overlap = self.config.get("trade_sync_overlap",60)
+        # 集計済みの決済済みトレードidを覚えておく件数の上限
+        self.closed_trade_id_max = self.config.get("closed_trade_id_max",10000)
+        # 約定がなくてもopen状態のトレードを取得し直す間隔(秒)。未実現損益の更新に使う。
+        self.open_trade_full_sync_interval = self.config.get("open_trade_full_sync_interval",60)
         """self.ccxt_api = []
         for key01,key02 in self.config["liquid_api_keys_for_ccxt"]:
             ccxt_api = ccxt.liquid()
@@ -37,7 +57,58 @@ class LiquidRestApi():
         self.liquid_api_key = []
         for key01,key02 in self.config["liquid_api_keys"]:
             self.liquid_api_key.append([key01,key02])
-        self._api_key_index = 0
+        # キーごとに最後に使ったnonce。同じ時刻が続いても単調増加させる。
+        self._last_nonce = [0] * len(self.liquid_api_key)
+
+        # apiキーごとに永続セッションを持つ
+        pool_config = self.config.get("liquid_session_pool",{})
+        self.session_pool = LiquidSessionPool(
+            len(self.liquid_api_key),
+            logger,
+            pool_size=pool_config.get("pool_size",4),
+            connect_timeout=pool_config.get("connect_timeout",3.05),
+            read_timeout=pool_config.get("read_timeout",10),
+            warm_up=pool_config.get("warm_up",True),
+            warm_up_path=f"/products/{self.product_id}",
+            )
+        # private apiの送信スケジューラ。apiキーごとに1スレッドで、キーのnonceの順序を保つ。
+        self.scheduler = RequestScheduler(len(self.liquid_api_key),logger,**self.config.get("liquid_rate_limit",{}))
+
+    def _init_product(self,product_id,symbol):
+        """
+        商品ごとの状態(注文索引、トレード台帳、ポジション台帳)を初期化する。
+        """
+        self.product_id = product_id
+        self.symbol = symbol
+        self.last_closed_pnl_timestamp = datetime.now(self.tz).timestamp()
+        self._closed_trades_since = self.last_closed_pnl_timestamp
+
+        # トレード台帳。open状態のトレードをid索引で保持し、closedは前回同期時刻以降の差分のみ取得する。
+        self.open_trades = {}
+        self.trade_position = 0
+        self.trade_open_pnl = 0
+        self._counted_closed_trade_ids = OrderedDict()
+        self._open_trades_synced_at = float("-inf")
+
+        # 自分の注文の索引。発注・キャンセルのレスポンスで更新し、バックグラウンドで/orders/と突き合わせる。
+        self.order_index = LiquidOrderIndex(max_orders=self.config.get("order_index_max_orders",1000))
+        self.order_sync_thread = None
+        self._order_sync_stop = Event()
+
+        # 約定ごとに更新するポジション台帳。注文索引の更新で約定を検出し、/trades/と定期的に突き合わせる。
+        self.position_ledger = PositionLedger(self.logger,product_id=product_id)
+        self.order_index.subscribe(self.position_ledger.on_order)
+
+    def for_product(self,product_id,symbol):
+        """
+        別の商品を扱うインスタンスを返す。
+        apiキー、セッション、送信スケジューラ、nonceは共有し、注文索引、トレード台帳、ポジション台帳は商品ごとに持つ。
+        :param product_id:商品id。ETH/JPYなら29など。
+        :param symbol:'ETH/JPY'などの通貨ペア
+        """
+        rest = copy.copy(self)
+        rest._init_product(product_id,symbol)
+        return rest
 
     def _log_error(self,message):
         self.logger.error(f"[LiquidRestApi]{message}")
@@ -45,19 +116,13 @@ class LiquidRestApi():
     def _log_info(self,message):
         self.logger.info(f"[LiquidRestApi]{message}")
 
-    def _api_key(self):
-        """
-        次に使用するapiキーを返す。
-        """
-        self._api_key_index = self._api_key_index + 1 if self._api_key_index + 1 < len(self.liquid_api_key) else 0
-        return self.liquid_api_key[self._api_key_index]
-    
-    def _create_request_param(self,path,query):
+    def _create_request_param(self,path,query,key_index):
         url = 'https://api.liquid.com' + path + query
-        token,secret = self._api_key()
-        timestamp = datetime.now(self.tz).timestamp()
+        token,secret = self.liquid_api_key[key_index]
+        timestamp = max(datetime.now(self.tz).timestamp(),self._last_nonce[key_index] + 1e-6)
+        self._last_nonce[key_index] = timestamp
         payload = {
-            "path": path,
+            "path": path + query,
             "nonce": timestamp,
             "token_id": token
         }
@@ -69,6 +134,47 @@ class LiquidRestApi():
         }
         return headers,url
 
+    def _send(self,method,path,query,data,key_index):
+        """
+        署名して送信する。RequestSchedulerのワーカーから呼ばれ、1つのキーは1スレッドからのみ使われる。
+        レート制限はRateLimitError、nonceエラーはNonceErrorを送出し、スケジューラがキーを止めて再送する。
+        """
+        sign_start = time.perf_counter()
+        headers,url = self._create_request_param(path,query,key_index)
+        http_start = time.perf_counter()
+        latency_metrics.record("rest_sign",http_start - sign_start)
+        sent_at = time.time()
+        res = self.session_pool.request(method,url,key_index,headers=headers,data=data)
+        latency_metrics.record_since("rest_http",http_start)
+        if self.clock_sync is not None:
+            self.clock_sync.add_http_date(res.headers.get("Date"),sent_at,time.time())
+        if res.status_code == 429:
+            raise RateLimitError(res.text)
+        if res.status_code == 401 and "nonce" in res.text.lower():
+            raise NonceError(res.text)
+        return res.json()
+
+    def _submit_private_request(self,method,path,query='',data=None,priority=PRIORITY_QUERY):
+        """
+        private apiの呼び出しをスケジューラに登録する。
+        :param priority:PRIORITY_CANCEL,PRIORITY_ORDER,PRIORITY_QUERYのいずれか
+        :return: レスポンスのjsonを結果に持つFuture
+        """
+        return self.scheduler.submit(priority,lambda key_index:self._send(method,path,query,data,key_index))
+
+    def _private_request(self,method,path,query='',data=None,priority=PRIORITY_QUERY):
+        """
+        private apiを呼び出し、結果を待つ。
+        :return: レスポンスのjson
+        """
+        return self._submit_private_request(method,path,query,data,priority).result()
+
+    def get_connection_stats(self):
+        """
+        接続の新規作成数と再利用数を返す。
+        """
+        return self.session_pool.get_stats()
+
     def _to_my_order_format(self,order):
         return {
                 "id": order["id"],
@@ -84,7 +190,7 @@ class LiquidRestApi():
 
     def get_ticker(self):
         url = f"https://api.liquid.com/products/{self.product_id}"
-        res = requests.get(url).json()
+        res = self.session_pool.request("GET",url).json()
         ticker = {
             "timestamp":float(res["timestamp"]),
             "ltp":float(res["last_traded_price"]),
@@ -98,9 +204,6 @@ class LiquidRestApi():
         return ticker
 
     def market_order(self,quantity):
-        path = '/orders/'
-        query = ''
-        headers,url = self._create_request_param(path,query)
         side = "buy" if quantity > 0 else "sell"
         data = {
             "order":{
@@ -118,8 +221,10 @@ class LiquidRestApi():
 
         for _ in range(self.try_num):
             try:
-                res = requests.post(url, headers=headers, data=json_data).json()
-                return self._to_my_order_format(res)
+                res = self._private_request("POST",'/orders/',data=json_data,priority=PRIORITY_ORDER)
+                order = self._to_my_order_format(res)
+                self.order_index.update(order)
+                return order
             except Exception as e:
                 break
                 self.logger.error(f"error in {sys._getframe().f_code.co_name}.{e}")
@@ -129,10 +234,6 @@ class LiquidRestApi():
 
     # 指値注文する関数
     def limit_order(self,quantity,price):
-        path = '/orders/'
-        query = ''
-        headers,url = self._create_request_param(path,query)
-
         side = "buy" if quantity > 0 else "sell"
         data = {
             "order":{
@@ -151,8 +252,10 @@ class LiquidRestApi():
 
         for _ in range(self.try_num):
             try:
-                res = requests.post(url, headers=headers, data=json_data).json()
-                return self._to_my_order_format(res)
+                res = self._private_request("POST",'/orders/',data=json_data,priority=PRIORITY_ORDER)
+                order = self._to_my_order_format(res)
+                self.order_index.update(order)
+                return order
             except Exception as e:
                 self.logger.error(f"error in {sys._getframe().f_code.co_name}.{e}")
                 self.logger.error(traceback.format_exc())
@@ -166,16 +269,14 @@ class LiquidRestApi():
         """
         for _ in range(self.try_num):
             try:
-                path = '/orders/'
-                query = ''
-                headers,url = self._create_request_param(path,query)
-                res = requests.get(url, headers=headers).json()
+                fetch_started_at = time.monotonic()
+                res = self._private_request("GET",'/orders/',f"?product_id={self.product_id}")
+                orders = [order for order in map(self._to_my_order_format,res["models"])]
+                self.order_index.reconcile(orders,fetch_started_at)
                 if status is None:
-                    orders = [order for order in map(self._to_my_order_format,res["models"])]
                     return orders
                 else:
-                    orders = [order for order in map(self._to_my_order_format,res["models"]) if order["status"]==status]
-                    return orders
+                    return [order for order in orders if order["status"]==status]
             except Exception as e:
                 self.logger.error(f"error in {sys._getframe().f_code.co_name}.{e}")
                 self.logger.error(traceback.format_exc())
@@ -183,33 +284,135 @@ class LiquidRestApi():
         raise Exception("over try_num.")
 
     def get_order(self,order_id):
-        orders = self.get_orders()
-        for order in orders:
-            if order['id'] == order_id:
-                return self._to_my_order_format(order)
+        """
+        注文を返す。注文索引に無い場合のみ/orders/を取得する。
+        """
+        order = self.order_index.get(order_id)
+        if order is not None:
+            return order
+        self.get_orders()
+        order = self.order_index.get(order_id)
+        if order is not None:
+            return order
         raise Exception("no such order.")
 
+    def get_local_orders(self,status=None,side=None):
+        """
+        注文索引から条件に合う注文を返す。apiは呼ばない。
+        :param status:liveなど。Noneの場合は条件にしない。
+        :param side:buyかsell。Noneの場合は条件にしない。
+        """
+        return self.order_index.get_orders(status=status,side=side)
+
+    def start_order_sync(self):
+        """
+        注文索引と/orders/、ポジション台帳と/trades/の突き合わせをバックグラウンドで開始する。
+        """
+        if self.order_sync_thread is not None:return
+        self._order_sync_stop.clear()
+        self.order_sync_thread = Thread(target=self._order_sync_loop)
+        self.order_sync_thread.daemon = True
+        self.order_sync_thread.start()
+
+    def stop_order_sync(self):
+        if self.order_sync_thread is None:return
+        self._order_sync_stop.set()
+        self.order_sync_thread.join()
+        self.order_sync_thread = None
+
+    def _order_sync_loop(self):
+        last_position_sync = None
+        while True:
+            # ポジション台帳は開始直後に1度突き合わせ、既存のポジションを反映する
+            now = time.monotonic()
+            if self.position_sync_interval > 0 and (last_position_sync is None or now - last_position_sync >= self.position_sync_interval):
+                last_position_sync = now
+                try:
+                    self.reconcile_position()
+                except Exception as e:
+                    self._log_error(f"position sync failed.{e}")
+            if self._order_sync_stop.wait(self.order_sync_interval):return
+            try:
+                self.get_orders()
+            except Exception as e:
+                self._log_error(f"order sync failed.{e}")
+
     # 注文をキャンセルする。
-    def cancel_order(self,order_id):
+    def _cancel_result(self,future):
         try:
-            path = f'/orders/{order_id}/cancel'
-            query = ""
-            headers,url = self._create_request_param(path,query)
-            res = requests.put(url, headers=headers).json()
-            return self._to_my_order_format(res)
+            order = self._to_my_order_format(future.result())
+            self.order_index.update(order)
+            return order
         except Exception as e:
             # 約定済みのケース
             return None
 
-    def cancel_all_orders(self):
+    def cancel_order(self,order_id):
+        return self._cancel_result(self._submit_private_request("PUT",f'/orders/{order_id}/cancel',priority=PRIORITY_CANCEL))
+
+    def cancel_orders(self,order_ids):
+        """
+        複数の注文のキャンセルを最優先でまとめて登録し、空いているキーから並列に送る。
+        :param order_ids:キャンセルする注文idのリスト
+        :return: 注文idをキーとした結果の辞書。resultはcancelledかfailed(約定済みなど)。
         """
-        全ての注文をキャンセルする。
+        futures = [(order_id,self._submit_private_request("PUT",f'/orders/{order_id}/cancel',priority=PRIORITY_CANCEL)) for order_id in order_ids]
+        results = {}
+        for order_id,future in futures:
+            order = self._cancel_result(future)
+            results[order_id] = {
+                "result":"cancelled" if order is not None and order["status"] == "cancelled" else "failed",
+                "order":order,
+                }
+        return results
+
+    def edit_order(self,order_id,quantity,price):
+        """
+        板に載っている注文の数量と価格をその場で変更する。キャンセルして新規発注するより往復が1回少なく、板から注文が消えない。
+        :param quantity:変更後の数量。符号は無視する(売買方向は変えられない)。
+        :param price:変更後の価格
+        :return: 変更後の注文。約定済み・キャンセル済みで変更できなかった場合はNone。
+            それ以外の理由(タイムアウト、5xx、レート制限など)で失敗し、注文がliveのまま残っている場合は例外を送出する。
+        """
+        data = {
+            "order":{
+            "quantity":abs(quantity),
+            "price":price,
+            }
+        }
+        try:
+            res = self._private_request("PUT",f'/orders/{order_id}',data=json.dumps(data),priority=PRIORITY_ORDER)
+            order = self._to_my_order_format(res)
+        except Exception as e:
+            self._log_error(f"edit_order failed.id={order_id}.{e}")
+            # 失敗の理由はレスポンスからは区別しにくいため、/orders/で注文の状態を確認する
+            self.get_orders()
+            order = self.order_index.get(order_id)
+            if order is None or order["status"] != "live":
+                return None
+            raise
+        self.order_index.update(order)
+        if order["status"] != "live":
+            return None
+        return order
+
+    def cancel_all_orders(self,side=None,min_price=None,max_price=None):
+        """
+        全ての注文をキャンセルする。条件を指定した場合は条件に合う注文のみキャンセルする。
+        :param side:buyかsell。Noneの場合は両方。
+        :param min_price:この価格以上の注文をキャンセルする。
+        :param max_price:この価格以下の注文をキャンセルする。
+        :return: cancel_ordersの結果
         """
         try:
-            orders = self.get_orders(status="open")
+            orders = self.get_orders(status="live")
+            order_ids = []
             for order in orders:
-                self.cancel_order(order["id"])
-            return
+                if side is not None and order["side"] != side:continue
+                if min_price is not None and order["price"] < min_price:continue
+                if max_price is not None and order["price"] > max_price:continue
+                order_ids.append(order["id"])
+            return self.cancel_orders(order_ids)
         except Exception as e:
             self.logger.error(f"error in {sys._getframe().f_code.co_name}.{e}")
             self.logger.error(traceback.format_exc())
@@ -217,12 +420,12 @@ class LiquidRestApi():
 
     # 全ポジションを決済
     def position_close_all(self):
+        """
+        全てのポジションを決済する。取引所のapiは商品を指定できないため、全ての商品のポジションが対象になる。
+        """
         for _ in range(self.try_num):
             try:
-                path = '/trades/close_all/'
-                query = ''
-                headers,url = self._create_request_param(path,query)
-                res = requests.put(url, headers=headers).json()
+                res = self._private_request("PUT",'/trades/close_all/',priority=PRIORITY_ORDER)
                 return res
             except Exception as e:
                 self.logger.error(f"error in {sys._getframe().f_code.co_name}.{e}")
@@ -236,10 +439,7 @@ class LiquidRestApi():
         """
         for _ in range(self.try_num):
             try:
-                path = '/fiat_accounts/'
-                query = ''
-                headers,url = self._create_request_param(path,query)
-                res = requests.get(url, headers=headers).json()
+                res = self._private_request("GET",'/fiat_accounts/')
                 return res
             except Exception as e:
                 self.logger.error(f"error in {sys._getframe().f_code.co_name}.{e}")
@@ -250,10 +450,7 @@ class LiquidRestApi():
     def get_trades(self):
         for _ in range(self.try_num):
             try:
-                path = '/trades/'
-                query = ''
-                headers,url = self._create_request_param(path,query)
-                res = requests.get(url, headers=headers).json()
+                res = self._private_request("GET",'/trades/')
                 ret = [trade for trade in res["models"] if trade["product_id"] == self.product_id]
                 return ret
             except Exception as e:
@@ -281,39 +478,143 @@ class LiquidRestApi():
             self.logger.error(traceback.format_exc())
             raise e
 
-    def get_position_and_open_closed_pnl(self):
+    def _get_trades_page(self,status,page):
+        """
+        トレード一覧を1ページ分取得する。
+        :return: 対象プロダクトのトレードのリスト、総ページ数
+        """
+        query = f"?status={status}&limit={self.trade_page_limit}&page={page}"
+        for _ in range(self.try_num):
+            try:
+                res = self._private_request("GET",'/trades/',query)
+                trades = [trade for trade in res["models"] if trade["product_id"] == self.product_id]
+                return trades,res.get("total_pages",1)
+            except Exception as e:
+                self.logger.error(f"error in {sys._getframe().f_code.co_name}.{e}")
+                self.logger.error(traceback.format_exc())
+                time.sleep(1)
+        raise Exception("over try_num.")
+
+    def _trade_position(self,trade):
+        if trade["side"] == "long":
+            return float(trade["open_quantity"])
+        elif trade["side"] == "short":
+            return -float(trade["open_quantity"])
+        return 0
+
+    def _sync_open_trades(self,force=False):
+        """
+        open状態のトレードを取得し、トレードid索引を更新する。
+        ポジションと未実現損益は変化のあったトレード分だけ加減算する。
+        前回の取得以降にポジション台帳が約定を検出しておらず、open_trade_full_sync_interval秒経っていない場合は取得しない。
+        :param force:Trueの場合は常に取得する。決済済みのトレードが見つかった場合など。
+        """
+        now = time.monotonic()
+        if not force and self.position_ledger.last_fill_at < self._open_trades_synced_at and now - self._open_trades_synced_at < self.open_trade_full_sync_interval:
+            return
+        trades = []
+        page = 1
+        while True:
+            models,total_pages = self._get_trades_page("open",page)
+            trades += models
+            if page >= total_pages or len(models) == 0:break
+            page += 1
+        self._open_trades_synced_at = now
+        open_trades = {trade["id"]:trade for trade in trades}
+        for trade_id in list(self.open_trades.keys()):
+            if trade_id not in open_trades:
+                old = self.open_trades.pop(trade_id)
+                self.trade_position -= self._trade_position(old)
+                self.trade_open_pnl -= float(old["open_pnl"])
+        for trade_id,trade in open_trades.items():
+            old = self.open_trades.get(trade_id)
+            if old is not None:
+                if old["updated_at"] == trade["updated_at"] and old["open_pnl"] == trade["open_pnl"]:continue
+                self.trade_position -= self._trade_position(old)
+                self.trade_open_pnl -= float(old["open_pnl"])
+            self.open_trades[trade_id] = trade
+            self.trade_position += self._trade_position(trade)
+            self.trade_open_pnl += float(trade["open_pnl"])
+
+    def _sync_closed_trades(self):
+        """
+        前回同期以降に決済されたトレードをページングして取得し、実現損益を集計する。
+        並び順には依存せず、集計済みのトレードidで重複を除く。
+        前回同期時刻(trade_sync_overlap秒前から)より後に更新されたトレードがなく、
+        前回同期時にopenだったトレード以降に建てたトレードもないページまで取得する。
+        trade_sync_max_pagesを超えた場合は、取得していないページがあるため同期時刻を進めない。
+        :return: 前回同期以降の実現損益、集計したトレード数
+        """
+        closed_pnl = 0
+        count = 0
+        cursor = max(self._closed_trades_since,self.last_closed_pnl_timestamp - self.trade_sync_overlap)
+        # 前回同期時にopenだったトレードは、建てた時刻が古くても今回決済されている可能性がある
+        threshold = min([cursor] + [trade["created_at"] for trade in self.open_trades.values()])
+        next_cursor = self.last_closed_pnl_timestamp
+        page = 1
+        while page <= self.trade_sync_max_pages:
+            models,total_pages = self._get_trades_page("closed",page)
+            reached_cursor = True
+            for trade in models:
+                if trade["updated_at"] >= cursor or trade["created_at"] >= threshold:
+                    reached_cursor = False
+                if trade["updated_at"] < cursor:continue
+                if trade["id"] in self._counted_closed_trade_ids:continue
+                self._counted_closed_trade_ids[trade["id"]] = None
+                closed_pnl += float(trade["pnl"])
+                count += 1
+                next_cursor = max(next_cursor,trade["updated_at"])
+            if reached_cursor or page >= total_pages or len(models) == 0:break
+            page += 1
+        else:
+            self._log_error(f"closed trades exceed {self.trade_sync_max_pages} pages. cursor is not advanced.")
+            next_cursor = self.last_closed_pnl_timestamp
+        while len(self._counted_closed_trade_ids) > self.closed_trade_id_max:
+            self._counted_closed_trade_ids.popitem(last=False)
+        self.last_closed_pnl_timestamp = next_cursor
+        return closed_pnl,count
+
+    def _trade_average_price(self):
+        """
+        open状態のトレードの建値を、売買方向で符号を付けた数量で加重平均する。
+        ロングとショートが両建ての場合も、ネットのポジションの平均建値になる。
+        """
+        position = sum(self._trade_position(trade) for trade in self.open_trades.values())
+        if position == 0:return 0
+        return sum(float(trade["open_price"]) * self._trade_position(trade) for trade in self.open_trades.values()) / position
+
+    def reconcile_position(self):
+        """
+        /trades/のポジション・実現損益とポジション台帳を突き合わせる。
+        get_position_and_open_closed_pnlの実現損益(前回からの差分)を台帳に渡すため、突き合わせを行う場合はbotから直接呼ばないこと。
+        :return: ポジションのずれ、実現損益のずれ
+        """
+        fetch_started_at = time.monotonic()
+        # 台帳が見逃した約定はlast_fill_atに現れないため、open状態のトレードは常に取得し直す
+        position,_,closed_pnl = self.get_position_and_open_closed_pnl(force=True)
+        return self.position_ledger.reconcile(position,self._trade_average_price(),closed_pnl,fetch_started_at)
+
+    def get_position_and_open_closed_pnl(self,force=False):
         """
         ポジションと実現損益、未実現損益を返す。
         実現損益は前回実行時からの差分を返す。
         初回実行時はinit時からの差分を返す。
-        実行間隔が空きすぎると正確な情報は取れなくなる。
+        前回実行時以降に決済されたトレードのみを取得するため、実行間隔が空いてもページングで取りこぼさない。
+        open状態のトレードは、ポジション台帳が約定を検出した時、決済されたトレードがあった時、open_trade_full_sync_interval秒ごとにのみ取得し直す。
+        それ以外はポジション・未実現損益が最大open_trade_full_sync_interval秒古く、台帳が見逃した約定はその間反映されない。
+        :param force:Trueの場合はopen状態のトレードを常に取得し直す
         :return: ポジション、未実現損益、実現損益
         """
         try:
-            trades = self.get_trades()
-            position = 0
-            closed_pnl = 0
-            open_pnl = 0
-            next_lastest_timestamp = self.last_closed_pnl_timestamp
-            for trade in trades:
-                if trade["status"] == "open":
-                    open_pnl += float(trade["open_pnl"])
-                    if trade["side"] == "long":
-                        position += float(trade["open_quantity"])
-                    elif trade["side"] == "short":
-                        position -= float(trade["open_quantity"])
-                elif trade["status"] == "closed":
-                        if self.last_closed_pnl_timestamp < trade["updated_at"]:
-                            next_lastest_timestamp = max(next_lastest_timestamp,trade["updated_at"])
-                            closed_pnl += float(trade["pnl"])
-            self.last_closed_pnl_timestamp = next_lastest_timestamp
-            return position,open_pnl,closed_pnl
+            # 決済済みを先に取得する。間に決済されたトレードは次回のclosedで集計される。
+            closed_pnl,count = self._sync_closed_trades()
+            self._sync_open_trades(force=force or count > 0)
+            return self.trade_position,self.trade_open_pnl,closed_pnl
         except Exception as e:
             self.logger.error(f"error in {sys._getframe().f_code.co_name}.{e}")
             self.logger.error(traceback.format_exc())
             raise e
 
-
 if __name__=='__main__':
     import logging
     current_dir=os.path.dirname(__file__)
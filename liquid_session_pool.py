@@ -0,0 +1,93 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+class LiquidSessionPool():
+    """
+    LiquidのRestApiに対する永続的なhttpセッション(keep-alive)を管理する。
+    apiキーごとにセッションを1つ持ち、public api用のセッションを別に1つ持つ。
+    接続を使い回すことで、発注・キャンセルのたびにTCP+TLS接続を張り直すコストを省く。
+    接続の新規作成数と再利用数をカウントする。
+    """
+    base_url = 'https://api.liquid.com'
+
+    def __init__(self,key_num,logger,pool_size=4,connect_timeout=3.05,read_timeout=10,warm_up=True,warm_up_path='/products/5'):
+        """
+        :param key_num:apiキーの数。キーごとにセッションを作る。
+        :param logger:ロガーインスタンス。
+        :param pool_size:セッションごとに保持する接続数の上限。同時に発行するリクエスト数に合わせる。
+        :param connect_timeout:接続タイムアウト(秒)。
+        :param read_timeout:読み込みタイムアウト(秒)。
+        :param warm_up:Trueの場合、生成時に全セッションの接続を確立しておく。
+        :param warm_up_path:ウォームアップ時にアクセスするpublic apiのパス。
+        """
+        self.logger = logger
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout,read_timeout)
+        self.warm_up_path = warm_up_path
+        self.sessions = [self._create_session() for _ in range(key_num)]
+        self.public_session = self._create_session()
+        if warm_up:
+            self.warm_up()
+
+    def _log_error(self,message):
+        self.logger.error(f"[LiquidSessionPool]{message}")
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,pool_maxsize=self.pool_size)
+        session.mount('https://',adapter)
+        return session
+
+    def _all_sessions(self):
+        return self.sessions + [self.public_session]
+
+    def get_session(self,key_index=None):
+        """
+        apiキーに対応するセッションを返す。key_indexがNoneの場合はpublic api用のセッションを返す。
+        """
+        if key_index is None:
+            return self.public_session
+        return self.sessions[key_index]
+
+    def request(self,method,url,key_index=None,**kwargs):
+        """
+        セッションを使ってリクエストを送る。タイムアウトが指定されていなければデフォルト値を使う。
+        :return: requests.Response
+        """
+        kwargs.setdefault("timeout",self.timeout)
+        return self.get_session(key_index).request(method,url,**kwargs)
+
+    def warm_up(self):
+        """
+        全セッションでpublic apiにアクセスし、TCP+TLS接続を確立しておく。
+        """
+        for session in self._all_sessions():
+            try:
+                session.get(self.base_url + self.warm_up_path,timeout=self.timeout)
+            except Exception as e:
+                self._log_error(f"warm up failed.{e}")
+
+    def get_stats(self):
+        """
+        接続の利用状況を返す。
+        requests:送ったリクエスト数
+        new_connections:新規に確立した接続数
+        reused_connections:既存の接続を再利用したリクエスト数
+        """
+        request_num = 0
+        new_connections = 0
+        for session in self._all_sessions():
+            pools = session.get_adapter(self.base_url).poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                request_num += pool.num_requests
+                new_connections += pool.num_connections
+        return {
+            "requests":request_num,
+            "new_connections":new_connections,
+            "reused_connections":request_num - new_connections,
+            }
+
+    def close(self):
+        for session in self._all_sessions():
+            session.close()
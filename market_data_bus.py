@@ -0,0 +1,293 @@
+import time
+from threading import Lock
+from multiprocessing import shared_memory,resource_tracker
+import numpy as np
+from liquid_message import Ticker,BookSnapshot
+from ohlcv_aggregator import OHLCV_DTYPE
+from tick_recorder import BOOK_LEVELS,book_dtype
+
+DEFAULT_NAME = "simple_mm_bot_market_data"
+MAX_RESOLUTIONS = 8
+
+# 共有メモリの先頭に置くレイアウト情報。読み手はこれを読んで本体のレイアウトを組み立てる。
+HEADER_DTYPE = np.dtype([
+    ("product_id",np.int64),
+    ("resolution_num",np.int64),
+    ("resolutions",np.int64,(MAX_RESOLUTIONS,)),
+    ("length",np.int64),
+    ("book_levels",np.int64),
+    ("depth_num",np.int64),
+    ])
+
+def _body_dtype(resolution_num,length,book_levels,depth_num):
+    return np.dtype([
+        ("seq",np.uint64),
+        ("last_receive_monotonic",np.float64),
+        ("ticker",np.float64,(len(Ticker._fields),)),
+        ("book_timestamp",np.float64),
+        ("book_asks",np.float64,(depth_num,)),
+        ("book_bids",np.float64,(depth_num,)),
+        ("levels",book_dtype(book_levels)),
+        ("ohlcv_count",np.int64,(resolution_num,)),
+        ("ohlcv",OHLCV_DTYPE,(resolution_num,length)),
+        ])
+
+def _size(body_dtype):
+    return HEADER_DTYPE.itemsize + body_dtype.itemsize
+
+class MarketDataPublisher():
+    """
+    LiquidRealtimeApiが受信した最新のTicker、板、ローソク足を共有メモリに書き込む。
+    1つのプロセスだけがwebsocketに接続してデコードし、同じホストの他のbotプロセスはMarketDataReaderで読む。
+    書き込みはseqlock方式。書き込み中はseqを奇数にし、書き終えたら偶数にする。
+    realtimeの通知は受信スレッド、補完のスレッド、張り替え中の複数の接続から同時に来るため、書き込みはロックで1つずつ行う。
+    """
+    def __init__(self,realtime,name=DEFAULT_NAME,product_id=None,ohlcv_resolutions=(1,60),ohlcv_length=600,book_levels=BOOK_LEVELS,takeover=False):
+        """
+        :param realtime:LiquidRealtimeApi。開始済みのもの。
+        :param name:共有メモリの名前
+        :param product_id:書き込む商品。Noneの場合はrealtimeの最初の商品。
+        :param ohlcv_resolutions:書き込むローソク足の長さ(秒)のリスト。realtimeで作っているもの。
+        :param ohlcv_length:書き込むローソク足の本数
+        :param book_levels:書き込む板の片側の段数
+        :param takeover:同じ名前の共有メモリが既にある場合に削除して作り直す。前回異常終了した時の領域が残っている場合に指定する。
+            動いているpublisherの領域も削除するため、そのpublisherが止まっていることを確認してから指定すること。
+        """
+        if len(ohlcv_resolutions) > MAX_RESOLUTIONS:
+            raise ValueError(f"ohlcv_resolutions must be at most {MAX_RESOLUTIONS}.")
+        self.realtime = realtime
+        self.product_id = product_id
+        self.ohlcv_resolutions = list(ohlcv_resolutions)
+        self.ohlcv_length = ohlcv_length
+        self.book_levels = book_levels
+        depth_num = 1 + len(realtime.get_order_book(product_id).depth_sizes)
+        body_dtype = _body_dtype(len(ohlcv_resolutions),ohlcv_length,book_levels,depth_num)
+        try:
+            self.shm = shared_memory.SharedMemory(name=name,create=True,size=_size(body_dtype))
+        except FileExistsError:
+            if not takeover:
+                raise FileExistsError(f"shared memory {name} already exists. another publisher may be running. set takeover=True to replace it.")
+            old = shared_memory.SharedMemory(name=name)
+            old.close()
+            old.unlink()
+            self.shm = shared_memory.SharedMemory(name=name,create=True,size=_size(body_dtype))
+        header = np.ndarray((),dtype=HEADER_DTYPE,buffer=self.shm.buf)
+        header["product_id"] = -1 if product_id is None else product_id
+        header["resolution_num"] = len(ohlcv_resolutions)
+        header["resolutions"][:len(ohlcv_resolutions)] = ohlcv_resolutions
+        header["length"] = ohlcv_length
+        header["book_levels"] = book_levels
+        header["depth_num"] = depth_num
+        self.body = np.ndarray((),dtype=body_dtype,buffer=self.shm.buf,offset=HEADER_DTYPE.itemsize)
+        self.body["ticker"][:] = np.nan
+        self.body["book_timestamp"] = np.nan
+        self.seq = np.ndarray((1,),dtype=np.uint64,buffer=self.shm.buf,offset=HEADER_DTYPE.itemsize)
+        # 前回書き込んだ時の各時間足の本数、最新足のタイムスタンプ、過去の足を直した回数
+        self.last_bars = [(0,None,0)] * len(ohlcv_resolutions)
+        self.last_book_timestamp = None
+        self.closed = False
+        self.lock = Lock()
+        realtime.subscribe(self._on_update)
+        self.publish()
+
+    def _on_update(self,channel,record,product_id=None):
+        if self.closed:return
+        if self.product_id is not None and product_id != self.product_id:return
+        self.publish()
+
+    def publish(self):
+        """
+        最新のデータを書き込む。realtimeの受信スレッドから呼ばれる。
+        板は前回から更新があった時のみ書く。板の受信は通知されないため、次のTicker・約定の受信時に反映される。
+        ローソク足は新しい足ができた時と過去の足が直された時のみ全体を書き、それ以外は直近2本のみ書く。
+        """
+        with self.lock:
+            if self.closed:return
+            self._publish()
+
+    def _publish(self):
+        realtime = self.realtime
+        body = self.body
+        ticker = realtime.get_ticker(self.product_id)
+        order_book = realtime.get_order_book(self.product_id)
+        book = None
+        if order_book.timestamp != self.last_book_timestamp:
+            self.last_book_timestamp = order_book.timestamp
+            book = realtime.get_book(self.product_id)
+            ask_price,ask_size = order_book.get_levels("asks",self.book_levels)
+            bid_price,bid_size = order_book.get_levels("bids",self.book_levels)
+        bars = [realtime.get_ohlcv(self.ohlcv_length,resolution,self.product_id) for resolution in self.ohlcv_resolutions]
+        revisions = [realtime.get_ohlcv_revision(resolution,self.product_id) for resolution in self.ohlcv_resolutions]
+
+        self.seq[0] += 1
+        body["last_receive_monotonic"] = realtime.last_receive_monotonic
+        if ticker is not None:
+            body["ticker"][:] = ticker
+        if book is not None:
+            body["book_timestamp"] = book.timestamp
+            body["book_asks"][:] = book.asks
+            body["book_bids"][:] = book.bids
+            levels = body["levels"]
+            levels["timestamp"] = order_book.timestamp
+            levels["ask_price"][:] = ask_price
+            levels["ask_size"][:] = ask_size
+            levels["bid_price"][:] = bid_price
+            levels["bid_size"][:] = bid_size
+        for i,bar in enumerate(bars):
+            count = len(bar)
+            latest = bar[-1]["timestamp"] if count > 0 else None
+            if (count,latest,revisions[i]) == self.last_bars[i]:
+                start = max(0,count - 2)
+            else:
+                start = 0
+                self.last_bars[i] = (count,latest,revisions[i])
+            body["ohlcv"][i][start:count] = bar[start:]
+            body["ohlcv_count"][i] = count
+        self.seq[0] += 1
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.shm.close()
+        self.shm.unlink()
+
+class MarketDataReader():
+    """
+    MarketDataPublisherが書き込んだ共有メモリを読む。LiquidRealtimeApiと同じgetメソッドを持ち、BotBaseのrealtimeとして使える。
+    ロックは取らず、読む前後のseqが同じで偶数であることを確認し、書き込みと重なった場合は読み直す。
+    返り値は全て共有メモリからのコピー。
+    """
+    def __init__(self,name=DEFAULT_NAME,wait_timeout=30,poll_interval=0.001,read_timeout=1.0):
+        """
+        :param name:共有メモリの名前
+        :param wait_timeout:startで共有メモリが作られるのを待つ秒数
+        :param poll_interval:wait_for_updateで更新を確認する間隔(秒)
+        :param read_timeout:書き込み中の状態がこの秒数続いた場合は、publisherが書き込み中に止まったとみなして例外を送出する
+        """
+        self.name = name
+        self.read_timeout = read_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.shm = None
+        self.last_receive_perf = None
+
+    def start(self):
+        """
+        共有メモリに接続する。publisherがまだ作っていない場合はwait_timeout秒まで待つ。
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            try:
+                self.shm = shared_memory.SharedMemory(name=self.name)
+                break
+            except FileNotFoundError:
+                if time.monotonic() > deadline:raise
+                time.sleep(0.1)
+        # 読み手の終了時に共有メモリが削除されないよう、resource_trackerの管理から外す
+        resource_tracker.unregister(self.shm._name,"shared_memory")
+        header = np.ndarray((),dtype=HEADER_DTYPE,buffer=self.shm.buf)
+        resolution_num = int(header["resolution_num"])
+        self.resolutions = header["resolutions"][:resolution_num].tolist()
+        body_dtype = _body_dtype(resolution_num,int(header["length"]),int(header["book_levels"]),int(header["depth_num"]))
+        self.body = np.ndarray((),dtype=body_dtype,buffer=self.shm.buf,offset=HEADER_DTYPE.itemsize)
+        self.seq = np.ndarray((1,),dtype=np.uint64,buffer=self.shm.buf,offset=HEADER_DTYPE.itemsize)
+
+    def stop(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+    def _read(self,fn):
+        """
+        seqlockでfnの結果を読む。fnは共有メモリの値をコピーして返すこと。
+        書き込みと重なった場合は他のスレッドに譲ってから読み直し、read_timeout秒を超えたらTimeoutErrorを送出する。
+        """
+        deadline = None
+        while True:
+            seq = int(self.seq[0])
+            if not seq & 1:
+                value = fn(self.body)
+                if int(self.seq[0]) == seq:
+                    return value
+            if deadline is None:
+                deadline = time.monotonic() + self.read_timeout
+            elif time.monotonic() > deadline:
+                raise TimeoutError(f"market data bus {self.name} is being written for over {self.read_timeout}s.")
+            time.sleep(0)
+
+    @property
+    def update_seq(self):
+        return int(self.seq[0]) // 2
+
+    def wait_for_update(self,last_seq,timeout,coalesce=0):
+        """
+        LiquidRealtimeApi.wait_for_updateと同じ。共有メモリのseqをpoll_interval秒ごとに確認する。
+        """
+        deadline = time.monotonic() + timeout
+        while self.update_seq == last_seq:
+            if time.monotonic() >= deadline:
+                return self.update_seq
+            time.sleep(self.poll_interval)
+        if coalesce > 0:
+            time.sleep(max(0,min(coalesce,deadline - time.monotonic())))
+        return self.update_seq
+
+    def get_seconds_from_last_message(self):
+        """
+        publisherが最後にメッセージを受信してからの経過時間を返す。time.monotonicはホスト内のプロセスで共通。
+        """
+        return time.monotonic() - self._read(lambda body:float(body["last_receive_monotonic"]))
+
+    def get_ticker(self):
+        values = self._read(lambda body:body["ticker"].tolist())
+        if np.isnan(values[0]):return None
+        return Ticker(*values)
+
+    def get_book(self):
+        timestamp,asks,bids = self._read(lambda body:(float(body["book_timestamp"]),body["book_asks"].tolist(),body["book_bids"].tolist()))
+        if np.isnan(timestamp):return None
+        return BookSnapshot(timestamp,asks,bids)
+
+    def get_levels(self,side,n):
+        """
+        上位n段の価格と数量を返す。nはpublisherのbook_levels以下。
+        :param side:asksかbids
+        """
+        prefix = "ask" if side == "asks" else "bid"
+        return self._read(lambda body:(body["levels"][f"{prefix}_price"][:n].copy(),body["levels"][f"{prefix}_size"][:n].copy()))
+
+    def get_ohlcv(self,n,resolution=60):
+        """
+        直近n本のローソク足のコピーを返す。時系列順で、最新(未確定)の足が最後尾に入っている。
+        """
+        i = self.resolutions.index(resolution)
+        def read(body):
+            count = int(body["ohlcv_count"][i])
+            return body["ohlcv"][i][max(0,count - n):count].copy()
+        return self._read(read)
+
+
+if __name__=='__main__':
+    import os
+    import sys
+    from liquid_realtime_api import LiquidRealtimeApi
+    from setup_logger import setup_logger
+    if len(sys.argv) > 1 and sys.argv[1] == "reader":
+        reader = MarketDataReader()
+        reader.start()
+        for _ in range(5):
+            print(reader.get_ticker(),reader.get_ohlcv(1))
+            print(reader.get_book())
+            time.sleep(3)
+        reader.stop()
+    else:
+        logger = setup_logger(os.path.basename(__file__))
+        realtime = LiquidRealtimeApi(logger,ohlcv_resolutions=(1,60))
+        realtime.start()
+        publisher = MarketDataPublisher(realtime)
+        try:
+            while True:
+                time.sleep(10)
+        except KeyboardInterrupt:
+            publisher.close()
+            realtime.stop()
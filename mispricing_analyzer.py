@@ -0,0 +1,121 @@
+"""
+「n秒間に発生するk円の値動きはミスプライスであり、そのまたn秒後には元の価格に戻っている可能性が高い」という仮定を検証する。
+各時刻tについて、t-nからtの値動き(move)が|move|>=kのものをイベントとし、tからt+nの値動きのうちmoveと逆方向の大きさを戻り幅とする。
+戻り幅が|move|*reversion_ratio以上のイベントを「戻った」とみなす。
+HigeCatchBotのintervalがn、ema*alphaがkにおおよそ対応する。
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+def to_price_series(timestamps,prices,step=1.0,start=None,end=None):
+    """
+    約定を一定間隔の価格系列にする。各時刻の価格はその時刻以前の最終約定価格。
+    :param timestamps:約定のタイムスタンプの配列(時系列順)
+    :param prices:約定価格の配列
+    :param step:間隔(秒)
+    :return: 時刻の配列、価格の配列
+    """
+    timestamps = np.asarray(timestamps,dtype=np.float64)
+    prices = np.asarray(prices,dtype=np.float64)
+    start = timestamps[0] if start is None else start
+    end = timestamps[-1] if end is None else end
+    grid = np.arange(start,end + step,step)
+    idx = np.searchsorted(timestamps,grid,side="right") - 1
+    grid = grid[idx >= 0]
+    return grid,prices[idx[idx >= 0]]
+
+def analyze(prices,n,ks,reversion_ratio=0.5):
+    """
+    1つのnについて、全てのkの結果をまとめて計算する。
+    イベントを値動きの大きさでソートし、累積和を使ってk全体をベクトル演算で求める。
+    :param prices:一定間隔の価格系列
+    :param n:値動きを見る期間(系列のサンプル数)
+    :param ks:値動きの閾値(円)の配列
+    :param reversion_ratio:戻ったとみなす戻り幅の割合
+    :return: count(イベント数)、probability(戻った割合)、mean_reversion(平均戻り幅)、mean_move(平均値動き)の辞書。各値はksと同じ長さの配列。
+    """
+    prices = np.asarray(prices,dtype=np.float64)
+    ks = np.asarray(ks,dtype=np.float64)
+    if len(prices) <= 2 * n:
+        zeros = np.zeros(len(ks))
+        nans = np.full(len(ks),np.nan)
+        return {"count":zeros,"probability":nans,"mean_reversion":nans,"mean_move":nans}
+    move = prices[n:-n] - prices[:-2 * n]
+    after = prices[2 * n:] - prices[n:-n]
+    abs_move = np.abs(move)
+    reversion = -after * np.sign(move)
+
+    order = np.argsort(abs_move,kind="stable")
+    abs_move = abs_move[order]
+    reversion = reversion[order]
+    reverted = reversion >= abs_move * reversion_ratio
+
+    # 末尾からの累積和。suffix[i]はi番目以降(|move|の大きい側)の合計。
+    def suffix_sum(x):
+        return np.concatenate([np.cumsum(x[::-1])[::-1],[0.0]])
+    reversion_sum = suffix_sum(reversion)
+    reverted_sum = suffix_sum(reverted.astype(np.float64))
+    move_sum = suffix_sum(abs_move)
+
+    idx = np.searchsorted(abs_move,ks,side="left")
+    count = (len(abs_move) - idx).astype(np.float64)
+    with np.errstate(invalid="ignore",divide="ignore"):
+        return {
+            "count":count,
+            "probability":reverted_sum[idx] / count,
+            "mean_reversion":reversion_sum[idx] / count,
+            "mean_move":move_sum[idx] / count,
+            }
+
+_worker_prices = None
+
+def _init_worker(prices):
+    global _worker_prices
+    _worker_prices = prices
+
+def _analyze_worker(args):
+    n,ks,reversion_ratio = args
+    return analyze(_worker_prices,n,ks,reversion_ratio)
+
+def analyze_grid(prices,ns,ks,reversion_ratio=0.5,max_workers=None):
+    """
+    (n,k)の格子全体を計算する。nごとにプロセスプールへ分散する。
+    :param prices:一定間隔の価格系列
+    :param ns:値動きを見る期間(サンプル数)のリスト
+    :param ks:値動きの閾値(円)のリスト
+    :param reversion_ratio:戻ったとみなす戻り幅の割合
+    :param max_workers:プロセス数。1の場合はプロセスを使わずに計算する。
+    :return: n,k、および(len(ns),len(ks))の配列のcount,probability,mean_reversion,mean_moveの辞書
+    """
+    prices = np.asarray(prices,dtype=np.float64)
+    ks = np.asarray(ks,dtype=np.float64)
+    tasks = [(n,ks,reversion_ratio) for n in ns]
+    if max_workers == 1 or len(ns) == 1:
+        results = [analyze(prices,*task) for task in tasks]
+    else:
+        # 価格系列はワーカーの初期化時に1度だけ渡す
+        with ProcessPoolExecutor(max_workers=max_workers,initializer=_init_worker,initargs=(prices,)) as executor:
+            results = list(executor.map(_analyze_worker,tasks))
+    ret = {"n":np.asarray(ns),"k":ks}
+    for key in ["count","probability","mean_reversion","mean_move"]:
+        ret[key] = np.vstack([result[key] for result in results])
+    return ret
+
+
+if __name__=='__main__':
+    from tick_recorder import TickReader
+    if len(sys.argv) < 2:
+        print("usage: python mispricing_analyzer.py tick_dir [start_timestamp] [end_timestamp]")
+        sys.exit(1)
+    start = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    end = float(sys.argv[3]) if len(sys.argv) > 3 else None
+    executions = TickReader(sys.argv[1]).read("executions",start,end)
+    _,prices = to_price_series(executions["timestamp"],executions["price"])
+    ns = [1,2,3,5,10,20,30,60]
+    ks = [1000,2000,5000,10000,20000,30000]
+    result = analyze_grid(prices,ns,ks)
+    print("n\\k " + " ".join(f"{k:>14.0f}" for k in ks))
+    for i,n in enumerate(ns):
+        cells = [f"{result['probability'][i][j]:6.3f}({int(result['count'][i][j]):6d})" for j in range(len(ks))]
+        print(f"{n:>4} " + " ".join(cells))
@@ -0,0 +1,156 @@
+import numpy as np
+
+OHLCV_DTYPE = np.dtype([
+    ("timestamp",np.float64),
+    ("open",np.float64),
+    ("high",np.float64),
+    ("low",np.float64),
+    ("close",np.float64),
+    ("volume",np.float64),
+    ("buy_volume",np.float64),
+    ("sell_volume",np.float64),
+    ])
+
+class OhlcvRingBuffer():
+    """
+    1つの時間足のローソク足を、事前に確保した構造化NumPy配列のリングバッファに保持する。
+    各足を配列の2か所(pos,pos+length)に書き込むことで、直近n本を常にコピーなしの連続したビューで返せる。
+    足の区切りは約定のタイムスタンプ(取引所時刻)で決める。約定のない足は直前の終値で埋める。
+    """
+    def __init__(self,resolution,length):
+        """
+        :param resolution:足の長さ(秒)
+        :param length:保持する足の本数
+        """
+        self.resolution = resolution
+        self.length = length
+        self.buffer = np.zeros(2 * length,dtype=OHLCV_DTYPE)
+        self.head = -1
+        self.count = 0
+        self.last_timestamp = None
+        self.bar = None
+        # 各足の始値・終値にした約定のタイムスタンプ。遅れて届いた約定で始値・終値を更新するかの判定に使う。約定のない足はNone。
+        self.open_timestamps = [None] * length
+        self.close_timestamps = [None] * length
+        # 最新足より前の足を直した回数。共有メモリなどに写している側が、全体を書き直すかの判定に使う。
+        self.revision = 0
+
+    def _write(self,pos,bar):
+        self.buffer[pos] = bar
+        self.buffer[pos + self.length] = bar
+
+    def _append(self,bar,trade_timestamp=None):
+        self.head = (self.head + 1) % self.length
+        self.count = min(self.count + 1,self.length)
+        self._write(self.head,bar)
+        self.open_timestamps[self.head] = trade_timestamp
+        self.close_timestamps[self.head] = trade_timestamp
+
+    def _fill_empty(self,bar_timestamp):
+        """
+        最新足の次からbar_timestampの直前まで、約定のない足を直前の終値で埋める。
+        """
+        close = self.bar[4]
+        num = int(round((bar_timestamp - self.last_timestamp) / self.resolution)) - 1
+        start = bar_timestamp - min(num,self.length) * self.resolution
+        for i in range(min(num,self.length)):
+            self._append((start + i * self.resolution,close,close,close,close,0.0,0.0,0.0))
+
+    def advance(self,timestamp):
+        """
+        約定がなくても、timestampの属する足まで空の足を作って進める。
+        """
+        if self.last_timestamp is None:return
+        bar_timestamp = timestamp - timestamp % self.resolution
+        if bar_timestamp <= self.last_timestamp:return
+        self._fill_empty(bar_timestamp + self.resolution)
+        self.bar = self.buffer[self.head].tolist()
+        self.last_timestamp = bar_timestamp
+
+    def update(self,timestamp,price,quantity,taker_side):
+        """
+        約定1件を反映する。
+        保持している範囲内であれば、遅れて届いた約定は過去の足に反映する。
+        始値・終値は約定の届いた順ではなく、その足で最も古い・新しい約定の価格にする。
+        過去の足の終値を直した場合は、約定のない後続の足も直した終値で埋め直す。
+        """
+        bar_timestamp = timestamp - timestamp % self.resolution
+        buy_volume = quantity if taker_side == "buy" else 0.0
+        sell_volume = quantity if taker_side == "sell" else 0.0
+        if self.last_timestamp is None or bar_timestamp > self.last_timestamp:
+            if self.last_timestamp is not None:
+                self._fill_empty(bar_timestamp)
+            self.bar = (bar_timestamp,price,price,price,price,quantity,buy_volume,sell_volume)
+            self.last_timestamp = bar_timestamp
+            self._append(self.bar,timestamp)
+            return
+        back = int(round((self.last_timestamp - bar_timestamp) / self.resolution))
+        if back >= self.count:return
+        pos = (self.head - back) % self.length
+        _,o,h,l,c,v,bv,sv = self.bar if back == 0 else self.buffer[pos].tolist()
+        if v == 0:
+            # 空の足として埋めていた場合は始値から作り直す
+            o,h,l = price,price,price
+            self.open_timestamps[pos] = timestamp
+            self.close_timestamps[pos] = None
+        elif timestamp < self.open_timestamps[pos]:
+            o = price
+            self.open_timestamps[pos] = timestamp
+        if self.close_timestamps[pos] is None or timestamp >= self.close_timestamps[pos]:
+            c = price
+            self.close_timestamps[pos] = timestamp
+        self._write(pos,(bar_timestamp,o,max(h,price),min(l,price),c,v + quantity,bv + buy_volume,sv + sell_volume))
+        if back > 0:
+            self.revision += 1
+        # 後続の約定のない足は、直した終値で埋め直す
+        for step in range(1,back + 1):
+            next_pos = (pos + step) % self.length
+            next_bar = self.buffer[next_pos].tolist()
+            if next_bar[5] != 0:break
+            self._write(next_pos,(next_bar[0],c,c,c,c,0.0,0.0,0.0))
+        self.bar = self.buffer[self.head].tolist()
+
+    def get(self,n):
+        """
+        直近n本の足を時系列順に返す。最後尾が最新(未確定)の足。
+        コピーではなくバッファのビューを返すため、値は以降の更新で変わる。
+        :param n:本数。保持している本数を超える場合は保持している分だけ返す。
+        """
+        n = min(n,self.count)
+        end = self.head + self.length + 1
+        return self.buffer[end - n:end]
+
+class OhlcvAggregator():
+    """
+    約定から複数の時間足のローソク足を同時に作る。
+    """
+    def __init__(self,resolutions=(1,5,60,300,3600),length=600):
+        """
+        :param resolutions:作る足の長さ(秒)のリスト
+        :param length:保持する足の本数。時間足ごとに変える場合は{足の長さ:本数}の辞書。
+        """
+        self.buffers = {}
+        for resolution in resolutions:
+            buffer_length = length[resolution] if isinstance(length,dict) else length
+            self.buffers[resolution] = OhlcvRingBuffer(resolution,buffer_length)
+
+    def update(self,timestamp,price,quantity,taker_side):
+        for buffer in self.buffers.values():
+            buffer.update(timestamp,price,quantity,taker_side)
+
+    def advance(self,timestamp):
+        for buffer in self.buffers.values():
+            buffer.advance(timestamp)
+
+    def get(self,n,resolution=60):
+        """
+        :param n:本数
+        :param resolution:足の長さ(秒)
+        """
+        return self.buffers[resolution].get(n)
+
+    def get_revision(self,resolution=60):
+        """
+        最新足より前の足を直した回数を返す。
+        """
+        return self.buffers[resolution].revision
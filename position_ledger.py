@@ -0,0 +1,226 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+def apply_fill(position,average_price,quantity,price):
+    """
+    約定1件をポジションに反映した結果を返す。反対売買の分は実現損益にする。
+    PositionLedgerとバックテストのシミュレーターで共通の計算。
+    :param quantity:約定数量。買いは正、売りは負。
+    :return: ポジション、平均建値、実現損益の増分
+    """
+    if position * quantity >= 0:
+        total = position + quantity
+        if total != 0:
+            average_price = (average_price * position + price * quantity) / total
+        return total,average_price,0
+    closed = min(abs(quantity),abs(position))
+    direction = 1 if position > 0 else -1
+    pnl = (price - average_price) * closed * direction
+    position += quantity
+    if abs(position) < 1e-12:
+        position = 0
+        average_price = 0
+    elif position * direction < 0:
+        # ドテンした分は約定価格で新規
+        average_price = price
+    return position,average_price,pnl
+
+class PositionLedger():
+    """
+    約定のたびにポジション、平均建値、実現損益を更新する台帳。
+    約定は次の2つから検出する。
+    ・発注・キャンセル・変更のレスポンスと/orders/の取得結果。注文ごとの約定数量の増分を約定とする。
+    ・公開の約定。liveな自分の注文の価格を超えて約定した場合、その注文は全量約定したとみなす(推定約定)。
+      後で注文の約定数量が分かった時に、推定との差分で補正する。
+    REST APIのポジション・実現損益とは定期的に突き合わせ、ずれを記録してREST側に合わせる。
+    実現損益のずれ(手数料、端数、見逃した約定)はreconcile_pnlに分けて持ち、約定の実現損益には混ぜない。
+    読み出しは保持している値を返すだけで、apiは呼ばない。
+    """
+    def __init__(self,logger=None,product_id=None,since=None,max_orders=10000,drift_tolerance=1e-8):
+        """
+        :param logger:ロガーインスタンス。Noneの場合はずれを出力しない。
+        :param product_id:対象の商品id。公開の約定の商品の判定に使う。Noneの場合は判定しない。
+        :param since:この時刻以降に作られた注文の約定のみ反映する。それ以前のポジションは突き合わせで反映する。Noneの場合は現在時刻。
+        :param max_orders:約定数量を覚えておく注文数の上限
+        :param drift_tolerance:突き合わせでずれとみなす大きさ
+        """
+        self.logger = logger
+        self.product_id = product_id
+        self.since = since if since is not None else time.time()
+        self.max_orders = max_orders
+        self.drift_tolerance = drift_tolerance
+        self.lock = Lock()
+
+        self.position = 0
+        self.average_price = 0
+        self.realized_pnl = 0
+        # 突き合わせでREST側に合わせた実現損益の補正の累計
+        self.reconcile_pnl = 0
+        self.ltp = None
+        self._reported_pnl = 0
+
+        # 注文id -> 反映済みの約定数量(絶対値)
+        self._filled = OrderedDict()
+        # 注文id -> liveな注文。推定約定の判定に使う。
+        self._live = {}
+        # 約定数量を反映し終えた注文id。/orders/に再び現れても反映しない。
+        self._closed_ids = OrderedDict()
+        self.last_fill_at = 0
+
+        # RESTの実現損益の累計
+        self.rest_realized_pnl = 0
+        self.stats = {"fill":0,"inferred_fill":0,"correction":0,"reconcile":0,"drift":0}
+        self.last_drift = (0,0)
+
+    def _log_error(self,message):
+        if self.logger is None:return
+        self.logger.error(f"[PositionLedger]{message}")
+
+    def _apply(self,quantity,price):
+        """
+        約定をポジションに反映する。反対売買の分は実現損益にする。
+        """
+        self.last_fill_at = time.monotonic()
+        self.position,self.average_price,pnl = apply_fill(self.position,self.average_price,quantity,price)
+        self.realized_pnl += pnl
+
+    def _fill_to(self,order,filled,price=None):
+        """
+        注文の反映済み約定数量をfilledにし、増分をポジションに反映する。
+        :param price:増分の約定価格。Noneの場合は注文の価格。
+        """
+        delta = filled - self._filled.get(order["id"],0)
+        self._filled[order["id"]] = filled
+        if abs(delta) < 1e-12:return False
+        if price is None:
+            price = order["price"] if order["price"] else self.ltp
+        if price is None:return False
+        self._apply(delta if order["quantity"] > 0 else -delta,price)
+        return True
+
+    def _forget(self,order_id):
+        self._filled.pop(order_id,None)
+        self._closed_ids[order_id] = None
+        while len(self._closed_ids) > self.max_orders:
+            self._closed_ids.popitem(last=False)
+
+    def on_order(self,order):
+        """
+        注文のレスポンス・取得結果で約定を反映する。LiquidOrderIndexのリスナーとして登録する。
+        :param order:_to_my_order_format済みの注文。remainingは約定済みの数量。
+        """
+        if order is None:return
+        order_id = order["id"]
+        with self.lock:
+            if order_id in self._closed_ids:return
+            if order_id not in self._filled and order["timestamp"] < self.since:return
+            corrected = order_id in self._filled and order_id not in self._live and self._filled[order_id] > 0
+            # 価格を変更した注文のレスポンスでは、増分は変更前に板にあった価格で約定している
+            live = self._live.get(order_id)
+            price = live["price"] if live is not None and live["price"] else None
+            if self._fill_to(order,abs(order["remaining"]),price):
+                if corrected:
+                    self.stats["correction"] += 1
+                else:
+                    self.stats["fill"] += 1
+            if order["status"] == "live":
+                self._live[order_id] = order
+            else:
+                self._live.pop(order_id,None)
+                self._forget(order_id)
+            while len(self._filled) > self.max_orders:
+                self._filled.popitem(last=False)
+
+    def on_execution(self,channel,record,product_id=None):
+        """
+        公開の約定で、価格を超えて約定されたliveな注文を約定済みとする。LiquidRealtimeApiのリスナーとして登録する。
+        """
+        if channel != "executions":return
+        if self.product_id is not None and product_id is not None and product_id != self.product_id:return
+        with self.lock:
+            self.ltp = record.price
+            if len(self._live) == 0:return
+            for order_id,order in list(self._live.items()):
+                # 注文より前の約定(バックフィルなど)では判定しない
+                if record.timestamp < order["timestamp"]:continue
+                if order["quantity"] > 0:
+                    traded_through = record.price < order["price"]
+                else:
+                    traded_through = record.price > order["price"]
+                if not traded_through:continue
+                self._live.pop(order_id)
+                if self._fill_to(order,abs(order["quantity"])):
+                    self.stats["inferred_fill"] += 1
+
+    def reconcile(self,position,average_price,closed_pnl,fetch_started_at=None):
+        """
+        REST APIのポジション・実現損益と突き合わせる。ずれがあれば記録し、REST側に合わせる。
+        実現損益のずれはreconcile_pnlに足し、約定の実現損益とget_position_and_open_closed_pnlの差分には含めない。
+        取得開始後に約定を反映した場合は、取得結果の方が古い可能性があるため、ずれの記録のみ行う。
+        :param position:RESTのポジション
+        :param average_price:RESTの平均建値
+        :param closed_pnl:前回の突き合わせ以降のRESTの実現損益
+        :param fetch_started_at:取得開始時のtime.monotonic()
+        :return: ポジションのずれ、実現損益のずれ
+        """
+        with self.lock:
+            self.rest_realized_pnl += closed_pnl
+            position_drift = position - self.position
+            pnl_drift = self.rest_realized_pnl - self.realized_pnl - self.reconcile_pnl
+            self.stats["reconcile"] += 1
+            self.last_drift = (position_drift,pnl_drift)
+            if abs(position_drift) <= self.drift_tolerance and abs(pnl_drift) <= self.drift_tolerance:
+                return self.last_drift
+            self.stats["drift"] += 1
+            in_flight = fetch_started_at is not None and self.last_fill_at > fetch_started_at
+            self._log_error(f"drift position={position_drift} pnl={pnl_drift}{' (fills in flight, not applied)' if in_flight else ''}.")
+            if in_flight:
+                return self.last_drift
+            self.position = position
+            self.average_price = average_price if position != 0 else 0
+            self.reconcile_pnl += pnl_drift
+            return self.last_drift
+
+    def get_position(self):
+        return self.position
+
+    def get_average_price(self):
+        return self.average_price
+
+    def get_realized_pnl(self):
+        """
+        約定から計算した実現損益。突き合わせの補正は含まない。
+        """
+        return self.realized_pnl
+
+    def get_reconcile_pnl(self):
+        """
+        突き合わせでREST側に合わせた実現損益の補正の累計。
+        """
+        return self.reconcile_pnl
+
+    def get_unrealized_pnl(self,price=None):
+        """
+        :param price:評価する価格。Noneの場合は最後に受信した約定価格。
+        """
+        price = self.ltp if price is None else price
+        if self.position == 0 or price is None:return 0
+        return (price - self.average_price) * self.position
+
+    def get_position_and_open_closed_pnl(self,price=None):
+        """
+        LiquidRestApi.get_position_and_open_closed_pnlと同じ形で返す。
+        実現損益は約定の分のみで、突き合わせの補正はget_reconcile_pnlで別に取得する。
+        :return: ポジション、未実現損益、前回呼び出し時からの実現損益
+        """
+        with self.lock:
+            closed_pnl = self.realized_pnl - self._reported_pnl
+            self._reported_pnl = self.realized_pnl
+            return self.position,self.get_unrealized_pnl(price),closed_pnl
+
+    def get_stats(self):
+        """
+        約定の検出数と突き合わせの結果を返す。
+        """
+        return dict(self.stats,last_position_drift=self.last_drift[0],last_pnl_drift=self.last_drift[1],reconcile_pnl=self.reconcile_pnl)
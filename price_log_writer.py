@@ -0,0 +1,199 @@
+import os
+import csv
+import gzip
+import sys
+import queue
+import time
+from threading import Thread,Lock
+import numpy as np
+from tick_recorder import _day
+
+PRICE_LOG_DTYPE = np.dtype([
+    ("timestamp",np.float64),
+    ("position",np.float64),
+    ("pnl",np.float64),
+    ("trade_count",np.float64),
+    ("ltp",np.float64),
+    ("ema",np.float64),
+    ("ask",np.float64),
+    ("bid",np.float64),
+    ("ask_cancel",np.float64),
+    ("bid_cancel",np.float64),
+    ])
+
+class PriceLogWriter():
+    """
+    価格・発注判断のログを列ごとのバッファに溜め、別スレッドでまとめてファイルに書き出す。
+    appendはバッファの1行に書き込むだけで、ファイル操作はしない。
+    flush_rows行溜まるか、最後の書き出しからflush_interval秒経つと書き出す。
+    ファイルは日付(日本時間)ごとに分ける。
+    format="npz":{directory}/{YYYYMMDD}/{書き出し時刻}.npzに、列ごとの配列を圧縮して書く。
+    format="csv":{directory}/{YYYYMMDD}.csv.gzに追記する。
+    """
+    def __init__(self,directory,logger,dtype=PRICE_LOG_DTYPE,format="npz",flush_rows=600,flush_interval=60):
+        """
+        :param directory:出力先ディレクトリ
+        :param logger:ロガーインスタンス
+        :param dtype:1行の構造化dtype。先頭はtimestamp。
+        :param format:npzかcsv
+        :param flush_rows:この行数溜まったら書き出す
+        :param flush_interval:最後の書き出しからこの秒数経ったら書き出す
+        """
+        if format not in ("npz","csv"):
+            raise ValueError(f"unknown format {format}.")
+        self.directory = directory
+        self.logger = logger
+        self.dtype = dtype
+        self.format = format
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.buffer = np.empty(flush_rows,dtype=dtype)
+        self.count = 0
+        self.lock = Lock()
+        self.queue = queue.SimpleQueue()
+        self.writer_thread = None
+        self.last_flush = time.monotonic()
+        self._chunk_seq = 0
+
+    def _log_error(self,message):
+        self.logger.error(f"[PriceLogWriter]{message}")
+
+    def start(self):
+        if self.writer_thread is not None:return
+        self.writer_thread = Thread(target=self._write_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def stop(self):
+        """
+        バッファに残った行を書き出してから終了する。
+        """
+        if self.writer_thread is None:return
+        self.flush()
+        self.queue.put(None)
+        self.writer_thread.join()
+        self.writer_thread = None
+
+    def append(self,row):
+        """
+        1行追加する。
+        :param row:dtypeの列順のタプル
+        """
+        with self.lock:
+            self.buffer[self.count] = row
+            self.count += 1
+            if self.count < self.flush_rows:return
+            self._swap()
+
+    def flush(self):
+        """
+        バッファの行を書き出しキューに入れる。
+        """
+        with self.lock:
+            self._swap()
+
+    def _swap(self):
+        # lockを取得して呼ぶ。書き出すバッファを渡し、新しいバッファに切り替える。
+        self.last_flush = time.monotonic()
+        if self.count == 0:return
+        self.queue.put(self.buffer[:self.count])
+        self.buffer = np.empty(self.flush_rows,dtype=self.dtype)
+        self.count = 0
+
+    def _write_loop(self):
+        while True:
+            timeout = max(0,self.last_flush + self.flush_interval - time.monotonic())
+            try:
+                rows = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.flush()
+                continue
+            if rows is None:return
+            try:
+                self._write(rows)
+            except Exception as e:
+                self._log_error(f"failed to write price log.{e}")
+
+    def _write(self,rows):
+        days = np.array([_day(timestamp) for timestamp in rows["timestamp"][[0,-1]]])
+        if days[0] == days[1]:
+            groups = [(days[0],rows)]
+        else:
+            # 日付をまたぐ場合は行ごとに日付で分ける
+            row_days = np.array([_day(timestamp) for timestamp in rows["timestamp"]])
+            groups = [(day,rows[row_days == day]) for day in np.unique(row_days)]
+        for day,group in groups:
+            if self.format == "npz":
+                self._write_npz(day,group)
+            else:
+                self._write_csv(day,group)
+
+    def _write_npz(self,day,rows):
+        day_dir = os.path.join(self.directory,day)
+        os.makedirs(day_dir,exist_ok=True)
+        self._chunk_seq += 1
+        path = os.path.join(day_dir,f"{int(time.time() * 1000)}_{self._chunk_seq:06d}.npz")
+        np.savez_compressed(path,**{name:rows[name] for name in self.dtype.names})
+
+    def _write_csv(self,day,rows):
+        os.makedirs(self.directory,exist_ok=True)
+        path = os.path.join(self.directory,f"{day}.csv.gz")
+        new_file = not os.path.exists(path)
+        with gzip.open(path,"at",newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(self.dtype.names)
+            writer.writerows(rows.tolist())
+
+def load_price_log(directory,start=None,end=None,dtype=PRICE_LOG_DTYPE,as_dataframe=False):
+    """
+    PriceLogWriterで書き出したログを読み込む。npzとcsvのどちらにも対応する。
+    :param start:開始タイムスタンプ(この時刻を含む)。Noneの場合は最初から。
+    :param end:終了タイムスタンプ(この時刻を含まない)。Noneの場合は最後まで。
+    :param as_dataframe:Trueの場合はpandasのDataFrameで返す。
+    :return: 時系列順の構造化NumPy配列
+    """
+    start_day = _day(start) if start is not None else None
+    end_day = _day(end) if end is not None else None
+    arrays = []
+    names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+    for name in names:
+        day = name.split(".")[0]
+        if start_day is not None and day < start_day:continue
+        if end_day is not None and day > end_day:continue
+        path = os.path.join(directory,name)
+        if os.path.isdir(path):
+            for chunk_name in sorted(os.listdir(path)):
+                if not chunk_name.endswith(".npz"):continue
+                with np.load(os.path.join(path,chunk_name)) as chunk:
+                    array = np.empty(len(chunk[dtype.names[0]]),dtype=dtype)
+                    for column in dtype.names:
+                        array[column] = chunk[column]
+                arrays.append(array)
+        elif name.endswith(".csv.gz"):
+            with gzip.open(path,"rt") as f:
+                array = np.genfromtxt(f,delimiter=",",skip_header=1,dtype=dtype)
+            arrays.append(np.atleast_1d(array))
+    array = np.concatenate(arrays) if len(arrays) > 0 else np.empty(0,dtype=dtype)
+    array = array[np.argsort(array["timestamp"],kind="stable")]
+    if start is not None:
+        array = array[array["timestamp"] >= start]
+    if end is not None:
+        array = array[array["timestamp"] < end]
+    if as_dataframe:
+        import pandas as pd
+        return pd.DataFrame(array)
+    return array
+
+
+if __name__=='__main__':
+    if len(sys.argv) < 2:
+        print("usage: python price_log_writer.py price_log_dir [start_timestamp] [end_timestamp]")
+        sys.exit(1)
+    start = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    end = float(sys.argv[3]) if len(sys.argv) > 3 else None
+    array = load_price_log(sys.argv[1],start,end)
+    print(f"{len(array)} rows")
+    if len(array) > 0:
+        print(array[:5])
+        print(array[-5:])
@@ -0,0 +1,180 @@
+import heapq
+import itertools
+import time
+from concurrent.futures import Future
+from threading import Thread,Condition
+
+# 優先度。値が小さいほど先に送る。
+PRIORITY_CANCEL = 0
+PRIORITY_ORDER = 1
+PRIORITY_QUERY = 2
+
+class RateLimitError(Exception):
+    """
+    取引所のレート制限(429)に当たった。
+    """
+    pass
+
+class NonceError(Exception):
+    """
+    nonceエラーで拒否された。
+    """
+    pass
+
+class TokenBucket():
+    """
+    apiキー1つ分のトークンバケット。rate個/秒でトークンが貯まり、最大capacity個まで貯まる。
+    レート制限・nonceエラーが続いた場合は、連続回数に応じて指数的に送信を止める。
+    """
+    def __init__(self,rate,capacity,base_backoff=0.5,max_backoff=30):
+        """
+        :param rate:1秒あたりに補充するトークン数
+        :param capacity:最大トークン数(バースト)
+        :param base_backoff:1回目のエラーで止める秒数
+        :param max_backoff:止める秒数の上限
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.blocked_until = 0
+        self.error_count = 0
+
+    def _refill(self,now):
+        self.tokens = min(self.capacity,self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self,now):
+        """
+        トークンが1つ使えるようになるまでの秒数を返す。
+        """
+        self._refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait,self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def success(self):
+        self.error_count = 0
+
+    def backoff(self):
+        """
+        エラーの連続回数に応じて送信を止める。
+        :return: 止める秒数
+        """
+        seconds = min(self.max_backoff,self.base_backoff * 2 ** self.error_count)
+        self.error_count += 1
+        self.blocked_until = time.monotonic() + seconds
+        return seconds
+
+class _Request():
+    def __init__(self,priority,seq,fn,retry_num):
+        self.priority = priority
+        self.seq = seq
+        self.fn = fn
+        self.retry_num = retry_num
+        self.attempts = 0
+        self.future = Future()
+
+    def __lt__(self,other):
+        return (self.priority,self.seq) < (other.priority,other.seq)
+
+class RequestScheduler():
+    """
+    全てのrest api呼び出しを優先度順に送る。
+    apiキーごとにワーカースレッドを1つ持ち、ワーカーはそのキーを専有する。
+    同じキーのリクエストは1つずつ順番に署名・送信されるため、nonceは単調増加する。
+    キーが2つ以上ある場合、1つのキーをキャンセル専用に予約し、キャンセルが照会系の後ろで待たないようにする。
+    """
+    def __init__(self,key_num,logger,rate=1.0,burst=3,base_backoff=0.5,max_backoff=30,reserve_for_cancel=True):
+        """
+        :param key_num:apiキーの数
+        :param logger:ロガーインスタンス
+        :param rate:キーごとの1秒あたりのリクエスト数
+        :param burst:キーごとに連続で送れるリクエスト数
+        :param base_backoff:レート制限・nonceエラー時に止める最初の秒数
+        :param max_backoff:止める秒数の上限
+        :param reserve_for_cancel:Trueの場合、キーが2つ以上あれば1つをキャンセル専用にする
+        """
+        self.logger = logger
+        self.buckets = [TokenBucket(rate,burst,base_backoff,max_backoff) for _ in range(key_num)]
+        self.heap = []
+        self.condition = Condition()
+        self.seq = itertools.count()
+        self.stop_flg = False
+        self.workers = []
+        for key_index in range(key_num):
+            cancel_only = reserve_for_cancel and key_num >= 2 and key_index == 0
+            worker = Thread(target=self._worker_loop,args=(key_index,cancel_only))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _log_error(self,message):
+        self.logger.error(f"[RequestScheduler]{message}")
+
+    def submit(self,priority,fn,retry_num=3):
+        """
+        リクエストを登録する。
+        :param priority:PRIORITY_CANCEL,PRIORITY_ORDER,PRIORITY_QUERYのいずれか
+        :param fn:fn(key_index)。使用するapiキーのインデックスを受け取って送信し、結果を返す。
+            RateLimitError,NonceErrorを送出した場合はキーを止めて再送する。
+        :param retry_num:RateLimitError,NonceErrorで再送する回数の上限
+        :return: concurrent.futures.Future
+        """
+        request = _Request(priority,next(self.seq),fn,retry_num)
+        with self.condition:
+            heapq.heappush(self.heap,request)
+            self.condition.notify_all()
+        return request.future
+
+    def call(self,priority,fn,retry_num=3):
+        """
+        submitして結果を待つ。
+        """
+        return self.submit(priority,fn,retry_num).result()
+
+    def stop(self):
+        with self.condition:
+            self.stop_flg = True
+            self.condition.notify_all()
+
+    def _can_take(self,cancel_only):
+        if len(self.heap) == 0:return False
+        return not cancel_only or self.heap[0].priority == PRIORITY_CANCEL
+
+    def _worker_loop(self,key_index,cancel_only):
+        bucket = self.buckets[key_index]
+        while True:
+            # トークンが使えるようになるまで、リクエストを取らずに待つ
+            wait = bucket.wait_time(time.monotonic())
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            with self.condition:
+                while not self.stop_flg and not self._can_take(cancel_only):
+                    self.condition.wait()
+                if self.stop_flg:return
+                request = heapq.heappop(self.heap)
+            bucket.take()
+            request.attempts += 1
+            try:
+                result = request.fn(key_index)
+            except (RateLimitError,NonceError) as e:
+                seconds = bucket.backoff()
+                self._log_error(f"key {key_index} backoff {seconds}s.{type(e).__name__}:{e}")
+                if request.attempts <= request.retry_num:
+                    with self.condition:
+                        heapq.heappush(self.heap,request)
+                        self.condition.notify_all()
+                else:
+                    request.future.set_exception(e)
+                continue
+            except Exception as e:
+                request.future.set_exception(e)
+                continue
+            bucket.success()
+            request.future.set_result(result)
@@ -1,16 +1,109 @@
-
+import atexit
 import logging
-def setup_logger(name,logfile = None):
+import logging.handlers
+import queue
+import time
+
+class RateLimitFilter(logging.Filter):
+    """
+    同じ箇所から同じ内容のエラーが続く場合、interval秒に1回だけ出力する。
+    抑制した件数は次に出力するメッセージの末尾に付ける。
+    """
+    def __init__(self,interval=60,level=logging.ERROR,max_keys=1000):
+        """
+        :param interval:同じエラーを出力する最短の間隔(秒)
+        :param level:このレベル以上のログを対象にする
+        :param max_keys:覚えておくエラーの種類の上限。超えた場合は全て忘れる。
+        """
+        super().__init__()
+        self.interval = interval
+        self.level = level
+        self.max_keys = max_keys
+        # (パス,行番号,メッセージ,引数,例外の型) -> [最後に出力した時刻,抑制した件数]
+        self.history = {}
+
+    def filter(self,record):
+        if record.levelno < self.level:return True
+        # 書式文字列が同じでも、引数や例外の型が違うエラーは別に数える
+        exc_type = type(record.exc_info[1]).__name__ if record.exc_info else None
+        key = (record.pathname,record.lineno,str(record.msg),str(record.args),exc_type)
+        now = time.monotonic()
+        entry = self.history.get(key)
+        if entry is not None and now - entry[0] < self.interval:
+            entry[1] += 1
+            return False
+        if entry is not None and entry[1] > 0:
+            record.msg = f"{record.msg} (suppressed {entry[1]} similar messages)"
+        if len(self.history) >= self.max_keys:
+            self.history.clear()
+        self.history[key] = [now,0]
+        return True
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    メッセージの組み立てをリスナーのスレッドで行うQueueHandler。
+    同じプロセス内のキューに渡すだけなので、呼び出し元のスレッドではレコードをそのまま積む。
+    argsは後で文字列にするため、呼び出し後に変更されるオブジェクトを渡さないこと。
+    """
+    def prepare(self,record):
+        return record
+
+class Lazy():
+    """
+    文字列にする時に初めてfn(*args)を計算する。ログのargsに渡し、出力しない場合の計算を省く。
+    """
+    def __init__(self,fn,*args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+def _stop_listener(listener):
+    # 既に止めている場合は何もしない
+    if listener._thread is not None:
+        listener.stop()
+
+def setup_logger(name,logfile = None,queue_mode = False,max_bytes = None,backup_count = 5,when = None,error_interval = None):
+    """
+    :param name:ロガー名
+    :param logfile:出力するファイル。Noneの場合は標準出力のみ。
+    :param queue_mode:Trueの場合、呼び出し元はキューに積むだけにし、出力はバックグラウンドのスレッドで行う。
+    :param max_bytes:ファイルがこのサイズを超えたらローテーションする
+    :param backup_count:ローテーションで残すファイル数
+    :param when:時間でローテーションする場合の単位。midnight,Hなど。max_bytesが優先。
+    :param error_interval:同じエラーを出力する最短の間隔(秒)。Noneの場合は抑制しない。
+    """
     logger = logging.getLogger(str(name))
     logger.setLevel(logging.INFO)
     formatter = logging.Formatter(fmt="%(asctime)s - %(levelname)s - %(message)s",datefmt="%Y-%m-%d %H:%M:%S")
+    handlers = []
     sh = logging.StreamHandler()
     sh.setFormatter(formatter)
     sh.setLevel(logging.INFO)
-    logger.addHandler(sh)
+    handlers.append(sh)
     if logfile is not None:
-        fh = logging.FileHandler(logfile)
+        if max_bytes is not None:
+            fh = logging.handlers.RotatingFileHandler(logfile,maxBytes=max_bytes,backupCount=backup_count)
+        elif when is not None:
+            fh = logging.handlers.TimedRotatingFileHandler(logfile,when=when,backupCount=backup_count)
+        else:
+            fh = logging.FileHandler(logfile)
         fh.setFormatter(formatter)
         fh.setLevel(logging.INFO)
-        logger.addHandler(fh)
-    return logger
\ No newline at end of file
+        handlers.append(fh)
+    if error_interval is not None:
+        # キューに積む前に判定し、抑制するエラーは組み立てもしない
+        logger.addFilter(RateLimitFilter(error_interval))
+    if queue_mode:
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(_LazyQueueHandler(log_queue))
+        listener = logging.handlers.QueueListener(log_queue,*handlers,respect_handler_level=True)
+        listener.start()
+        # 終了時にキューに残ったログを出力する
+        atexit.register(_stop_listener,listener)
+        logger.queue_listener = listener
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+    return logger
@@ -0,0 +1,192 @@
+import os
+import queue
+from datetime import datetime,timezone,timedelta
+from threading import Thread
+import numpy as np
+
+TICKER_DTYPE = np.dtype([
+    ("timestamp",np.float64),
+    ("ltp",np.float64),
+    ("ask",np.float64),
+    ("bid",np.float64),
+    ("high",np.float64),
+    ("low",np.float64),
+    ("volume",np.float64),
+    ])
+
+EXECUTION_DTYPE = np.dtype([
+    ("timestamp",np.float64),
+    ("id",np.int64),
+    ("price",np.float64),
+    ("quantity",np.float64),
+    ("taker_side",np.int8),
+    ])
+
+BOOK_LEVELS = 20
+
+def book_dtype(levels=BOOK_LEVELS):
+    return np.dtype([
+        ("timestamp",np.float64),
+        ("ask_price",np.float64,(levels,)),
+        ("ask_size",np.float64,(levels,)),
+        ("bid_price",np.float64,(levels,)),
+        ("bid_size",np.float64,(levels,)),
+        ])
+
+TZ = timezone(timedelta(hours=+9), 'Asia/Tokyo')
+
+def _day(timestamp):
+    return datetime.fromtimestamp(timestamp,TZ).strftime("%Y%m%d")
+
+class TickRecorder():
+    """
+    realtime apiで受信したメッセージを、チャネルごとの固定長バイナリファイルに追記する。
+    ファイルは{directory}/{channel}/{YYYYMMDD}.bin。日付はメッセージのタイムスタンプ(日本時間)で決める。
+    ファイル書き込みは別スレッドで行い、受信スレッドはキューに入れるだけで待たない。
+    """
+    def __init__(self,directory,logger,book_levels=BOOK_LEVELS):
+        """
+        :param directory:出力先ディレクトリ
+        :param logger:ロガーインスタンス
+        :param book_levels:板情報を記録する片側の段数
+        """
+        self.directory = directory
+        self.logger = logger
+        self.book_levels = book_levels
+        self.dtypes = {"ticker":TICKER_DTYPE,"executions":EXECUTION_DTYPE,"book":book_dtype(book_levels)}
+        self.queue = queue.SimpleQueue()
+        self.files = {}
+        self.writer_thread = None
+
+    def _log_error(self,message):
+        self.logger.error(f"[TickRecorder]{message}")
+
+    def start(self):
+        if self.writer_thread is not None:return
+        self.writer_thread = Thread(target=self._write_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def stop(self):
+        """
+        キューに残ったメッセージを書き終えてからファイルを閉じる。
+        """
+        if self.writer_thread is None:return
+        self.queue.put(None)
+        self.writer_thread.join()
+        self.writer_thread = None
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def record_ticker(self,ticker):
+        self.queue.put(("ticker",ticker.timestamp,(ticker.timestamp,ticker.ltp,ticker.ask,ticker.bid,ticker.high,ticker.low,ticker.volume)))
+
+    def record_execution(self,execution):
+        taker_side = 1 if execution.taker_side == "buy" else -1
+        self.queue.put(("executions",execution.timestamp,(execution.timestamp,execution.id,execution.price,execution.quantity,taker_side)))
+
+    def record_book(self,order_book):
+        """
+        :param order_book:LiquidOrderBook。上位book_levels段を記録する。足りない段はnanで埋める。
+        """
+        ask_price,ask_size = order_book.get_levels("asks",self.book_levels)
+        bid_price,bid_size = order_book.get_levels("bids",self.book_levels)
+        self.queue.put(("book",order_book.timestamp,(order_book.timestamp,ask_price,ask_size,bid_price,bid_size)))
+
+    def _get_file(self,channel,day):
+        f = self.files.get(channel)
+        path = os.path.join(self.directory,channel,f"{day}.bin")
+        if f is not None and f.name == path:
+            return f
+        # 日付が変わったらファイルを切り替える
+        if f is not None:
+            f.close()
+        os.makedirs(os.path.join(self.directory,channel),exist_ok=True)
+        f = open(path,"ab")
+        self.files[channel] = f
+        return f
+
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            batches = {}
+            for item in items:
+                if item is None:
+                    stop = True
+                    continue
+                channel,timestamp,record = item
+                batches.setdefault((channel,_day(timestamp)),[]).append(record)
+            for (channel,day),records in batches.items():
+                try:
+                    f = self._get_file(channel,day)
+                    f.write(np.array(records,dtype=self.dtypes[channel]).tobytes())
+                    f.flush()
+                except Exception as e:
+                    self._log_error(f"failed to write {channel}.{e}")
+
+class TickReader():
+    """
+    TickRecorderが書いたファイルをメモリマップで読み、NumPyの構造化配列で返す。
+    """
+    def __init__(self,directory,book_levels=BOOK_LEVELS):
+        """
+        :param directory:TickRecorderの出力先ディレクトリ
+        :param book_levels:TickRecorderで指定した板情報の段数
+        """
+        self.directory = directory
+        self.dtypes = {"ticker":TICKER_DTYPE,"executions":EXECUTION_DTYPE,"book":book_dtype(book_levels)}
+
+    def _map(self,path,dtype):
+        # 書き込み途中の末尾の不完全なレコードは読まない
+        num = os.path.getsize(path) // dtype.itemsize
+        if num == 0:
+            return np.empty(0,dtype=dtype)
+        return np.memmap(path,dtype=dtype,mode="r",shape=(num,))
+
+    def read(self,channel,start=None,end=None):
+        """
+        指定期間のメッセージを返す。
+        期間が1日に収まる場合はメモリマップのビューを返し、複数日にまたがる場合は連結したコピーを返す。
+        タイムスタンプが単調増加でないファイルは、受信順のまま期間内のレコードを抜き出したコピーを返す。
+        :param channel:ticker,executions,bookのいずれか
+        :param start:開始タイムスタンプ(この時刻を含む)。Noneの場合は最初から。
+        :param end:終了タイムスタンプ(この時刻を含まない)。Noneの場合は最後まで。
+        """
+        dtype = self.dtypes[channel]
+        channel_dir = os.path.join(self.directory,channel)
+        if not os.path.isdir(channel_dir):
+            return np.empty(0,dtype=dtype)
+        start_day = _day(start) if start is not None else None
+        end_day = _day(end) if end is not None else None
+        arrays = []
+        for name in sorted(os.listdir(channel_dir)):
+            if not name.endswith(".bin"):continue
+            day = name[:-4]
+            if start_day is not None and day < start_day:continue
+            if end_day is not None and day > end_day:continue
+            array = self._map(os.path.join(channel_dir,name),dtype)
+            timestamps = array["timestamp"]
+            if np.all(timestamps[1:] >= timestamps[:-1]):
+                lo = np.searchsorted(timestamps,start,side="left") if start is not None else 0
+                hi = np.searchsorted(timestamps,end,side="left") if end is not None else len(array)
+                arrays.append(array[lo:hi])
+                continue
+            # 受信順に追記するため、取引所の時刻が前後したファイルは二分探索できない
+            mask = np.ones(len(array),dtype=bool)
+            if start is not None:
+                mask &= timestamps >= start
+            if end is not None:
+                mask &= timestamps < end
+            arrays.append(array[mask])
+        if len(arrays) == 0:
+            return np.empty(0,dtype=dtype)
+        if len(arrays) == 1:
+            return arrays[0]
+        return np.concatenate(arrays)